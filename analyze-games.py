@@ -1,22 +1,24 @@
 import argparse
+import data_sources
+import instrumentation
 import json
+import numpy
 import os
 import pandas as pd
-import random
 import re
 from common import (convert_team_totals_to_averages,
                     differential_vector,
                     extract_stats_components,
-                    read_team_stats_file)
+                    read_team_stats_file,
+                    team_stat_columns)
 from constants import YEAR
+from data_sources import get_source
 from datetime import datetime
+from instrumentation import count, span
 from mascots import MASCOTS
-from predictor import Predictor
-from pymongo import MongoClient
-from save_json import save_predictions_json
-from sportsreference.ncaab.boxscore import Boxscores
-from sportsreference.ncaab.conferences import Conferences
-from sportsreference.ncaab.teams import Teams
+from mongo_store import prediction_store, run_id_for_date
+from predictor import JOBS_VARIABLE, Predictor
+from save_json import read_records, save_predictions_json
 
 
 AWAY = 0
@@ -58,25 +60,25 @@ def team_ranked(team):
         return None
 
 
-def save_to_mongodb(predictions):
-    client = MongoClient()
-    db = client.clarktechsports
-    # Clear all of the existing predictions and add predictions for the
-    # current day
-    db.predictions.update_many({}, {'$set': {'latest': False}})
-    db.predictions.insert_many(predictions)
+def save_to_mongodb(filename):
+    # Predictions are saved as the run for the current day, replacing any
+    # earlier run from the same day. They are streamed back from the file
+    # rather than kept in memory.
+    prediction_store().save_run(run_id_for_date(), read_records(filename))
+
+
+def predictions_filename(today=None):
+    today = today or datetime.now()
+    return 'predictions/%s-%s-%s.json' % (today.month, today.day, today.year)
 
 
 def save_predictions(predictions, skip_save_to_mongodb):
-    today = datetime.now()
     if not os.path.exists('predictions'):
         os.makedirs('predictions')
-    filename = 'predictions/%s-%s-%s.json' % (today.month,
-                                              today.day,
-                                              today.year)
+    filename = predictions_filename()
     save_predictions_json(predictions, filename)
     if not skip_save_to_mongodb:
-        save_to_mongodb(predictions)
+        save_to_mongodb(filename)
 
 
 def display_prediction(matchup, result):
@@ -122,21 +124,19 @@ def create_prediction_data(match_data, inverted_conferences, winner, loser,
     return prediction
 
 
-def create_variance(stats, stdev_dict):
-    local_stats = {}
+def create_variance(stats, stdev_dict, num_sims=1):
+    # Every simulation gets its own row of stats, each stat shifted by up to
+    # one standard deviation.
+    columns = [stat for stat in stats if not stat.startswith('opp_')]
+    stdev = numpy.array([float(stdev_dict[stat]) for stat in columns])
+    values = stats[columns].values[0].astype(float)
+    variance = numpy.random.uniform(-1 * stdev, stdev,
+                                    (num_sims, len(columns)))
+    return pd.DataFrame(values + variance, columns=columns)
 
-    for stat in stats:
-        if stat.startswith('opp_'):
-            continue
-        min_val = -1 * float(stdev_dict[stat])
-        max_val = abs(min_val)
-        variance = random.uniform(min_val, max_val)
-        new_value = float(stats[stat]) + variance
-        local_stats[stat] = new_value
-    return pd.DataFrame([local_stats])
 
-
-def get_stats(stats_filename, stdev_dict, away=False):
+def get_stats(stats_filename, stdev_dict, away=False, columns=None,
+              num_sims=1):
     stats = read_team_stats_file(stats_filename)
     for field in FIELDS_TO_DROP:
         stats.drop(field, 1, inplace=True)
@@ -145,8 +145,10 @@ def get_stats(stats_filename, stdev_dict, away=False):
        'net_rating' in stats:
         stats['defensive_rating'] = stats['offensive_rating'] - \
             stats['net_rating']
+    if columns is not None:
+        stats = stats[[col for col in stats if col in columns]]
     if stdev_dict:
-        stats = create_variance(stats, stdev_dict)
+        stats = create_variance(stats, stdev_dict, num_sims)
         stats = extract_stats_components(stats, away)
     else:
         # Get all of the stats that don't start with 'opp', AKA all of the
@@ -158,15 +160,15 @@ def get_stats(stats_filename, stdev_dict, away=False):
     return stats
 
 
-def get_match_stats(game, stdev_dict):
+def get_match_stats(game, stdev_dict, columns=None, num_sims=1):
     # No stats are saved for non-DI schools, so ignore predictions for matchups
     # that include non-DI schools.
     if game['non_di']:
         return None
     away_stats = get_stats('team-stats/%s' % game['away_abbr'], stdev_dict,
-                           away=True)
+                           away=True, columns=columns, num_sims=num_sims)
     home_stats = get_stats('team-stats/%s' % game['home_abbr'], stdev_dict,
-                           away=False)
+                           away=False, columns=columns, num_sims=num_sims)
     match_stats = pd.concat([away_stats, home_stats], axis=1)
     return match_stats
 
@@ -210,13 +212,15 @@ def get_points(points, winner, loser):
 
 
 def make_predictions(prediction_stats, games_list, match_info, predictor):
-    prediction_list = []
-    conferences = Conferences().team_conference
-
-    prediction_data = pd.concat(prediction_stats)
-    prediction_data = differential_vector(prediction_data)
-    prediction_data['points_difference'] = prediction_data['home_points'] - \
-        prediction_data['away_points']
+    # Predictions are yielded one game at a time so they can be written out
+    # as soon as they are ready.
+    conferences = get_source().team_conference()
+
+    with span('predictions.build_matches'):
+        prediction_data = pd.concat(prediction_stats)
+        prediction_data = differential_vector(prediction_data)
+        prediction_data['points_difference'] = \
+            prediction_data['home_points'] - prediction_data['away_points']
     prediction_data = predictor.simplify(prediction_data)
     predictions = predictor.predict(prediction_data, int)
     for sim in range(len(games_list) / NUM_SIMS):
@@ -261,17 +265,16 @@ def make_predictions(prediction_stats, games_list, match_info, predictor):
         p = create_prediction_data(match_info[sim*NUM_SIMS], conferences,
                                    winner, loser, winner_prob, loser_prob,
                                    winner_points, loser_points)
-        prediction_list.append(p)
-    return prediction_list
+        yield p
 
 
-def find_stdev_for_every_stat(teams):
+def find_stdev_for_every_stat(teams, columns=None):
     stats_list = []
     stdev_dict = {}
 
     for team in teams:
         filename = 'team-stats/%s' % team.abbreviation.lower()
-        stats_list.append(get_stats(filename, None))
+        stats_list.append(get_stats(filename, None, columns=columns))
     stats_dataframe = pd.concat(stats_list)
     for col in stats_dataframe:
         if col in FIELDS_TO_DROP:
@@ -285,30 +288,35 @@ def parse_boxscores(predictor, teams, skip_save_to_mongodb):
     match_info = []
     prediction_stats = []
 
-    stdev_dict = find_stdev_for_every_stat(teams)
-    today = datetime.today()
-    today_string = '%s-%s-%s' % (today.month, today.day, today.year)
-    for game in Boxscores(today).games[today_string]:
+    # Only the team stats which the model's features are built from are used.
+    columns = team_stat_columns(predictor.features)
+    stdev_dict = find_stdev_for_every_stat(teams, columns)
+    source = get_source()
+    with span('boxscores.fetch'):
+        games = source.boxscores(source.today())
+    for game in games:
         # Skip the games that are not between two DI teams since stats are not
         # saved for those teams.
         if game['non_di']:
             continue
+        count('games_predicted')
+        home = Team(game['home_name'], game['home_abbr'])
+        away = Team(game['away_name'], game['away_abbr'])
+        title = '%s at %s' % (away.name, home.name)
+        # The stats of every simulation of a game are built at once, one row
+        # per simulation.
+        match_stats = get_match_stats(game, stdev_dict, columns, NUM_SIMS)
+        prediction_stats.append(match_stats)
+        home_name = game['home_name']
+        away_name = game['away_name']
+        if game['home_rank']:
+            home_name = '(%s) %s' % (game['home_rank'], home_name)
+        if game['away_rank']:
+            away_name = '(%s) %s' % (game['away_rank'], away_name)
+        g = MatchInfo(away_name, home_name, game['away_abbr'],
+                      game['home_abbr'], game['top_25'], None, match_stats)
         for sim in range(NUM_SIMS):
-            home = Team(game['home_name'], game['home_abbr'])
-            away = Team(game['away_name'], game['away_abbr'])
-            title = '%s at %s' % (away.name, home.name)
-            game_info = GameInfo(home, away, title)
-            games_list.append(game_info)
-            match_stats = get_match_stats(game, stdev_dict)
-            prediction_stats.append(match_stats)
-            home_name = game['home_name']
-            away_name = game['away_name']
-            if game['home_rank']:
-                home_name = '(%s) %s' % (game['home_rank'], home_name)
-            if game['away_rank']:
-                away_name = '(%s) %s' % (game['away_rank'], away_name)
-            g = MatchInfo(away_name, home_name, game['away_abbr'],
-                          game['home_abbr'], game['top_25'], None, match_stats)
+            games_list.append(GameInfo(home, away, title))
             match_info.append(g)
     predictions = make_predictions(prediction_stats, games_list, match_info,
                                    predictor)
@@ -323,16 +331,32 @@ def arguments():
     default='matches')
     parser.add_argument('--skip-save-to-mongodb', help='Optionally skip saving'
     ' results to a MongoDB database.', action='store_true')
+    parser.add_argument('--model', help='Optionally specify a saved model to '
+    'load instead of training a new one. If the file does not exist yet, the '
+    'newly trained model is saved there.', default=None)
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    data_sources.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
-def main():
+def predict_games(predictor, skip_save_to_mongodb):
     teams = []
+    for team in get_source().teams():
+        teams.append(Team(team['name'], team['abbreviation']))
+    parse_boxscores(predictor, teams, skip_save_to_mongodb)
+
+
+def main():
     args = arguments()
-    predictor = Predictor(args.dataset)
-    for team in Teams():
-        teams.append(Team(team.name, team.abbreviation))
-    parse_boxscores(predictor, teams, args.skip_save_to_mongodb)
+    instrumentation.start(args)
+    data_sources.start(args)
+    predictor = Predictor(args.dataset, model_file=args.model,
+                          jobs=args.jobs)
+    predict_games(predictor, args.skip_save_to_mongodb)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+import argparse
+import hashlib
+import instrumentation
+import json
+import numpy as np
+import os
+import pandas as pd
+from match_store import (TRAINING_CACHE_DIRECTORY,
+                         TRAINING_DATA_VERSION,
+                         build_training_data)
+from multiprocessing import Pool
+from predictor import (FOREST_PARAMETERS,
+                       MODEL_VERSION,
+                       SELECTION_THRESHOLD,
+                       Predictor)
+
+
+BACKTEST_DIRECTORY = '.cache/backtest'
+CALIBRATION_BINS = 10
+MIN_TRAINING_GAMES = 500
+RANDOM_STATE = 0
+
+# The training data is handed to every worker once when the pool starts.
+# Forked workers share its pages with the parent instead of each receiving
+# a copy for every fold.
+_data = None
+_dates = None
+
+
+def game_dates(data):
+    # Every boxscore_index starts with the date the game was played on.
+    return np.array([index[:10] for index in data.index])
+
+
+def fold_digests(data, days):
+    # Identifies the exact rows each day's fold trains and tests on, so a
+    # game whose stats were corrected after the fact reruns the folds which
+    # include it.
+    dates = game_dates(data)
+    rows = pd.util.hash_pandas_object(data).values
+    return dict((day, hashlib.sha1(rows[dates <= day].tostring()).hexdigest())
+                for day in days)
+
+
+def _share(data):
+    global _data, _dates
+    _data = data
+    _dates = game_dates(data)
+
+
+def backtest_day(day):
+    history = _dates < day
+    games = _dates == day
+    predictor = Predictor(data=_data[history | games],
+                          test_games=_data.index[games], compact=True,
+                          jobs=1, random_state=RANDOM_STATE)
+    X_test = predictor.test_data
+    actual = _data[games][['home_points', 'away_points']].values
+    predicted = predictor.predict(X_test, float)
+    home_probability = predictor.predict_probability(X_test)[:, 0]
+    actual_margin = actual[:, 0] - actual[:, 1]
+    predicted_margin = predicted[:, 0] - predicted[:, 1]
+    home_won = actual_margin >= 0
+    # Calibration is kept as sums per probability bin so days can be added
+    # together afterwards.
+    bins = np.minimum((home_probability * CALIBRATION_BINS).astype(int),
+                      CALIBRATION_BINS - 1)
+    calibration = [[int((bins == i).sum()),
+                    float(home_probability[bins == i].sum()),
+                    int(home_won[bins == i].sum())]
+                   for i in range(CALIBRATION_BINS)]
+    return {'date': day,
+            'history': int(history.sum()),
+            'games': int(games.sum()),
+            'correct': int(((predicted_margin >= 0) == home_won).sum()),
+            'margin_error': float(np.abs(predicted_margin -
+                                         actual_margin).sum()),
+            'calibration': calibration}
+
+
+class BacktestCache:
+    def __init__(self, directory=BACKTEST_DIRECTORY, min_games=None,
+                 dataset=None):
+        # Results only stay valid for the same model and training data, so
+        # each configuration and dataset is kept in its own directory.
+        if dataset:
+            dataset = os.path.abspath(dataset)
+        config = json.dumps({'model': MODEL_VERSION,
+                             'dataset': dataset,
+                             'parameters': FOREST_PARAMETERS,
+                             'threshold': SELECTION_THRESHOLD,
+                             'training_data': TRAINING_DATA_VERSION,
+                             'min_games': min_games,
+                             'random_state': RANDOM_STATE}, sort_keys=True)
+        key = hashlib.sha1(config).hexdigest()[:12]
+        self.directory = os.path.join(directory, key)
+
+    def _filename(self, day):
+        return os.path.join(self.directory, '%s.json' % day)
+
+    def lookup(self, day, digest):
+        try:
+            with open(self._filename(day)) as result_file:
+                result = json.load(result_file)
+        except (IOError, OSError, ValueError):
+            return None
+        # Games which were added or changed later for this day or any
+        # earlier day change the fold, so it has to be run again.
+        if result.get('data') != digest:
+            return None
+        return result
+
+    def store(self, result):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        filename = self._filename(result['date'])
+        temporary = '%s.tmp' % filename
+        with open(temporary, 'w') as result_file:
+            json.dump(result, result_file)
+        os.rename(temporary, filename)
+
+
+def find_days(dates, min_games=MIN_TRAINING_GAMES, start=None, end=None):
+    days = []
+    for day in sorted(set(dates)):
+        if (dates < day).sum() < min_games:
+            continue
+        if (start and day < start) or (end and day > end):
+            continue
+        days.append(day)
+    return days
+
+
+def run_backtest(data, days, cache, processes=None):
+    digests = fold_digests(data, days)
+    results = {}
+    missing = []
+    for day in days:
+        result = cache.lookup(day, digests[day])
+        if result:
+            results[day] = result
+        else:
+            missing.append(day)
+    if not missing:
+        return [results[day] for day in days]
+    pool = None
+    if processes == 1:
+        _share(data)
+        new_results = (backtest_day(day) for day in missing)
+    else:
+        pool = Pool(processes, initializer=_share, initargs=(data,))
+        new_results = pool.imap_unordered(backtest_day, missing)
+    # Every fold is saved as soon as it finishes so an interrupted run picks
+    # up where it left off. The workers are stopped even if a fold fails or
+    # the run is interrupted.
+    try:
+        for result in new_results:
+            result['data'] = digests[result['date']]
+            cache.store(result)
+            results[result['date']] = result
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return [results[day] for day in days]
+
+
+def summarize(results):
+    games = sum(result['games'] for result in results)
+    correct = sum(result['correct'] for result in results)
+    margin_error = sum(result['margin_error'] for result in results)
+    calibration = np.sum([result['calibration'] for result in results],
+                         axis=0)
+    return {'days': len(results),
+            'games': games,
+            'accuracy': round(100.0 * correct / max(games, 1), 2),
+            'margin_mae': round(margin_error / max(games, 1), 3),
+            'calibration': calibration.tolist()}
+
+
+def print_days(results):
+    print '%10s %6s %9s %11s' % ('date', 'games', 'accuracy', 'margin mae')
+    for result in results:
+        print '%10s %6s %8.2f%% %11.3f' % (
+            result['date'], result['games'],
+            100.0 * result['correct'] / result['games'],
+            result['margin_error'] / result['games'])
+
+
+def print_summary(summary):
+    print '=' * 80
+    print '  Days: %s, games: %s' % (summary['days'], summary['games'])
+    print '  Accuracy: %s%%' % summary['accuracy']
+    print '  Margin MAE: %s points' % summary['margin_mae']
+    print '=' * 80
+    print '%13s %6s %12s %12s' % ('home win prob', 'games', 'predicted',
+                                  'actual')
+    for i, (games, probability, wins) in enumerate(summary['calibration']):
+        if not games:
+            continue
+        low = float(i) / CALIBRATION_BINS
+        print '%6.1f - %4.1f %6d %11.1f%% %11.1f%%' % (
+            low, low + 1.0 / CALIBRATION_BINS, games,
+            100.0 * probability / games, 100.0 * wins / games)
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', help='Specify which dataset to use. For '
+    'testing purposes, use the "sample-data" directory. For production '
+    'deployments, use "matches" with current data that was pulled.',
+    default='matches')
+    parser.add_argument('--cache-directory', help='Specify where the '
+    'processed training data is cached. Default is %s.' %
+    TRAINING_CACHE_DIRECTORY, default=TRAINING_CACHE_DIRECTORY)
+    parser.add_argument('--backtest-directory', help='Specify where the '
+    'results of every day are cached. Default is %s.' % BACKTEST_DIRECTORY,
+    default=BACKTEST_DIRECTORY)
+    parser.add_argument('--processes', '-p', help='Optionally specify the '
+    'number of processes to run days in. Defaults to every core.', type=int,
+    default=None)
+    parser.add_argument('--min-games', help='Specify how many earlier games a '
+    'day needs before it is tested. Default is %s.' % MIN_TRAINING_GAMES,
+    type=int, default=MIN_TRAINING_GAMES)
+    parser.add_argument('--start', help='Optionally specify the first day to '
+    'test as YYYY-MM-DD.', default=None)
+    parser.add_argument('--end', help='Optionally specify the last day to '
+    'test as YYYY-MM-DD.', default=None)
+    parser.add_argument('--days', help='Optionally print the results of every '
+    'day.', action='store_true')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    instrumentation.start(args)
+    data = build_training_data(args.dataset, args.cache_directory).sort_index()
+    days = find_days(game_dates(data), args.min_games, args.start, args.end)
+    cache = BacktestCache(args.backtest_directory, args.min_games,
+                          args.dataset)
+    results = run_backtest(data, days, cache, args.processes)
+    if args.days:
+        print_days(results)
+    print_summary(summarize(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import numpy as np
+import time
+from forest_inference import FlatForest, njit
+from predictor import Predictor
+
+
+BATCH_SIZES = [50, 200, 1000, 10000, 100000]
+ROWS_PER_SIZE = 100000
+
+
+def simulation_batch(test_data, size, random_state):
+    # Resample held-out games and jitter them the same way the simulations
+    # add variance to team stats.
+    rows = test_data[random_state.randint(0, len(test_data), size)]
+    noise = random_state.uniform(-1, 1, rows.shape) * test_data.std(axis=0)
+    return (rows + noise).astype(np.float32)
+
+
+def time_calls(predict, batches):
+    start = time.time()
+    for batch in batches:
+        predict(batch)
+    return time.time() - start
+
+
+def benchmark(predictor, threads):
+    model = predictor.forest
+    flat_forest = FlatForest(model)
+    test_data = np.asarray(predictor.test_data, dtype=np.float32)
+    random_state = np.random.RandomState(0)
+    engine = 'compiled' if njit else 'numpy'
+    print 'Engine: %s, threads: %s' % (engine, threads)
+    print '%10s %8s %12s %12s %9s %12s' % ('batch', 'calls', 'sklearn (s)',
+                                           'flat (s)', 'speedup',
+                                           'max error')
+    # Compile the traversal once up front so it isn't counted.
+    flat_forest.predict(test_data[:2], threads)
+    for size in BATCH_SIZES:
+        calls = max(1, ROWS_PER_SIZE // size)
+        batches = [simulation_batch(test_data, size, random_state)
+                   for i in range(min(calls, 20))]
+        batches = (batches * (calls // len(batches) + 1))[:calls]
+        sklearn_time = time_calls(model.predict, batches)
+        flat_time = time_calls(lambda batch: flat_forest.predict(batch,
+                                                                 threads),
+                               batches)
+        error = max(np.abs(model.predict(batch) -
+                           flat_forest.predict(batch, threads)).max()
+                    for batch in batches[:5])
+        print '%10s %8s %12.4f %12.4f %8.2fx %12.2e' % (
+            size, calls, sklearn_time, flat_time, sklearn_time / flat_time,
+            error)
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', help='Specify which dataset to use. For '
+    'testing purposes, use the "sample-data" directory. For production '
+    'deployments, use "matches" with current data that was pulled.',
+    default='sample-data')
+    parser.add_argument('--model', help='Optionally specify a saved model to '
+    'load instead of training a new one. If the file does not exist yet, the '
+    'newly trained model is saved there.', default=None)
+    parser.add_argument('--threads', help='Specify the number of threads to '
+    'evaluate the flattened forest with.', type=int, default=1)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    predictor = Predictor(args.dataset, model_file=args.model, compact=True)
+    benchmark(predictor, args.threads)
+
+
+if __name__ == '__main__':
+    main()
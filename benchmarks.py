@@ -0,0 +1,319 @@
+import argparse
+import bracket_builder
+import copy
+import json
+import monte_carlo_simulation
+import numpy as np
+import os
+import pandas as pd
+import platform
+import random
+import shutil
+import sklearn
+import subprocess
+import sys
+import tempfile
+import time
+from common import differential_vector, filter_stats, team_stat_columns
+from conference_tournaments import BRACKETS
+from contextlib import contextmanager
+from data_sources import derive_team_stats
+from match_store import build_training_data, read_matches
+from predictor import Predictor
+from team_stats import TeamStatsStore
+
+
+BASELINE_FILE = 'benchmarks/baseline.json'
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+STARTUP_SCRIPTS = ['analyze-games.py', 'bracket_builder.py', 'matchups.py',
+                   'monte_carlo_simulation.py', 'prediction_server.py',
+                   'run-monte-carlo.py', 'update-model.py']
+BATCH_SIZES = [1, 50, 1000, 10000]
+NUM_SIMS = [10, 100]
+CONFERENCE_SIZE = 12
+BRACKET = 'America East Conference'
+REPEATS = 3
+REGRESSION_THRESHOLD = 0.2
+RANDOM_STATE = 0
+
+
+@contextmanager
+def quiet():
+    # The simulations print their standings after every iteration.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def seed():
+    random.seed(RANDOM_STATE)
+    np.random.seed(RANDOM_STATE)
+
+
+def time_call(function, repeats=REPEATS):
+    # Report the fastest of a few runs, which is the least noisy estimate.
+    times = []
+    for i in range(repeats):
+        seed()
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return {'seconds': round(min(times), 5),
+            'median': round(sorted(times)[len(times) // 2], 5),
+            'repeats': repeats}
+
+
+def benchmark_load(dataset, repeats):
+    results = {}
+    results['load.read_matches'] = time_call(lambda: read_matches(dataset),
+                                             repeats)
+    results['load.training_data'] = time_call(
+        lambda: build_training_data(dataset, None), repeats)
+    cache_directory = tempfile.mkdtemp()
+    try:
+        build_training_data(dataset, cache_directory)
+        results['load.training_data_cached'] = time_call(
+            lambda: build_training_data(dataset, cache_directory), repeats)
+    finally:
+        shutil.rmtree(cache_directory)
+    return results
+
+
+def benchmark_differential_vector(matches, repeats):
+    stats = filter_stats(matches.copy()).dropna()
+    return {'differential_vector': time_call(
+        lambda: differential_vector(stats.copy()), repeats)}
+
+
+def benchmark_training(data, repeats):
+    return {'training': time_call(
+        lambda: Predictor(data=data, jobs=1, random_state=RANDOM_STATE)
+        .forest, repeats)}
+
+
+def benchmark_predict(predictor, data, repeats):
+    results = {}
+    features = data.drop(['home_points', 'away_points'], axis=1)
+    random_state = np.random.RandomState(RANDOM_STATE)
+    for size in BATCH_SIZES:
+        batch = features.iloc[random_state.randint(0, len(features), size)]
+        calls = max(1, 1000 // size)
+
+        def predict():
+            for i in range(calls):
+                predictor.predict(predictor.simplify(batch), int)
+        result = time_call(predict, repeats)
+        result['calls'] = calls
+        results['predict.batch_%s' % size] = result
+    return results
+
+
+def benchmark_monte_carlo(predictor, compact_predictor, teams, repeats):
+    conference = {'name': 'Benchmark Conference',
+                  'teams': dict((team, team) for team in
+                                teams[:CONFERENCE_SIZE])}
+    schedule = [[home, away] for home in sorted(conference['teams'])
+                for away in sorted(conference['teams']) if home != away]
+    conference_wins = dict((team, 0) for team in conference['teams'])
+    results = {}
+    for name, model in [('monte_carlo', predictor),
+                        ('monte_carlo_compact', compact_predictor)]:
+        columns = team_stat_columns(model.features)
+        stats_dict, stdev_dict = \
+            monte_carlo_simulation.create_stats_dictionary(conference,
+                                                           columns)
+        for num_sims in NUM_SIMS:
+            def simulate():
+                with quiet():
+                    monte_carlo_simulation.predict_all_simulations(
+                        model, stats_dict, stdev_dict, conference, num_sims,
+                        schedule, conference_wins)
+            results['%s.sims_%s' % (name, num_sims)] = time_call(simulate,
+                                                                 repeats)
+    return results
+
+
+def benchmark_bracket(predictor, teams, repeats):
+    seeds = teams[:8]
+
+    def simulate():
+        bracket_builder.simulate_tournament(seeds,
+                                            copy.deepcopy(BRACKETS[BRACKET]),
+                                            predictor)
+    return {'bracket': time_call(simulate, repeats)}
+
+
+def benchmark_rankings(predictor, teams, repeats):
+    # Score every pairing of the sample teams and order them by their
+    # expected wins, which is what the power rankings are built from.
+    store = TeamStatsStore('team-stats', predictor.features)
+    pairs = [(home, away) for home in teams for away in teams
+             if home != away and home in store and away in store]
+
+    def rank():
+        expected_wins = dict((team, 0.0) for team in teams)
+        for i in range(0, len(pairs), 10000):
+            chunk = pairs[i:i+10000]
+            match_stats = predictor.simplify(store.matchup_frame(chunk))
+            probabilities = predictor.predict_probability(match_stats)
+            for (home, away), (home_win, away_win) in zip(chunk,
+                                                          probabilities):
+                expected_wins[home] += home_win
+                expected_wins[away] += away_win
+        return sorted(expected_wins, key=expected_wins.get, reverse=True)
+    result = time_call(rank, repeats)
+    result['matchups'] = len(pairs)
+    return {'rankings': result}
+
+
+def run_python(arguments):
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [REPOSITORY] + [path for path in [environment.get('PYTHONPATH')]
+                        if path])
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable] + arguments, env=environment,
+                              stdout=devnull)
+
+
+def benchmark_startup(predictor, repeats):
+    # Every run starts a fresh interpreter, so this includes every import a
+    # script makes before it can do anything.
+    results = {}
+    for script in STARTUP_SCRIPTS:
+        name = 'startup.%s' % os.path.splitext(script)[0]
+        results[name] = time_call(lambda: run_python(
+            [os.path.join(REPOSITORY, script), '--help']), repeats)
+    # A run which finds a saved model only has to load it.
+    model_file = os.path.abspath('benchmark-model.plk')
+    predictor.save(model_file)
+    results['startup.load_model'] = time_call(lambda: run_python(
+        ['-c', 'from predictor import Predictor; '
+         'Predictor(model_file=%r)' % model_file]), repeats)
+    return results
+
+
+def run_suite(dataset, repeats=REPEATS, only=None):
+    dataset = os.path.abspath(dataset)
+    results = {}
+    working_directory = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        # The simulations read team-stats/ from the working directory, so
+        # the suite runs from a scratch directory holding the generated
+        # stats.
+        os.chdir(directory)
+        matches = read_matches(dataset)
+        teams = derive_team_stats(matches, dataset, 'team-stats')
+        data = build_training_data(dataset, None)
+        predictor = Predictor(data=data, jobs=1, random_state=RANDOM_STATE)
+        compact_predictor = Predictor(data=data, jobs=1, compact=True,
+                                      random_state=RANDOM_STATE)
+        benchmarks = [
+            ('load', lambda: benchmark_load(dataset, repeats)),
+            ('differential_vector',
+             lambda: benchmark_differential_vector(matches, repeats)),
+            ('training', lambda: benchmark_training(data, repeats)),
+            ('predict', lambda: benchmark_predict(predictor, data, repeats)),
+            ('monte_carlo', lambda: benchmark_monte_carlo(predictor,
+                                                          compact_predictor,
+                                                          teams, repeats)),
+            ('bracket', lambda: benchmark_bracket(predictor, teams,
+                                                  repeats)),
+            ('rankings', lambda: benchmark_rankings(predictor, teams,
+                                                    repeats)),
+            ('startup', lambda: benchmark_startup(predictor, repeats))]
+        for name, benchmark in benchmarks:
+            if only and name not in only:
+                continue
+            results.update(benchmark())
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory)
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sklearn': sklearn.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor()}
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    regressions = []
+    print '%-32s %12s %12s %9s' % ('benchmark', 'baseline (s)', 'current (s)',
+                                   'change')
+    for name in sorted(results):
+        current = results[name]['seconds']
+        if name not in baseline:
+            print '%-32s %12s %12.5f %9s' % (name, '-', current, 'new')
+            continue
+        previous = baseline[name]['seconds']
+        change = (current - previous) / previous if previous else 0.0
+        flag = ''
+        if change > threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print '%-32s %12.5f %12.5f %+8.1f%%%s' % (name, previous, current,
+                                                  change * 100.0, flag)
+    return regressions
+
+
+def print_results(results):
+    print '%-32s %12s %12s' % ('benchmark', 'best (s)', 'median (s)')
+    for name in sorted(results):
+        print '%-32s %12.5f %12.5f' % (name, results[name]['seconds'],
+                                       results[name]['median'])
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', help='Specify which dataset to benchmark '
+    'with. Default is the checked-in "sample-data" directory.',
+    default='sample-data')
+    parser.add_argument('--repeats', help='Specify how many times to run '
+    'every benchmark. Default is %s.' % REPEATS, type=int, default=REPEATS)
+    parser.add_argument('--only', help='Optionally only run the given groups '
+    'of benchmarks, such as "predict" or "monte_carlo".', nargs='+',
+    default=None)
+    parser.add_argument('--save', help='Optionally save the results as the '
+    'baseline to the given file, such as %s.' % BASELINE_FILE, default=None)
+    parser.add_argument('--compare', help='Optionally compare the results '
+    'against a saved baseline and exit with an error on any regression.',
+    default=None)
+    parser.add_argument('--threshold', help='Specify the slowdown relative to'
+    ' the baseline which counts as a regression. Default is %s.' %
+    REGRESSION_THRESHOLD, type=float, default=REGRESSION_THRESHOLD)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    results = run_suite(args.dataset, args.repeats, args.only)
+    print_results(results)
+    if args.save:
+        directory = os.path.dirname(args.save)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'environment': environment(), 'results': results},
+                      baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print '%s benchmarks regressed by more than %s%%' % (
+                len(regressions), args.threshold * 100)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
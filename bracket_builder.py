@@ -1,11 +1,14 @@
 import argparse
-import json
+import instrumentation
 import pandas as pd
 from common import (differential_vector,
                     extract_stats_components,
                     read_team_stats_file)
-from conference_tournaments import BRACKETS
-from predictor import Predictor
+from copy import deepcopy
+from predictor import JOBS_VARIABLE, Predictor
+from save_json import SIMULATION_FILE, read_records
+from simulation_histograms import HistogramReader
+from team_stats import TeamStatsStore
 
 
 def get_team_from_seed(seed, seeds):
@@ -23,7 +26,9 @@ def include_teams(game, games_list, seeds):
 
 
 def get_team_stats(team):
-    team = read_team_stats_file('team-stats/%s' % team)
+    # The stats are indexed by the team's abbreviation, which would keep the
+    # two teams of a match on separate rows when they are combined.
+    team = read_team_stats_file('team-stats/%s' % team).reset_index(drop=True)
     away_stats = extract_stats_components(team, away=True)
     home_stats = extract_stats_components(team, away=False)
     return home_stats, away_stats
@@ -52,51 +57,79 @@ def determine_winner(predictions, teams):
         return teams[0]
 
 
-def simulate_tournament(seeds, games_list, predictor):
+def simulate_tournament(seeds, games_list, predictor, team_stats=None):
+    # A TeamStatsStore builds both games of a matchup from stats which were
+    # read and split once, instead of reading every team's file per game.
     fields_to_rename = {'win_loss_pct': 'win_pct'}
     winner = None
 
     for game_name, game_data in sorted(games_list.iteritems()):
         game_data = include_teams(game_data, games_list, seeds)
-        match_stats = get_match_stats(game_data['top_team'],
-                                      game_data['bottom_team'])
-        match_stats = differential_vector(match_stats)
-        match_stats.rename(columns=fields_to_rename, inplace=True)
+        top_team = game_data['top_team']
+        bottom_team = game_data['bottom_team']
+        if team_stats is not None:
+            match_stats = team_stats.matchup_frame([(top_team, bottom_team),
+                                                    (bottom_team, top_team)])
+        else:
+            match_stats = get_match_stats(top_team, bottom_team)
+            match_stats = differential_vector(match_stats)
+            match_stats['points_difference'] = match_stats['home_points'] - \
+                match_stats['away_points']
+            match_stats.rename(columns=fields_to_rename, inplace=True)
         match_stats_simplified = predictor.simplify(match_stats)
         predictions = predictor.predict(match_stats_simplified, int)
-        winner = determine_winner(predictions, [game_data['top_team'],
-                                                game_data['bottom_team']])
+        winner = determine_winner(predictions, [top_team, bottom_team])
         game_data['winner'] = winner
     # This winner is the last winner of the last game, AKA the champion
     return winner
 
 
-def get_teams_dict(simulation, conference):
-    for conf in simulation['simulation']['conferences']:
-        key = conf.keys()[0]
-        if key == conference:
-            return conf[key]
-
-
 def build_projected_points(teams_dict):
     conf_points = {}
 
     for team in teams_dict:
-        name = str(team['nickname'])
-        points = team['points']
+        name = str(team['abbreviation'])
+        points = team['projectedWins']
         conf_points[name] = points
     return conf_points
 
 
-def find_projected_seeds(simulation, conference):
-    teams_dict = get_teams_dict(simulation, conference)
-    conf_points = build_projected_points(teams_dict)
+def find_projected_seeds(simulation):
+    conf_points = build_projected_points(simulation['teams'])
     return sorted(conf_points, key=conf_points.get, reverse=True)
 
 
-def load_simulation():
-    with open('simulations/simulation.json') as json_data:
-        return json.load(json_data)
+def load_simulation(conference, filename=SIMULATION_FILE):
+    if filename.endswith('.hist'):
+        # Only the requested conference's histogram is read from the
+        # memory-mapped file.
+        reader = HistogramReader(filename)
+        return reader.simulation(reader.find(conference))
+    # Only read as far as the requested conference, which also works while
+    # the simulations are still being written.
+    for simulation in read_records(filename):
+        if conference in [simulation['conferenceName'],
+                          simulation['conferenceAbbreviation']]:
+            return simulation
+    raise ValueError('No simulation found for %s in %s' % (conference,
+                                                           filename))
+
+
+def simulate_brackets(predictor, filename=SIMULATION_FILE, team_stats=None):
+    # Find the champion of every conference tournament which was simulated.
+    from conference_tournaments import BRACKETS
+    if team_stats is None:
+        team_stats = TeamStatsStore('team-stats', predictor.features)
+    champions = {}
+    for conference, bracket in sorted(BRACKETS.items()):
+        try:
+            simulation = load_simulation(conference, filename)
+        except ValueError:
+            continue
+        seeds = find_projected_seeds(simulation)
+        champions[conference] = simulate_tournament(seeds, deepcopy(bracket),
+                                                    predictor, team_stats)
+    return champions
 
 
 def parse_arguments():
@@ -105,14 +138,34 @@ def parse_arguments():
     'conference to analyze the power rankings for. For example, specify "Big '
     'Ten Conference" to get power rankings only comprising the Big Ten teams.',
     default=None)
+    parser.add_argument('--model', help='Optionally specify a saved model to '
+    'load instead of training a new one. If the file does not exist yet, the '
+    'newly trained model is saved there.', default=None)
+    parser.add_argument('--surrogate', help='Optionally predict games with a '
+    'distilled linear surrogate of the forest instead of the full forest.',
+    action='store_true')
+    parser.add_argument('--simulation', help='Specify the conference '
+    'simulations to seed the bracket from, either the JSON output or a .hist '
+    'file. Default is %s.' % SIMULATION_FILE, default=SIMULATION_FILE)
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
-    predictor = Predictor()
-    simulation = load_simulation()
-    seeds = find_projected_seeds(simulation, args.conference)
+    instrumentation.start(args)
+    predictor = Predictor(model_file=args.model, jobs=args.jobs)
+    if args.surrogate:
+        predictor = predictor.surrogate()
+        predictor.fidelity
+    simulation = load_simulation(args.conference, args.simulation)
+    seeds = find_projected_seeds(simulation)
+    # The brackets of every conference are only loaded once one is run.
+    from conference_tournaments import BRACKETS
     winner = simulate_tournament(seeds, BRACKETS[args.conference], predictor)
     print winner
 
@@ -1,8 +1,12 @@
+import argparse
+import instrumentation
 import json
 import re
 import requests
-from bs4 import BeautifulSoup
+import sys
+from common import make_request
 from datetime import datetime, timedelta
+from response_cache import CACHE_DIRECTORY, ResponseCache, ttl_for_date
 
 
 SCORES_PAGE = 'http://www.sports-reference.com/cbb/boxscores/index.cgi?month='
@@ -45,9 +49,16 @@ def parse_boxscores(boxscore_html):
     return results
 
 
-def find_yesterdays_games():
+def find_yesterdays_games(cache):
+    from bs4 import BeautifulSoup
     url = retrieve_yesterdays_url()
-    boxscores = requests.get(url)
+    yesterday = datetime.now() - timedelta(days=1)
+    boxscores = make_request(requests.Session(), url, cache,
+                             ttl_for_date(yesterday))
+    # No page is returned when it isn't cached in offline mode or the
+    # request kept failing.
+    if not boxscores:
+        return None
     boxscore_html = BeautifulSoup(boxscores.text, 'lxml')
     results = parse_boxscores(boxscore_html)
     return results
@@ -96,8 +107,26 @@ def check_saved_predictions(results):
     print '='*80
 
 
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-directory', help='Specify the directory to '
+                        'cache downloaded pages in.', default=CACHE_DIRECTORY)
+    parser.add_argument('--offline', help='Optionally only replay pages which '
+                        'were previously saved to the cache without touching '
+                        'the network.', action='store_true')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
 def main():
-    results = find_yesterdays_games()
+    args = arguments()
+    instrumentation.start(args)
+    cache = ResponseCache(args.cache_directory, args.offline)
+    results = find_yesterdays_games(cache)
+    if results is None:
+        print 'Unable to retrieve yesterday\'s scores from %s' % \
+            retrieve_yesterdays_url()
+        sys.exit(1)
     check_saved_predictions(results)
 
 
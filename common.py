@@ -1,8 +1,10 @@
 import difflib
 import numpy
+import os
 import pandas as pd
 import re
-import requests
+from instrumentation import count, span, timed
+from multiprocessing import Pool
 
 
 FIELDS_TO_COMBINE = {
@@ -47,20 +49,155 @@ FIELDS_TO_COMBINE = {
 }
 
 
+# Long-running processes, such as pipeline.py, keep the team stats they have
+# read in memory so every stage shares them instead of reading them again.
+_team_stats = None
+
+
+def share_team_stats():
+    global _team_stats
+    if _team_stats is None:
+        _team_stats = {}
+
+
 def read_team_stats_file(team_filename):
     team_filename = re.sub('\(\d+\) +', '', team_filename)
-    return pd.read_pickle('%s.plk' % team_filename)
+    filename = '%s.plk' % team_filename
+    if _team_stats is None:
+        return pd.read_pickle(filename)
+    # Stats which were pulled again since they were read are reloaded.
+    key = (filename, os.path.getmtime(filename))
+    if key not in _team_stats:
+        _team_stats[key] = pd.read_pickle(filename)
+    # Callers are free to modify the stats they are given.
+    return _team_stats[key].copy()
 
 
-def make_request(session, url):
-    # Try a URL 3 times. If it still doesn't work, just skip the entry.
-    for i in xrange(3):
+def read_team_stats_files(team_filenames, processes=None, columns=None):
+    filenames = ['%s.plk' % re.sub('\(\d+\) +', '', team_filename)
+                 for team_filename in team_filenames]
+    return read_pickles(filenames, processes, columns)
+
+
+def split_columns(columns, values, dtype=numpy.float64):
+    # Convert each column to floats where possible so every file with the
+    # same layout can be stacked into one numeric block. Anything else, such
+    # as names and dates, stays behind in a smaller object block. The compact
+    # path asks for float32 so the data is never held as float64.
+    numeric_columns, numeric_values = [], []
+    object_columns, object_values = [], []
+    for i, column in enumerate(columns):
+        try:
+            numeric_values.append(values[:, i].astype(dtype))
+            numeric_columns.append(column)
+        except (TypeError, ValueError):
+            object_values.append(values[:, i])
+            object_columns.append(column)
+    numeric_values = numpy.array(numeric_values, dtype=dtype) \
+        .reshape(len(numeric_columns), len(values)).T
+    object_values = numpy.array(object_values, dtype=object) \
+        .reshape(len(object_columns), len(values)).T
+    return numeric_columns, numeric_values, object_columns, object_values
+
+
+def decode_pickles(filenames, columns=None, dtype=numpy.float64):
+    layouts = {}
+    for filename in filenames:
+        frame = pd.read_pickle(filename)
+        if columns is not None:
+            frame = frame[[col for col in frame.columns if col in columns]]
+        index, rows = layouts.setdefault(tuple(frame.columns), ([], []))
+        index.extend(frame.index)
+        rows.append(frame.values)
+    blocks = []
+    for columns, (index, rows) in layouts.items():
+        values = numpy.concatenate(rows)
+        blocks.append((index,) + split_columns(columns, values, dtype))
+    return blocks
+
+
+def chunk_list(items, num_chunks):
+    size = max(1, -(-len(items) // num_chunks))
+    return [items[i:i+size] for i in xrange(0, len(items), size)]
+
+
+def decode_pickles_star(arguments):
+    return decode_pickles(*arguments)
+
+
+@timed('read_pickles')
+def read_pickles(filenames, processes=None, columns=None,
+                 dtype=numpy.float64):
+    # Decoding thousands of small pickles into individual DataFrames and
+    # concatenating them is dominated by pandas overhead. Instead, decode
+    # them into NumPy blocks, optionally across a pool of processes, and
+    # only build DataFrames once per distinct column layout.
+    filenames = list(filenames)
+    count('pickle_files', len(filenames))
+    if columns is not None:
+        columns = set(columns)
+    if processes and processes > 1 and len(filenames) > processes:
+        pool = Pool(processes)
         try:
-            response = session.get(url)
+            chunks = [(chunk, columns, dtype) for chunk in
+                      chunk_list(filenames, processes * 4)]
+            blocks = sum(pool.map(decode_pickles_star, chunks), [])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        blocks = decode_pickles(filenames, columns, dtype)
+    layouts = {}
+    for index, numeric_columns, numeric, object_columns, objects in blocks:
+        key = (tuple(numeric_columns), tuple(object_columns))
+        layouts.setdefault(key, []).append((index, numeric, objects))
+    frames = []
+    columns = []
+    for (numeric_columns, object_columns), parts in layouts.items():
+        index = sum([part[0] for part in parts], [])
+        numeric = pd.DataFrame(numpy.concatenate([part[1] for part in parts]),
+                               index=index, columns=list(numeric_columns))
+        objects = pd.DataFrame(numpy.concatenate([part[2] for part in parts]),
+                               index=index, columns=list(object_columns))
+        frames.append(pd.concat([numeric, objects], axis=1))
+        columns += [col for col in frames[-1].columns if col not in columns]
+    if not frames:
+        return pd.DataFrame()
+    # Grouping by layout loses the original file order, so sort by the index
+    # to keep the result deterministic.
+    return pd.concat(frames).reindex(columns=columns).sort_index()
+
+
+def make_request(session, url, cache=None, ttl=None):
+    import requests
+    if cache:
+        response = cache.lookup(url)
+        if response or cache.offline:
+            count('cached_responses')
             return response
-        except requests.exceptions.ConnectionError:
-            continue
-    return None
+    # Try a URL 3 times. If it still doesn't work, just skip the entry.
+    count('network_requests')
+    with span('network_request'):
+        for i in xrange(3):
+            try:
+                response = session.get(url)
+                break
+            except requests.exceptions.ConnectionError:
+                continue
+        else:
+            return None
+    if cache:
+        cache.store(url, response, ttl)
+    return response
+
+
+def update_stats(stats):
+    if 'defensive_rating' not in stats and \
+       'offensive_rating' in stats and \
+       'net_rating' in stats:
+        stats['defensive_rating'] = stats['offensive_rating'] - \
+            stats['net_rating']
+    return stats
 
 
 def include_wins_and_losses(stats, wins, losses, away=False):
@@ -107,6 +244,33 @@ def differential_vector(stats):
     return stats
 
 
+def differential_matrix(values, columns):
+    # The array equivalent of differential_vector for compact float32
+    # feature matrices which carry their column names separately.
+    positions = dict((column, i) for i, column in enumerate(columns))
+    dropped = set()
+    features = []
+    differences = []
+    for home_feature, away_feature in FIELDS_TO_COMBINE.items():
+        if home_feature not in positions or away_feature not in positions:
+            continue
+        dropped.update([home_feature, away_feature])
+        # A field which is shared by both teams, such as the pace, carries no
+        # difference and is dropped entirely by differential_vector.
+        if home_feature == away_feature:
+            continue
+        features.append(home_feature.replace('home_', ''))
+        differences.append(values[:, positions[home_feature]] -
+                           values[:, positions[away_feature]])
+    kept = [i for i, column in enumerate(columns) if column not in dropped]
+    matrix = numpy.empty((len(values), len(kept) + len(features)),
+                         dtype=numpy.float32)
+    matrix[:, :len(kept)] = values[:, kept]
+    for i, difference in enumerate(differences):
+        matrix[:, len(kept) + i] = difference
+    return matrix, [columns[i] for i in kept] + features
+
+
 def convert_team_totals_to_averages(stats):
     fields_to_average = ['assists', 'blocks', 'defensive_rebounds',
                          'field_goal_attempts', 'field_goals',
@@ -121,15 +285,47 @@ def convert_team_totals_to_averages(stats):
     new_stats = stats.copy()
 
     for field in fields_to_average:
-        new_value = float(stats[field]) / num_games
+        # Fields may have been projected away when only a subset is needed.
+        if field not in stats:
+            continue
+        new_value = stats[field].astype(float) / num_games
         new_stats.loc[:,field] = new_value
     return new_stats
 
 
-def extract_stats_components(stats, away=False):
+def feature_sources(features):
+    # Map a model's features back to the home and away match columns which
+    # they are derived from.
+    combined = dict((home.replace('home_', ''), (home, away)) for home, away
+                    in FIELDS_TO_COMBINE.items())
+    columns = set()
+    for feature in features:
+        if feature == 'points_difference':
+            columns.update(['home_points', 'away_points'])
+        elif feature in combined:
+            columns.update(combined[feature])
+        else:
+            columns.add(feature)
+    return sorted(columns)
+
+
+def team_stat_columns(features):
+    # The team stats needed to build the given features, including the
+    # fields required to derive and average them.
+    columns = set(['games_played'])
+    for column in feature_sources(features):
+        columns.add(re.sub('^(home|away)_', '', column))
+    if 'defensive_rating' in columns:
+        columns.update(['offensive_rating', 'net_rating'])
+    return sorted(columns)
+
+
+def extract_stats_components(stats, away=False, columns=None):
     # Get all of the stats that don't start with 'opp', AKA all of the
     # stats that are directly related to the indicated team.
     filtered_columns = [col for col in stats if not str(col).startswith('opp')]
+    if columns is not None:
+        filtered_columns = [col for col in filtered_columns if col in columns]
     stats = stats[filtered_columns]
     stats = convert_team_totals_to_averages(stats)
     if away:
@@ -145,7 +341,6 @@ def extract_stats_components(stats, away=False):
 
 def find_name_from_nickname(nickname):
     from teams import TEAMS
-
     nickname = difflib.get_close_matches(nickname, TEAMS.values())[0]
     for key, value in TEAMS.items():
         if value == nickname:
@@ -154,7 +349,6 @@ def find_name_from_nickname(nickname):
 
 def find_nickname_from_name(name):
     from teams import TEAMS
-
     try:
         nickname = TEAMS[name]
     except KeyError:
@@ -1,4 +1,5 @@
 import argparse
+import instrumentation
 import numpy
 import pandas as pd
 import re
@@ -9,7 +10,7 @@ from common import differential_vector, find_name_from_nickname
 from constants import YEAR
 from datetime import datetime
 from math import ceil, sqrt
-from predictor import Predictor
+from predictor import JOBS_VARIABLE, Predictor
 from teams import TEAMS
 
 
@@ -165,12 +166,18 @@ def parse_arguments():
     'conference to analyze the power rankings for. For example, specify "Big '
     'Ten Conference" to get power rankings only comprising the Big Ten teams.',
     default=None)
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
-    predictor = Predictor()
+    instrumentation.start(args)
+    predictor = Predictor(jobs=args.jobs)
     teams = teams_list(args.conference)
     stats_dict, net_rankings = create_stats_dictionary(teams)
     sorted_net_rating = sort_by_net_rating(net_rankings)
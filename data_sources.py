@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import pandas as pd
+from datetime import datetime
+from glob import glob
+from match_store import boxscore_index, read_matches
+
+
+SNAPSHOT_DIRECTORY = 'sample-snapshot'
+SOURCE_VARIABLE = 'DATA_SOURCE'
+LIVE = 'live'
+# The sample data has no conference membership, so derived snapshots fill
+# the conferences with tournament brackets in order, each with as many teams
+# as its bracket has seeds. The remaining teams form one more conference.
+REMAINING_CONFERENCE = 'Sample Conference'
+
+
+class DataSource:
+    # Teams, conferences, schedules and box scores are returned as plain
+    # dictionaries and lists so every source can be recorded as JSON.
+    def today(self):
+        return datetime.today()
+
+    def team_conference(self):
+        team_conference = {}
+        for abbreviation, details in self.conferences().items():
+            for team in details['teams']:
+                team_conference[team] = abbreviation
+        return team_conference
+
+
+class LiveSource(DataSource):
+    # sportsreference is only imported once live data is requested, so the
+    # simulations can run from a snapshot without it. Everything is fetched
+    # at most once per run, since several stages of a pipeline ask for the
+    # same data.
+    def __init__(self):
+        self._fetched = {}
+
+    def _fetch(self, key, fetch):
+        if key not in self._fetched:
+            self._fetched[key] = fetch()
+        return self._fetched[key]
+
+    def teams(self):
+        from sportsreference.ncaab.teams import Teams
+        return self._fetch('teams', lambda: [
+            {'name': team.name, 'abbreviation': team.abbreviation}
+            for team in Teams()])
+
+    def conferences(self):
+        from sportsreference.ncaab.conferences import Conferences
+        return self._fetch('conferences', lambda: Conferences().conferences)
+
+    def schedule(self, team):
+        from sportsreference.ncaab.schedule import Schedule
+        return self._fetch(('schedule', team), lambda: [
+            {'opponent_abbr': game.opponent_abbr,
+             'location': game.location,
+             'points_for': game.points_for} for game in Schedule(team)])
+
+    def boxscores(self, date):
+        from sportsreference.ncaab.boxscore import Boxscores
+        date_string = '%s-%s-%s' % (date.month, date.day, date.year)
+        return self._fetch(('boxscores', date_string),
+                           lambda: Boxscores(date).games[date_string])
+
+
+class SnapshotSource(DataSource):
+    def __init__(self, directory=SNAPSHOT_DIRECTORY):
+        self.directory = directory
+        with open(os.path.join(directory, 'snapshot.json')) as snapshot_file:
+            self._snapshot = json.load(snapshot_file)
+        self._schedules = None
+
+    def today(self):
+        # The day the snapshot was recorded, which is the only day whose box
+        # scores are guaranteed to be in it.
+        return datetime.strptime(self._snapshot['date'], '%Y-%m-%d')
+
+    def teams(self):
+        return self._snapshot['teams']
+
+    def conferences(self):
+        return self._snapshot['conferences']
+
+    def schedule(self, team):
+        if self._schedules is None:
+            with open(os.path.join(self.directory, 'schedules.json')) as \
+                    schedules_file:
+                self._schedules = json.load(schedules_file)
+        return self._schedules.get(team, [])
+
+    def boxscores(self, date):
+        filename = os.path.join(self.directory, 'boxscores',
+                                '%s.json' % date.strftime('%Y-%m-%d'))
+        if not os.path.exists(filename):
+            raise ValueError('No box scores were recorded for %s in %s' %
+                             (date.strftime('%Y-%m-%d'), self.directory))
+        with open(filename) as boxscores_file:
+            return json.load(boxscores_file)
+
+
+_source = None
+
+
+def create_source(name):
+    if name == LIVE:
+        return LiveSource()
+    return SnapshotSource(name)
+
+
+def get_source():
+    # Shared by every module of a run, like mongo_store.get_client().
+    global _source
+    if _source is None:
+        _source = create_source(os.environ.get(SOURCE_VARIABLE, LIVE))
+    return _source
+
+
+def use_source(source):
+    global _source
+    _source = source
+
+
+def add_arguments(parser):
+    parser.add_argument('--source', help='Specify where teams, conferences, '
+    'schedules and box scores come from. Use "%s" for sports-reference.com or'
+    ' the directory of a recorded snapshot, such as "%s", to run offline. '
+    'Defaults to the %s environment variable, or "%s" if it is not set.' %
+    (LIVE, SNAPSHOT_DIRECTORY, SOURCE_VARIABLE, LIVE), default=None)
+
+
+def start(args):
+    if getattr(args, 'source', None):
+        use_source(create_source(args.source))
+
+
+def save_snapshot(directory, date, teams, conferences, schedules, boxscores):
+    for path in [directory, os.path.join(directory, 'boxscores')]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    with open(os.path.join(directory, 'snapshot.json'), 'w') as snapshot_file:
+        json.dump({'date': date.strftime('%Y-%m-%d'),
+                   'teams': teams,
+                   'conferences': conferences}, snapshot_file, indent=1,
+                  sort_keys=True)
+    with open(os.path.join(directory, 'schedules.json'), 'w') as \
+            schedules_file:
+        json.dump(schedules, schedules_file, sort_keys=True)
+    with open(os.path.join(directory, 'boxscores',
+                           '%s.json' % date.strftime('%Y-%m-%d')), 'w') as \
+            boxscores_file:
+        json.dump(boxscores, boxscores_file, indent=1, sort_keys=True)
+
+
+def record_snapshot(source, directory, date=None):
+    date = date or source.today()
+    teams = source.teams()
+    schedules = dict((team['abbreviation'],
+                      source.schedule(team['abbreviation'])) for team in teams)
+    save_snapshot(directory, date, teams, source.conferences(), schedules,
+                  source.boxscores(date))
+
+
+def derive_team_stats(matches, dataset, directory):
+    # Every team's stats are the averages over the games in its dataset
+    # directory, in the layout pull-stats.py saves.
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    matches = matches.apply(pd.to_numeric, errors='coerce')
+    teams = []
+    for team in sorted(os.listdir(dataset)):
+        games = [boxscore_index(match) for match in
+                 glob('%s/%s/*' % (dataset, team))]
+        games = [index for index in games if index in matches.index]
+        if not games:
+            continue
+        rows = []
+        for index in games:
+            game = matches.loc[index]
+            side, other = ('home_', 'away_') if index.endswith(team) else \
+                ('away_', 'home_')
+            row = {}
+            for col in matches.columns:
+                if col.startswith(side):
+                    row[col[len(side):]] = game[col]
+                elif col.startswith(other):
+                    row['opp_%s' % col[len(other):]] = game[col]
+            rows.append(row)
+        stats = pd.DataFrame(rows).mean().to_frame().T.fillna(0)
+        stats['games_played'] = 1.0
+        stats['conference_wins'] = 0
+        stats['abbreviation'] = team.upper()
+        stats['conference'] = 'sample'
+        stats['name'] = team
+        stats.index = [team.upper()]
+        stats.to_pickle(os.path.join(directory, '%s.plk' % team))
+        teams.append(team)
+    return teams
+
+
+def derive_boxscores(matches, day, names):
+    boxscores = []
+    for index in sorted(matches.index):
+        if not index.startswith(day):
+            continue
+        game = matches.loc[index]
+        # The index ends with the home team after the date and the hour.
+        home = index[len('YYYY-MM-DD-HH-'):]
+        if game['winner'] == 'Home':
+            away = str(game['losing_abbr']).lower()
+        else:
+            away = str(game['winning_abbr']).lower()
+        boxscores.append({'boxscore': index,
+                          'home_name': names.get(home, home),
+                          'home_abbr': home,
+                          'home_rank': None,
+                          'away_name': names.get(away, away),
+                          'away_abbr': away,
+                          'away_rank': None,
+                          'non_di': home not in names or away not in names,
+                          'top_25': False})
+    return boxscores
+
+
+def conference_sizes(num_teams):
+    from conference_tournaments import BRACKETS
+    sizes = []
+    for name, bracket in sorted(BRACKETS.items()):
+        seeds = [int(game[team]) for game in bracket.values()
+                 for team in ['top_team', 'bottom_team']
+                 if str(game[team]).isdigit()]
+        if sum(size for name, size in sizes) + max(seeds) > num_teams:
+            break
+        sizes.append((name, max(seeds)))
+    remaining = num_teams - sum(size for name, size in sizes)
+    if remaining > 1:
+        sizes.append((REMAINING_CONFERENCE, remaining))
+    return sizes
+
+
+def derive_snapshot(dataset, directory, team_stats_directory=None):
+    # Builds a snapshot from a match dataset alone. The box scores are the
+    # games of the busiest day in the dataset and every conference has a full
+    # home and away round robin left to play.
+    matches = read_matches(dataset)
+    names = {}
+    for index in matches.index:
+        game = matches.loc[index]
+        for side in ['winning', 'losing']:
+            team = str(game['%s_abbr' % side]).lower()
+            if os.path.isdir(os.path.join(dataset, team)):
+                names[team] = str(game['%s_name' % side])
+    teams = sorted(names)
+    conferences = {}
+    schedules = {}
+    start = 0
+    for number, (name, size) in enumerate(conference_sizes(len(teams))):
+        members = teams[start:start+size]
+        start += size
+        conferences['sample-%s' % (number + 1)] = {
+            'name': name,
+            'teams': dict((team, names[team]) for team in members)}
+        for team in members:
+            schedules[team] = []
+            for opponent in members:
+                if opponent == team:
+                    continue
+                for location in ['HOME', 'AWAY']:
+                    schedules[team].append({'opponent_abbr': opponent,
+                                            'location': location,
+                                            'points_for': None})
+    days = [index[:10] for index in matches.index]
+    day = max(sorted(set(days)), key=days.count)
+    save_snapshot(directory, datetime.strptime(day, '%Y-%m-%d'),
+                  [{'name': names[team], 'abbreviation': team}
+                   for team in teams],
+                  conferences, schedules,
+                  derive_boxscores(matches, day, names))
+    if team_stats_directory:
+        derive_team_stats(matches, dataset, team_stats_directory)
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', help='"record" saves the live data for a '
+    'day, which needs network access. "derive" builds a snapshot offline from'
+    ' a match dataset instead.', choices=['record', 'derive'])
+    parser.add_argument('--directory', help='Specify where the snapshot is '
+    'saved. Default is %s.' % SNAPSHOT_DIRECTORY, default=SNAPSHOT_DIRECTORY)
+    parser.add_argument('--date', help='Optionally specify the day to record '
+    'box scores for as YYYY-MM-DD. Default is today.', default=None)
+    parser.add_argument('--dataset', help='Specify the match dataset to derive'
+    ' the snapshot from. Default is "sample-data".', default='sample-data')
+    parser.add_argument('--team-stats', help='Optionally also derive the team '
+    'stats the simulations read from the dataset into the given directory, '
+    'such as "team-stats".', default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    if args.command == 'record':
+        date = None
+        if args.date:
+            date = datetime.strptime(args.date, '%Y-%m-%d')
+        record_snapshot(LiveSource(), args.directory, date)
+    else:
+        derive_snapshot(args.dataset, args.directory, args.team_stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+# Numba is optional. When it is installed, the traversal is compiled and
+# parallelized across rows, otherwise it falls back to vectorized NumPy.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = xrange
+
+
+# Rows are traversed in chunks so the per-level node and feature arrays stay
+# small enough to remain in cache.
+CHUNK_SIZE = 8192
+# Without Numba, the vectorized traversal only beats sklearn's compiled
+# per-tree predict for batches up to roughly this many rows.
+NUMPY_MAX_ROWS = 1000
+# Everything a flattened forest is evaluated from.
+ARRAYS = ['roots', 'feature', 'threshold', 'left', 'right', 'value']
+
+
+def _traverse(data, roots, feature, threshold, left, right, value, depth,
+              output):
+    for i in prange(data.shape[0]):
+        for tree in range(roots.shape[0]):
+            node = roots[tree]
+            for level in range(depth):
+                if data[i, feature[node]] <= threshold[node]:
+                    node = left[node]
+                else:
+                    node = right[node]
+            for j in range(value.shape[1]):
+                output[i, j] += value[node, j]
+
+
+if njit:
+    _traverse_serial = njit(nogil=True, cache=True)(_traverse)
+    _traverse_parallel = njit(nogil=True, cache=True,
+                              parallel=True)(_traverse)
+
+
+class FlatForest:
+    compiled = njit is not None
+
+    def __init__(self, forest=None, arrays=None):
+        # Flatten every tree in the fitted forest into one set of contiguous
+        # node arrays. Node ids are global, so the children of a node point
+        # directly at their position in the flattened arrays. A forest which
+        # was flattened before can be given as its arrays instead, such as
+        # ones memory-mapped from shared memory.
+        if arrays is not None:
+            for name in ARRAYS:
+                setattr(self, name, arrays[name])
+            self.num_trees = len(self.roots)
+            self.depth = int(arrays['depth'])
+            return
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        node_counts = [tree.node_count for tree in trees]
+        self.roots = np.cumsum([0] + node_counts[:-1]).astype(np.intp)
+        self.num_trees = len(trees)
+        self.depth = max(tree.max_depth for tree in trees)
+        self.feature = np.concatenate([tree.feature for tree in trees]) \
+            .astype(np.intp)
+        self.threshold = np.concatenate([tree.threshold for tree in trees])
+        left = []
+        right = []
+        for root, tree in zip(self.roots, trees):
+            nodes = np.arange(tree.node_count, dtype=np.intp)
+            leaves = tree.children_left == -1
+            # Leaves point back at themselves so every row can take the same
+            # number of steps regardless of where its path ends.
+            left.append(np.where(leaves, nodes, tree.children_left) + root)
+            right.append(np.where(leaves, nodes, tree.children_right) + root)
+        self.left = np.concatenate(left).astype(np.intp)
+        self.right = np.concatenate(right).astype(np.intp)
+        self.feature[self.feature < 0] = 0
+        self.value = np.ascontiguousarray(
+            np.concatenate([tree.value[:, :, 0] for tree in trees]))
+
+    def arrays(self):
+        arrays = dict((name, getattr(self, name)) for name in ARRAYS)
+        arrays['depth'] = np.array(self.depth)
+        return arrays
+
+    def _leaves(self, data):
+        # Walk every tree for every row one level at a time. Inputs are
+        # float32 and thresholds float64, exactly as sklearn compares them.
+        num_rows, num_features = data.shape
+        flat_data = data.ravel()
+        offsets = np.tile(np.arange(num_rows, dtype=np.intp) * num_features,
+                          self.num_trees)
+        nodes = np.repeat(self.roots, num_rows)
+        for level in xrange(self.depth):
+            values = flat_data.take(offsets + self.feature.take(nodes))
+            go_left = values <= self.threshold.take(nodes)
+            nodes = np.where(go_left, self.left.take(nodes),
+                             self.right.take(nodes))
+        return nodes.reshape(self.num_trees, num_rows)
+
+    def _predict_chunk(self, data):
+        return self.value.take(self._leaves(data), axis=0).mean(axis=0)
+
+    def _predict_compiled(self, data, threads):
+        output = np.zeros((len(data), self.value.shape[1]))
+        traverse = _traverse_parallel if threads > 1 else _traverse_serial
+        traverse(data, self.roots, self.feature, self.threshold, self.left,
+                 self.right, self.value, self.depth, output)
+        return output / self.num_trees
+
+    def predict_trees(self, data):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        return self.value.take(self._leaves(data), axis=0)
+
+    def predict(self, data, threads=1):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if njit:
+            return self._predict_compiled(data, threads)
+        chunks = [data[i:i+CHUNK_SIZE] for i in
+                  xrange(0, len(data), CHUNK_SIZE)]
+        if not chunks:
+            return np.zeros((0, self.value.shape[1]))
+        if threads > 1 and len(chunks) > 1:
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(self._predict_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._predict_chunk(chunk) for chunk in chunks]
+        return np.concatenate(results)
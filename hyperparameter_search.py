@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import instrumentation
+import itertools
+import json
+import math
+import numpy as np
+import os
+import time
+from match_store import (TRAINING_CACHE_DIRECTORY,
+                         TRAINING_DATA_VERSION,
+                         build_training_data)
+from multiprocessing import Pool
+from predictor import SELECTION_THRESHOLD, Predictor
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import KFold
+
+
+TUNING_DIRECTORY = '.cache/tuning'
+NUM_FOLDS = 3
+NUM_CONFIGURATIONS = 27
+REDUCTION_FACTOR = 3
+RANDOM_STATE = 0
+SEARCH_SPACE = {'n_estimators': [10, 25, 50, 100],
+                'max_depth': [4, 6, 8, 10],
+                'max_features': ['sqrt', 0.3, 0.5],
+                'min_samples_leaf': [1, 3, 5],
+                'min_samples_split': [2, 10],
+                'bootstrap': [True, False],
+                'threshold': [0.005, SELECTION_THRESHOLD, 0.02]}
+
+# The folds are handed to every worker once when the pool starts.
+_folds = None
+
+
+class Folds:
+    def __init__(self, X, y, columns, fold, importances):
+        self.X = X
+        self.y = y
+        self.columns = columns
+        self.fold = fold
+        self.importances = importances
+
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        temporary = '%s.tmp.npz' % filename
+        np.savez(temporary, X=self.X, y=self.y,
+                 columns=np.array(self.columns), fold=self.fold,
+                 importances=self.importances)
+        os.rename(temporary, filename)
+
+    @staticmethod
+    def load(filename):
+        arrays = np.load(filename)
+        return Folds(arrays['X'], arrays['y'],
+                     [str(col) for col in arrays['columns']], arrays['fold'],
+                     arrays['importances'])
+
+
+def create_folds(data, num_folds=NUM_FOLDS):
+    X = data.drop(['home_points', 'away_points'], axis=1)
+    columns = [str(col) for col in X.columns]
+    X = X.values.astype(np.float32)
+    y = data[['home_points', 'away_points']].values
+    fold = np.zeros(len(X), dtype=np.int8)
+    splits = KFold(num_folds, shuffle=True, random_state=RANDOM_STATE)
+    importances = []
+    for i, (train, test) in enumerate(splits.split(X)):
+        fold[test] = i
+        # Feature selection only depends on the fold, so the importances of
+        # the selection forest are computed once and every threshold reuses
+        # them.
+        selector = RandomForestRegressor(n_estimators=50,
+                                         max_features='sqrt',
+                                         random_state=RANDOM_STATE)
+        selector.fit(X[train], y[train])
+        importances.append(selector.feature_importances_)
+    return Folds(X, y, columns, fold, np.array(importances))
+
+
+def load_folds(data, directory=TUNING_DIRECTORY, num_folds=NUM_FOLDS):
+    # The folds are cached for exactly this set of games, so re-runs skip
+    # preprocessing and feature selection entirely.
+    key = hashlib.sha1(json.dumps({'training_data': TRAINING_DATA_VERSION,
+                                   'games': sorted(data.index),
+                                   'folds': num_folds,
+                                   'random_state': RANDOM_STATE}))
+    filename = os.path.join(directory, 'folds-%s.npz' %
+                            key.hexdigest()[:12])
+    if os.path.exists(filename):
+        return Folds.load(filename)
+    folds = create_folds(data, num_folds)
+    folds.save(filename)
+    return folds
+
+
+def sample_configurations(num_configurations, random_state):
+    names = sorted(SEARCH_SPACE)
+    grid = list(itertools.product(*[SEARCH_SPACE[name] for name in names]))
+    chosen = random_state.choice(len(grid), min(num_configurations,
+                                                len(grid)), replace=False)
+    return [dict(zip(names, grid[i])) for i in chosen]
+
+
+def _share(folds):
+    global _folds
+    _folds = folds
+
+
+def evaluate(task):
+    # Train a configuration on a fraction of a fold's training rows and score
+    # it on the held-out fold.
+    key, configuration, fold, fraction = task
+    parameters = dict(configuration)
+    support = _folds.importances[fold] >= parameters.pop('threshold')
+    train = np.flatnonzero(_folds.fold != fold)
+    test = _folds.fold == fold
+    train = np.random.RandomState(fold).permutation(train)
+    train = np.sort(train[:max(1, int(len(train) * fraction))])
+    model = RandomForestRegressor(n_jobs=1, random_state=RANDOM_STATE,
+                                  **parameters)
+    model.fit(_folds.X[train][:, support], _folds.y[train])
+    X_test = _folds.X[test][:, support]
+    start = time.time()
+    predicted = model.predict(X_test)
+    elapsed = time.time() - start
+    actual = _folds.y[test]
+    actual_margin = actual[:, 0] - actual[:, 1]
+    predicted_margin = predicted[:, 0] - predicted[:, 1]
+    return {'key': key,
+            'games': int(test.sum()),
+            'correct': int(((predicted_margin >= 0) ==
+                            (actual_margin >= 0)).sum()),
+            'margin_error': float(np.abs(predicted_margin -
+                                         actual_margin).sum()),
+            'depth': max(tree.tree_.max_depth for tree in model.estimators_),
+            'seconds': elapsed}
+
+
+def evaluate_all(pool, configurations, fraction, num_folds):
+    tasks = [(key, configurations[key], fold, fraction)
+             for key in sorted(configurations) for fold in range(num_folds)]
+    results = dict((key, {'games': 0, 'correct': 0, 'margin_error': 0.0,
+                          'depth': 0, 'seconds': 0.0})
+                   for key in configurations)
+    for result in pool.imap_unordered(evaluate, tasks):
+        total = results[result['key']]
+        for name in ['games', 'correct', 'margin_error', 'seconds']:
+            total[name] += result[name]
+        total['depth'] = max(total['depth'], result['depth'])
+    scores = {}
+    for key, total in results.items():
+        configuration = configurations[key]
+        scores[key] = {
+            'configuration': configuration,
+            'fraction': fraction,
+            'accuracy': round(100.0 * total['correct'] / total['games'], 2),
+            'margin_mae': round(total['margin_error'] / total['games'], 3),
+            'depth': total['depth'],
+            # Every prediction walks each tree once from the root to a leaf,
+            # so trees x depth bounds the cost of inference.
+            'cost': configuration['n_estimators'] * total['depth'],
+            'microseconds_per_game': round(1e6 * total['seconds'] /
+                                           total['games'], 2)}
+    return scores
+
+
+def rank(scores):
+    # Configurations which made it further are ranked first, then the higher
+    # accuracy, the lower margin error and the cheaper configuration.
+    return sorted(scores, key=lambda key: (-scores[key]['fraction'],
+                                           -scores[key]['accuracy'],
+                                           scores[key]['margin_mae'],
+                                           scores[key]['cost']))
+
+
+def successive_halving(pool, configurations, num_folds, min_fraction,
+                       reduction_factor=REDUCTION_FACTOR):
+    # Every rung trains the surviving configurations on reduction_factor
+    # times more data and keeps the best 1/reduction_factor of them.
+    fraction = min_fraction
+    history = []
+    while True:
+        scores = evaluate_all(pool, configurations, fraction, num_folds)
+        history.append(scores)
+        if fraction >= 1.0 or len(configurations) == 1:
+            return scores, history
+        survivors = rank(scores)[:max(1, len(configurations) //
+                                      reduction_factor)]
+        configurations = dict((key, configurations[key])
+                              for key in survivors)
+        fraction = min(1.0, fraction * reduction_factor)
+
+
+def hyperband(pool, num_configurations, num_folds, random_state,
+              reduction_factor=REDUCTION_FACTOR, hyperband=False):
+    # Counted with integers, since the floating point logarithm falls just
+    # short of exact powers such as log(243, 3).
+    rungs = 0
+    while reduction_factor ** (rungs + 1) <= num_configurations:
+        rungs += 1
+    # Successive halving alone is the most aggressive bracket. Hyperband
+    # also runs the brackets which start fewer configurations on more data.
+    brackets = range(rungs, -1, -1) if hyperband else [rungs]
+    final = {}
+    history = []
+    for bracket in brackets:
+        count = int(math.ceil(float(num_configurations) * (rungs + 1) /
+                              (bracket + 1) /
+                              reduction_factor ** (rungs - bracket)))
+        sampled = sample_configurations(count, random_state)
+        configurations = dict(('%s-%s' % (bracket, i), configuration)
+                              for i, configuration in enumerate(sampled))
+        scores, bracket_history = successive_halving(
+            pool, configurations, num_folds,
+            1.0 / reduction_factor ** bracket, reduction_factor)
+        final.update(scores)
+        history.extend(bracket_history)
+    return final, history
+
+
+def furthest_scores(history):
+    # The score of every configuration from the last rung it reached.
+    scores = {}
+    for rung in history:
+        scores.update(rung)
+    return scores
+
+
+def pareto_front(scores):
+    # A configuration is on the front when no other one trained on the same
+    # amount of data is at least as accurate while being strictly cheaper.
+    front = set()
+    for key, score in scores.items():
+        if not any(other['fraction'] == score['fraction'] and
+                   other['accuracy'] >= score['accuracy'] and
+                   other['cost'] < score['cost']
+                   for other in scores.values()):
+            front.add(key)
+    return front
+
+
+def print_report(scores):
+    front = pareto_front(scores)
+    print '%5s %9s %10s %6s %6s %6s %9s  %s' % ('data', 'accuracy',
+                                                'margin mae', 'trees',
+                                                'depth', 'cost', 'us/game',
+                                                'configuration')
+    for key in rank(scores):
+        score = scores[key]
+        configuration = score['configuration']
+        others = dict((name, value) for name, value in configuration.items()
+                      if name not in ['n_estimators', 'max_depth'])
+        print '%4d%% %8.2f%% %10.3f %6s %6s %6s %9.2f %s %s' % (
+            100 * score['fraction'], score['accuracy'], score['margin_mae'],
+            configuration['n_estimators'], score['depth'], score['cost'],
+            score['microseconds_per_game'], '*' if key in front else ' ',
+            json.dumps(others, sort_keys=True))
+    print '* Best accuracy for its inference cost (trees x depth).'
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', help='Specify which dataset to use. For '
+    'testing purposes, use the "sample-data" directory. For production '
+    'deployments, use "matches" with current data that was pulled.',
+    default='matches')
+    parser.add_argument('--cache-directory', help='Specify where the '
+    'processed training data is cached. Default is %s.' %
+    TRAINING_CACHE_DIRECTORY, default=TRAINING_CACHE_DIRECTORY)
+    parser.add_argument('--tuning-directory', help='Specify where the folds '
+    'are cached. Default is %s.' % TUNING_DIRECTORY, default=TUNING_DIRECTORY)
+    parser.add_argument('--configurations', '-n', help='Specify how many '
+    'configurations to start with. Default is %s.' % NUM_CONFIGURATIONS,
+    type=int, default=NUM_CONFIGURATIONS)
+    parser.add_argument('--folds', help='Specify how many folds to score every'
+    ' configuration on. Default is %s.' % NUM_FOLDS, type=int,
+    default=NUM_FOLDS)
+    parser.add_argument('--hyperband', help='Optionally run every Hyperband '
+    'bracket instead of a single round of successive halving.',
+    action='store_true')
+    parser.add_argument('--processes', '-p', help='Optionally specify the '
+    'number of processes to train configurations in. Defaults to every core.',
+    type=int, default=None)
+    parser.add_argument('--model', help='Optionally train a model with the '
+    'winning configuration on the whole dataset and save it here.',
+    default=None)
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    instrumentation.start(args)
+    data = build_training_data(args.dataset, args.cache_directory).sort_index()
+    folds = load_folds(data, args.tuning_directory, args.folds)
+    random_state = np.random.RandomState(RANDOM_STATE)
+    pool = Pool(args.processes, initializer=_share, initargs=(folds,))
+    try:
+        scores, history = hyperband(pool, args.configurations, args.folds,
+                                    random_state, hyperband=args.hyperband)
+    finally:
+        pool.close()
+        pool.join()
+    print_report(furthest_scores(history))
+    winner = scores[rank(scores)[0]]['configuration']
+    print 'Winning configuration: %s' % json.dumps(winner, sort_keys=True)
+    if args.model:
+        predictor = Predictor(data=data, parameters=winner)
+        predictor.save(args.model)
+        print 'Saved the model to %s' % args.model
+        predictor.accuracy
+
+
+if __name__ == '__main__':
+    main()
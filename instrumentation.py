@@ -0,0 +1,152 @@
+import atexit
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# tracemalloc is only part of the standard library in Python 3.
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Timings:
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            total = self.spans.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['seconds'] += seconds
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+
+_timings = Timings()
+_profiler = None
+
+
+@contextmanager
+def span(name):
+    # Time a named stage. Spans with the same name add up, so a stage which
+    # runs once per game reports its total time and number of calls.
+    start = time.time()
+    try:
+        yield
+    finally:
+        _timings.add_span(name, time.time() - start)
+
+
+def timed(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    _timings.count(name, amount)
+
+
+def reset():
+    global _timings
+    _timings = Timings()
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss /= 1024.0
+    return round(max_rss / 1024.0, 1)
+
+
+def summary():
+    report = {'script': sys.argv[0],
+              'started': _timings.started,
+              'seconds': round(time.time() - _timings.started, 4),
+              'max_rss_mb': max_rss_mb(),
+              'spans': dict((name, {'calls': total['calls'],
+                                    'seconds': round(total['seconds'], 4)})
+                            for name, total in _timings.spans.items()),
+              'counters': dict(_timings.counters)}
+    if tracemalloc and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report['traced_memory_mb'] = {'current': round(current / 1e6, 1),
+                                      'peak': round(peak / 1e6, 1)}
+    return report
+
+
+def print_summary(report, output=sys.stderr):
+    output.write('%s\n' % ('=' * 80))
+    output.write('  %s finished in %.2fs, max RSS %s MB\n' % (
+        report['script'], report['seconds'], report['max_rss_mb']))
+    output.write('%s\n' % ('=' * 80))
+    spans = sorted(report['spans'].items(), key=lambda item:
+                   -item[1]['seconds'])
+    for name, total in spans:
+        output.write('%-40s %8d calls %10.3fs\n' % (name, total['calls'],
+                                                    total['seconds']))
+    for name, value in sorted(report['counters'].items()):
+        output.write('%-40s %14s\n' % (name, value))
+    if 'traced_memory_mb' in report:
+        output.write('Traced memory: %(current)s MB, peak %(peak)s MB\n' %
+                     report['traced_memory_mb'])
+
+
+def add_arguments(parser):
+    parser.add_argument('--timing-report', help='Optionally write the time '
+    'spent in every stage and the counters as JSON to the given file.',
+    default=None)
+    parser.add_argument('--profile', help='Optionally profile the run with '
+    'cProfile and save the stats to the given file.', default=None)
+    parser.add_argument('--trace-memory', help='Optionally track the peak '
+    'memory allocated by Python with tracemalloc (Python 3 only).',
+    action='store_true')
+
+
+def start(args):
+    # Called right after the arguments are parsed. The summary is printed to
+    # stderr when the script exits so it never mixes with regular output.
+    global _profiler
+    reset()
+    if getattr(args, 'trace_memory', False):
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            sys.stderr.write('tracemalloc is unavailable, only the max RSS '
+                             'is reported.\n')
+    if getattr(args, 'profile', None):
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    atexit.register(finish, args)
+
+
+def finish(args):
+    global _profiler
+    if _profiler:
+        _profiler.disable()
+        _profiler.dump_stats(args.profile)
+        pstats.Stats(_profiler, stream=sys.stderr).sort_stats('cumulative') \
+            .print_stats(20)
+        _profiler = None
+    report = summary()
+    print_summary(report)
+    if getattr(args, 'timing_report', None):
+        with open(args.timing_report, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
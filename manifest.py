@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def stats_version(dataframe):
+    return hashlib.sha1(dataframe.to_csv().encode('utf-8')).hexdigest()
+
+
+def parse_date(date_string):
+    return datetime.strptime(date_string, DATE_FORMAT)
+
+
+class IngestManifest:
+    def __init__(self, filename):
+        self.filename = filename
+        self.games = {}
+        self.team_stats = {}
+        self.last_run = None
+
+        if os.path.exists(filename):
+            with open(filename) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.games = manifest['games']
+            self.team_stats = manifest['team_stats']
+            if manifest['last_run']:
+                self.last_run = parse_date(manifest['last_run'])
+
+    def has_game(self, boxscore_index, path=None):
+        if boxscore_index not in self.games:
+            return False
+        return not path or path in self.games[boxscore_index]['paths']
+
+    def add_game(self, boxscore_index, team, path, date):
+        timestamp = None
+        if date:
+            timestamp = date.strftime(DATE_FORMAT)
+        game = self.games.setdefault(boxscore_index, {'paths': []})
+        game['date'] = timestamp
+        game['teams'] = sorted(set(game.get('teams', []) + [team]))
+        if path not in game['paths']:
+            game['paths'].append(path)
+
+    def team_stats_changed(self, abbreviation, version):
+        try:
+            return self.team_stats[abbreviation]['version'] != version
+        except KeyError:
+            return True
+
+    def add_team_stats(self, abbreviation, version):
+        self.team_stats[abbreviation] = {
+            'version': version,
+            'updated': datetime.now().strftime(DATE_FORMAT)
+        }
+
+    def save(self, finished=False):
+        if finished:
+            self.last_run = datetime.now()
+        last_run = None
+        if self.last_run:
+            last_run = self.last_run.strftime(DATE_FORMAT)
+        manifest = {'games': self.games,
+                    'team_stats': self.team_stats,
+                    'last_run': last_run}
+        temporary = '%s.tmp' % self.filename
+        with open(temporary, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.rename(temporary, self.filename)
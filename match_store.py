@@ -0,0 +1,156 @@
+import cPickle
+import json
+import numpy
+import os
+import pandas as pd
+import pickle
+from common import differential_vector, filter_stats, read_pickles
+from glob import glob
+from instrumentation import count, timed
+
+
+TRAINING_CACHE_DIRECTORY = '.cache/training-data'
+# Bump whenever process_matches changes so existing caches get rebuilt.
+TRAINING_DATA_VERSION = 2
+
+
+def boxscore_index(match_file):
+    return os.path.splitext(os.path.basename(match_file))[0]
+
+
+def file_signature(match_file):
+    # Files which are pulled again or corrected change their modification
+    # time or size, so their games are processed again.
+    stat = os.stat(match_file)
+    return [stat.st_mtime, stat.st_size]
+
+
+def find_match_files(data_directory):
+    # Older pulls saved every game twice, once under each team's directory.
+    # Key the files by their boxscore_index so only one copy is ever read.
+    match_files = {}
+    for match in sorted(glob('%s/*/*' % data_directory)):
+        match_files.setdefault(boxscore_index(match), match)
+    return match_files
+
+
+def read_match_files(match_files, indices, processes=None,
+                     dtype=numpy.float64):
+    data = read_pickles([match_files[index] for index in indices], processes,
+                        dtype=dtype)
+    data = data[~data.index.duplicated(keep='first')]
+    data.index.name = 'boxscore_index'
+    return data
+
+
+def read_matches(data_directory, processes=None, dtype=numpy.float64):
+    match_files = find_match_files(data_directory)
+    return read_match_files(match_files, sorted(match_files), processes,
+                            dtype)
+
+
+def process_matches(data):
+    # Every step here only looks at a single row at a time, which is what
+    # allows new games to be processed on their own and appended.
+    data = filter_stats(data)
+    data = data.dropna()
+    data['home_free_throw_percentage'].fillna(0, inplace=True)
+    data['away_free_throw_percentage'].fillna(0, inplace=True)
+    data['points_difference'] = data['home_points'] - data['away_points']
+    return differential_vector(data)
+
+
+class TrainingData:
+    def __init__(self, data_directory,
+                 cache_directory=TRAINING_CACHE_DIRECTORY,
+                 dtype=numpy.float64):
+        name = os.path.abspath(data_directory).strip(os.sep)
+        # Data processed at a different precision is cached separately.
+        if numpy.dtype(dtype) != numpy.float64:
+            name = '%s-%s' % (name, numpy.dtype(dtype).name)
+        directory = os.path.join(cache_directory, name.replace(os.sep, '_'))
+        self.data_file = os.path.join(directory, 'training-data.plk')
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+        self.data_directory = data_directory
+        self.directory = directory
+        self.dtype = dtype
+
+    def _load(self):
+        try:
+            with open(self.manifest_file) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['version'] != TRAINING_DATA_VERSION:
+                return None, {}
+            return pd.read_pickle(self.data_file), manifest['games']
+        except (IOError, OSError, ValueError, KeyError, EOFError,
+                pickle.UnpicklingError, cPickle.UnpicklingError):
+            # A damaged cache is rebuilt rather than failing every run.
+            return None, {}
+
+    def _save(self, data, games):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Both files are replaced in one step so a run which is interrupted
+        # part way through never leaves a truncated file behind. The manifest
+        # is written last, so games whose rows were saved without it are
+        # simply processed again on the next run.
+        temporary = '%s.tmp' % self.data_file
+        data.to_pickle(temporary)
+        os.rename(temporary, self.data_file)
+        manifest = {'version': TRAINING_DATA_VERSION,
+                    'games': games}
+        temporary = '%s.tmp' % self.manifest_file
+        with open(temporary, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(temporary, self.manifest_file)
+
+    @timed('training_data.build')
+    def build(self, rebuild=False, processes=None):
+        match_files = find_match_files(self.data_directory)
+        data, games = None, {}
+        if not rebuild:
+            data, games = self._load()
+        signatures = dict((game, file_signature(match_file))
+                          for game, match_file in match_files.items())
+        new_games = sorted(game for game in match_files
+                           if games.get(game) != signatures[game])
+        # Games whose match files are gone are dropped, as they would be
+        # from a full rebuild.
+        removed_games = sorted(set(games) - set(match_files))
+        count('new_games', len(new_games))
+        if not new_games and not removed_games:
+            return data
+        for game in removed_games:
+            del games[game]
+        if data is not None:
+            # The earlier rows of games whose files changed are replaced.
+            data = data.drop([game for game in new_games + removed_games
+                              if game in data.index])
+        if not new_games:
+            self._save(data, games)
+            return data
+        new_data = process_matches(read_match_files(match_files, new_games,
+                                                    processes, self.dtype))
+        if data is not None:
+            # Games which lack any of the existing columns would have been
+            # dropped by dropna in a full rebuild, so drop them here too.
+            new_data = new_data.reindex(columns=data.columns).dropna()
+            data = pd.concat([data, new_data])
+        else:
+            data = new_data
+        # Every game which was processed is recorded with the signature of
+        # its file, including the ones dropped for missing values, so they
+        # aren't attempted again until the file changes.
+        games.update((game, signatures[game]) for game in new_games)
+        self._save(data, games)
+        return data
+
+
+def build_training_data(data_directory,
+                        cache_directory=TRAINING_CACHE_DIRECTORY,
+                        processes=None, dtype=numpy.float64):
+    if not cache_directory:
+        return process_matches(read_matches(data_directory, processes,
+                                            dtype))
+    return TrainingData(data_directory, cache_directory, dtype).build(
+        processes=processes)
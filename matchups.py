@@ -1,18 +1,23 @@
 import argparse
-import numpy
-import pandas as pd
-import re
-from common import differential_vector, filter_stats, read_team_stats_file
+import instrumentation
+import json
+import socket
+import sys
+import urllib2
 from constants import YEAR
 from datetime import datetime
-from predictor import Predictor
-from teams import TEAMS
+from prediction_server import (DEFAULT_SERVER,
+                               PredictionService,
+                               request_predictions)
+from predictor import JOBS_VARIABLE, Predictor
+from team_stats import TeamStatsStore
 
 
 AWAY = 1
 HOME = 0
 TEAM_NAME_REGEX = 'schools/.*?/%s.html' % YEAR
 SCORES_PAGE = 'http://www.sports-reference.com/cbb/boxscores/index.cgi?month='
+BATCH_SIZE = 10000
 
 
 def retrieve_todays_url():
@@ -39,67 +44,167 @@ def display_predictions(predictions):
         print '%s => %s' % (teams, prediction[1])
 
 
-def convert_team_totals_to_averages(stats):
-    fields_to_average = ['mp', 'fg', 'fga', 'fg2', 'fg2a', 'fg3', 'fg3a', 'ft',
-                         'fta', 'orb', 'drb', 'trb', 'ast', 'stl', 'blk', 'tov',
-                         'pf', 'pts']
-    num_games = stats['g']
-    new_stats = stats.copy()
-
-    for field in fields_to_average:
-        new_value = float(stats[field]) / num_games
-        new_stats.loc[:,field] = new_value
-    return new_stats
-
-
-def extract_stats_components(stats, away=False):
-    # Get all of the stats that don't start with 'opp', AKA all of the
-    # stats that are directly related to the indicated team.
-    filtered_columns = [col for col in stats if not str(col).startswith('opp')]
-    stats = stats[filtered_columns]
-    stats = convert_team_totals_to_averages(stats)
-    if away:
-        # Prepend all stats with 'opp_' to signify the away team as such.
-        away_columns = ['opp_%s' % col for col in stats]
-        stats.columns = away_columns
-    return stats
-
-
-def create_matchup_stats(home_team, away_team):
-    away_stats = read_team_stats_file('team-stats/%s' % away_team)
-    home_stats = read_team_stats_file('team-stats/%s' % home_team)
-    away_stats = extract_stats_components(away_stats, away=True)
-    home_stats = extract_stats_components(home_stats)
-    match_stats = pd.concat([away_stats, home_stats], axis=1)
-    return match_stats
-
-
 def arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('home', help='Specify the home team in the matchup.')
-    parser.add_argument('away', help='Specify the away team in the matchup.')
+    parser.add_argument('home', help='Specify the home team in the matchup.',
+    nargs='?')
+    parser.add_argument('away', help='Specify the away team in the matchup.',
+    nargs='?')
+    parser.add_argument('--batch', help='Optionally score every matchup in '
+    'the given file instead of a single matchup. Use "-" to read from stdin. '
+    'Each line is either "home,away" or {"home": ..., "away": ...}. Results '
+    'are written to stdout with one JSON object per line, with an error for '
+    'lines which can\'t be parsed.', default=None)
     parser.add_argument('--dataset', help='Specify which dataset to use. For '
     'testing purposes, use the "sample-data" directory. For production '
     'deployments, use "matches" with current data that was pulled.',
     default='matches')
-    return parser.parse_args()
+    parser.add_argument('--model', help='Optionally specify a saved model to '
+    'load instead of training a new one. If the file does not exist yet, the '
+    'newly trained model is saved there.', default=None)
+    parser.add_argument('--server', help='Specify the address of a running '
+    'prediction server to query. Default is %s.' % DEFAULT_SERVER,
+    default=DEFAULT_SERVER)
+    parser.add_argument('--local', help='Optionally skip the prediction server'
+    ' and always load the model in this process.', action='store_true')
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if not args.batch and not (args.home and args.away):
+        parser.error('Either both home and away or --batch are required.')
+    return args
+
+
+def parse_matchup(line):
+    if line.startswith('{'):
+        game = json.loads(line)
+        return str(game['home']), str(game['away'])
+    home, away = [field.strip() for field in line.split(',')[:2]]
+    if not home or not away:
+        raise ValueError('Empty team')
+    return home, away
+
+
+def read_matchups(batch_file):
+    # Lines which can't be parsed are passed on as an error record in their
+    # place, so every line still gets exactly one line of output.
+    for line_number, line in enumerate(batch_file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            home, away = parse_matchup(line)
+        except (ValueError, KeyError, TypeError):
+            yield {'line': line_number,
+                   'error': 'Expected "home,away" or {"home": ..., '
+                            '"away": ...}'}
+            continue
+        # Skip the header row of a CSV file.
+        if (home, away) == ('home', 'away'):
+            continue
+        yield home, away
+
+
+def split_batches(matchups, batch_size=BATCH_SIZE):
+    batch = []
+    for matchup in matchups:
+        batch.append(matchup)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_service(args):
+    predictor = Predictor(args.dataset, model_file=args.model,
+                          jobs=args.jobs)
+    # Only the team stats which the model's features depend on are loaded.
+    team_stats = TeamStatsStore('team-stats', predictor.features)
+    return PredictionService(predictor, team_stats), predictor
+
+
+def query_server(matchups, server):
+    # Returns None only when no server could be reached. Error responses
+    # from a running server are raised instead of falling back to a local
+    # model which would hide them.
+    try:
+        return request_predictions(matchups, server, timeout=60)
+    except urllib2.HTTPError:
+        raise
+    except (urllib2.URLError, socket.error):
+        return None
+
+
+def server_error(error):
+    # Error responses from the prediction server explain themselves in the
+    # JSON body.
+    try:
+        return json.load(error)['error']
+    except (ValueError, KeyError, TypeError):
+        return str(error)
+
+
+def print_winner(result):
+    if 'error' in result:
+        print '%s: %s vs %s' % (result['error'], result['home'],
+                                result['away'])
+        sys.exit(1)
+    print result['winner']
+
+
+def run_batch(args):
+    batch_file = sys.stdin
+    if args.batch != '-':
+        batch_file = open(args.batch)
+    service = None
+    use_server = not args.local
+    for batch in split_batches(read_matchups(batch_file)):
+        matchups = [matchup for matchup in batch
+                    if isinstance(matchup, tuple)]
+        results = [] if not matchups else None
+        if use_server and results is None:
+            results = query_server(matchups, args.server)
+            # Stop asking the server once it could not be reached.
+            use_server = results is not None
+        if results is None:
+            if not service:
+                service, predictor = load_service(args)
+            results = service.predict(matchups)
+        results = iter(results)
+        for matchup in batch:
+            result = matchup
+            if isinstance(matchup, tuple):
+                result = next(results)
+            sys.stdout.write('%s\n' % json.dumps(result))
+        sys.stdout.flush()
 
 
 def main():
-    fields_to_rename = {'win_loss_pct': 'win_pct',
-                        'opp_win_loss_pct': 'opp_win_pct'}
-
     args = arguments()
-    predictor = Predictor(args.dataset)
-    match_stats = create_matchup_stats(args.home, args.away)
-    match_stats.rename(columns=fields_to_rename, inplace=True)
-    match_stats = differential_vector(match_stats)
-    match_stats_simplified = predictor.simplify(match_stats)
-    prediction = predictor.predict(match_stats_simplified, int)
-    if prediction[0] == 1:
-        print args.home
-    else:
-        print args.away
+    instrumentation.start(args)
+    try:
+        if args.batch:
+            run_batch(args)
+            return
+        if not args.local:
+            results = query_server([(args.home, args.away)], args.server)
+            if results:
+                print_winner(results[0])
+                return
+            sys.stderr.write('No prediction server is running at %s, '
+                             'loading the model instead.\n' % args.server)
+    except urllib2.HTTPError as error:
+        sys.stderr.write('The prediction server at %s answered with an '
+                         'error: %s\n' % (args.server, server_error(error)))
+        sys.exit(1)
+    # Fall back to loading the model in this process when no prediction
+    # server is running.
+    service, predictor = load_service(args)
+    print_winner(service.predict([(args.home, args.away)])[0])
     predictor.accuracy
 
 
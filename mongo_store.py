@@ -0,0 +1,116 @@
+import os
+import uuid
+from datetime import datetime
+from instrumentation import count, timed
+
+
+DATABASE = 'clarktechsports'
+MONGODB_URI_VARIABLE = 'MONGODB_URI'
+LATEST_RUNS = 'latest_runs'
+BULK_SIZE = 1000
+
+# MongoClient keeps its own connection pool, so a single client is shared by
+# everything in the process instead of connecting for every write.
+_client = None
+
+
+def get_client():
+    # pymongo is only imported once something is saved, so runs which skip
+    # MongoDB never load it.
+    global _client
+    from pymongo import MongoClient
+    if _client is None:
+        _client = MongoClient(os.environ.get(MONGODB_URI_VARIABLE))
+    return _client
+
+
+def run_id_for_date(date=None):
+    date = date or datetime.now()
+    return date.strftime('%Y-%m-%d')
+
+
+class RunStore:
+    def __init__(self, collection, key_fields, client=None,
+                 database=DATABASE):
+        # Every document belongs to a run, such as the day it was created
+        # for, and is identified within the run by its key_fields. Passing a
+        # client, such as a mongomock.MongoClient, skips the shared client.
+        self.db = (client or get_client())[database]
+        self.name = collection
+        self.collection = self.db[collection]
+        self.key_fields = key_fields
+        self._indexed = False
+
+    def ensure_indexes(self):
+        from pymongo import ASCENDING
+        if self._indexed:
+            return
+        self.collection.create_index([('runId', ASCENDING)])
+        self.collection.create_index([('latest', ASCENDING)])
+        self._indexed = True
+
+    def _document_id(self, run_id, document):
+        keys = [str(document[field]) for field in self.key_fields]
+        return ':'.join([run_id] + keys)
+
+    @timed('mongo.save_run')
+    def save_run(self, run_id, documents):
+        # Writing the same run again replaces its documents instead of adding
+        # duplicates, and only the documents of the previous latest run are
+        # touched, so the cost doesn't grow with the history.
+        from pymongo import ReplaceOne
+        self.ensure_indexes()
+        write_id = uuid.uuid4().hex
+        requests = []
+        written = 0
+        for document in documents:
+            document = dict(document)
+            document.pop('_id', None)
+            document.update({'_id': self._document_id(run_id, document),
+                             'runId': run_id,
+                             'writeId': write_id,
+                             'latest': True})
+            requests.append(ReplaceOne({'_id': document['_id']}, document,
+                                       upsert=True))
+            written += 1
+            # Documents can be streamed in, so they are sent in batches.
+            if len(requests) == BULK_SIZE:
+                self.collection.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+        count('mongo_documents', written)
+        # Documents left over from an earlier write of the same run are no
+        # longer part of it.
+        self.collection.delete_many({'runId': run_id,
+                                     'writeId': {'$ne': write_id}})
+        self.collection.update_many({'latest': True,
+                                     'runId': {'$ne': run_id}},
+                                    {'$set': {'latest': False}})
+        self.db[LATEST_RUNS].replace_one(
+            {'_id': self.name},
+            {'_id': self.name, 'runId': run_id, 'documents': written,
+             'updated': datetime.now()},
+            upsert=True)
+
+    def latest_run_id(self):
+        pointer = self.db[LATEST_RUNS].find_one({'_id': self.name})
+        if not pointer:
+            return None
+        return pointer['runId']
+
+    def latest(self):
+        run_id = self.latest_run_id()
+        if run_id is None:
+            return []
+        return list(self.collection.find({'runId': run_id}))
+
+
+def prediction_store(client=None):
+    return RunStore('predictions', ['homeAbbreviation', 'awayAbbreviation'],
+                    client)
+
+
+def simulation_store(client=None):
+    return RunStore('conference_predictions', ['conferenceAbbreviation'],
+                    client)
@@ -1,19 +1,40 @@
 import argparse
+import data_sources
+import instrumentation
 import itertools
 import numpy
+import os
 import pandas as pd
 import random
-from common import (differential_vector,
+import sys
+import zlib
+from common import (differential_matrix,
+                    differential_vector,
                     extract_stats_components,
-                    read_team_stats_file)
+                    read_team_stats_file,
+                    team_stat_columns,
+                    update_stats)
+from contextlib import contextmanager
+from data_sources import get_source
 from datetime import datetime
-from predictor import Predictor
-from sportsreference.ncaab.teams import Teams
-from sportsreference.ncaab.schedule import Schedule
+from instrumentation import count, span, timed
+from multiprocessing import Pool
+from predictor import JOBS_VARIABLE, Predictor
+from shared_arrays import SharedArrays, SharedModel, share_forest
+from team_stats import TeamStatsStore
 
 
 FIELDS_TO_DROP = ['abbreviation', 'conference', 'name']
 NUM_SIMS = 100
+# Distributed runs split every conference's simulations into tasks of at
+# most this many.
+SIMS_PER_TASK = 1000
+
+# Worker processes attach to the team stats and the model which the parent
+# put in shared memory once, instead of each loading their own copies.
+_shared = None
+_model = None
+_team_stats = None
 
 
 def get_winner(game, prediction):
@@ -33,9 +54,9 @@ def teams_list(conference, with_names=False):
     teams = []
     names = {}
     if not conference:
-        for team in Teams():
-            teams.append({team.abbreviation: team})
-            names[team.abbreviation] = team.name
+        for team in get_source().teams():
+            teams.append({team['abbreviation']: team})
+            names[team['abbreviation']] = team['name']
     else:
         for abbreviation, name in conference['teams'].items():
             teams.append(abbreviation)
@@ -55,21 +76,73 @@ def predict_all_matches(predictor, stats_dict, conference, schedule,
     for team in teams_list(conference):
         team_wins[team] = 0
 
-    for matchup in schedule:
-        home, away = matchup
-        home_stats = stats_dict[home]
-        away_stats = stats_dict['%s_away' % away]
-        match_stats.append(pd.concat([away_stats, home_stats], axis=1))
-    prediction_stats = pd.concat(match_stats)
-    match_vector = differential_vector(prediction_stats)
-    match_vector['points_difference'] = match_vector['home_points'] - \
-        match_vector['away_points']
+    with span('simulation.build_matches'):
+        for matchup in schedule:
+            home, away = matchup
+            home_stats = stats_dict[home]
+            away_stats = stats_dict['%s_away' % away]
+            match_stats.append(pd.concat([away_stats, home_stats], axis=1))
+        prediction_stats = pd.concat(match_stats)
+        match_vector = differential_vector(prediction_stats)
+        match_vector['points_difference'] = match_vector['home_points'] - \
+            match_vector['away_points']
     match_stats_simplified = predictor.simplify(match_vector)
     predictions = predictor.predict(match_stats_simplified, int)
     team_wins = get_totals(schedule, predictions, team_wins, conference_wins)
     return team_wins
 
 
+def create_stats_matrices(stats_dict, teams):
+    home_columns = [str(col) for col in stats_dict[teams[0]].columns]
+    away_columns = [str(col) for col in
+                    stats_dict['%s_away' % teams[0]].columns]
+    home_stats = numpy.vstack([stats_dict[team][home_columns].values
+                               for team in teams]).astype(numpy.float32)
+    away_stats = numpy.vstack([stats_dict['%s_away' % team][away_columns]
+                               .values for team in teams])
+    return (home_stats, away_stats.astype(numpy.float32), home_columns,
+            away_columns)
+
+
+def create_variance_matrix(stats, columns, stdev_dict):
+    stdev = numpy.array([float(stdev_dict[col]) for col in columns])
+    variance = numpy.random.uniform(-1 * stdev, stdev, stats.shape)
+    return stats + variance.astype(numpy.float32)
+
+
+def create_variance_matrices(stats_matrices, stdev_dict):
+    home_stats, away_stats, home_columns, away_columns = stats_matrices
+    return (create_variance_matrix(home_stats, home_columns, stdev_dict),
+            create_variance_matrix(away_stats, away_columns, stdev_dict),
+            home_columns, away_columns)
+
+
+def predict_all_matches_compact(predictor, stats_matrices, teams, schedule,
+                                conference_wins):
+    home_stats, away_stats, home_columns, away_columns = stats_matrices
+    team_wins = {}
+
+    for team in teams:
+        team_wins[team] = 0
+    if not schedule:
+        return get_totals(schedule, [], team_wins, conference_wins)
+    with span('simulation.build_matches'):
+        rows = dict((team, i) for i, team in enumerate(teams))
+        home_rows = [rows[home] for home, away in schedule]
+        away_rows = [rows[away] for home, away in schedule]
+        match_stats = numpy.hstack([away_stats[away_rows],
+                                    home_stats[home_rows]])
+        match_vector, columns = differential_matrix(
+            match_stats, away_columns + home_columns)
+        points_difference = match_vector[:, columns.index('home_points')] - \
+            match_vector[:, columns.index('away_points')]
+        match_vector = numpy.column_stack([match_vector, points_difference])
+    match_stats_simplified = predictor.simplify(match_vector,
+                                                columns + ['points_difference'])
+    predictions = predictor.predict(match_stats_simplified, int)
+    return get_totals(schedule, predictions, team_wins, conference_wins)
+
+
 def create_variance(stats_dict, stdev_dict):
     local_stats_dict = {}
 
@@ -127,14 +200,26 @@ def add_points_total(points_dict, team_wins):
 
 
 def predict_all_simulations(predictor, stats_dict, stdev_dict, conference,
-                            num_sims, schedule, conference_wins):
+                            num_sims, schedule, conference_wins,
+                            stats_matrices=None):
     standings_dict = initialize_standings_dict(conference)
     points_dict = {}
 
+    if predictor.compact:
+        teams = teams_list(conference)
+        if stats_matrices is None:
+            stats_matrices = create_stats_matrices(stats_dict, teams)
     for iteration in range(num_sims):
-        local_stats_dict = create_variance(stats_dict, stdev_dict)
-        team_wins = predict_all_matches(predictor, local_stats_dict, conference,
-                                        schedule, conference_wins)
+        if predictor.compact:
+            local_stats = create_variance_matrices(stats_matrices, stdev_dict)
+            team_wins = predict_all_matches_compact(predictor, local_stats,
+                                                    teams, schedule,
+                                                    conference_wins)
+        else:
+            local_stats_dict = create_variance(stats_dict, stdev_dict)
+            team_wins = predict_all_matches(predictor, local_stats_dict,
+                                            conference, schedule,
+                                            conference_wins)
         points_dict = add_points_total(points_dict, team_wins)
         rankings = print_rankings(team_wins)
         for rank in range(len(rankings)):
@@ -149,6 +234,7 @@ def get_conference_wins(team):
     return int(stats['conference_wins'])
 
 
+@timed('simulation.fetch_schedules')
 def get_remaining_schedule(conference):
     # remaining_schedule is a list of lists with the inner list being
     # the home first, followed by the away team (ie. [home, away])
@@ -157,17 +243,18 @@ def get_remaining_schedule(conference):
     conference_name_short = conference['name'].replace(' Conference', '')
 
     for team in teams_list(conference):
-        schedule = Schedule(team)
+        schedule = get_source().schedule(team)
+        count('schedules_fetched')
         conference_wins = get_conference_wins(team)
         current_records[team] = conference_wins
         for game in schedule:
             # Find all conference matchups that the team hasn't played yet.
-            if game.opponent_abbr in teams_list(conference) and \
-               not game.points_for:
-                if game.location == 'AWAY':
-                    remaining_schedule.append([game.opponent_abbr, team])
+            if game['opponent_abbr'] in teams_list(conference) and \
+               not game['points_for']:
+                if game['location'] == 'AWAY':
+                    remaining_schedule.append([game['opponent_abbr'], team])
                 else:
-                    remaining_schedule.append([team, game.opponent_abbr])
+                    remaining_schedule.append([team, game['opponent_abbr']])
     remaining_schedule.sort()
     # Return a list of non-duplicate matches
     schedule = list(s for s, _ in itertools.groupby(remaining_schedule))
@@ -176,30 +263,30 @@ def get_remaining_schedule(conference):
 
 def drop_stats(home_stats, away_stats):
     for field in FIELDS_TO_DROP:
+        # The fields are already missing when the stats have been projected
+        # onto the model's features.
+        if 'home_%s' % field not in home_stats:
+            continue
         home_stats.drop('home_%s' % field, 1, inplace=True)
         away_stats.drop('away_%s' % field, 1, inplace=True)
     return home_stats, away_stats
 
 
-def update_stats(stats):
-    if 'defensive_rating' not in stats and \
-       'offensive_rating' in stats and \
-       'net_rating' in stats:
-        stats['defensive_rating'] = stats['offensive_rating'] - \
-            stats['net_rating']
-    return stats
-
-
-def create_stats_dictionary(conference):
+@timed('simulation.team_stats')
+def create_stats_dictionary(conference, columns=None):
     stats_dict = {}
     stdev_dict = {}
     combined_stats = pd.DataFrame()
 
     for team in teams_list(conference):
-        stats = read_team_stats_file('team-stats/%s' % team)
+        # Reset the abbreviation index so a team's home stats line up with
+        # its opponent's away stats when a match is built.
+        stats = read_team_stats_file('team-stats/%s' % team) \
+            .reset_index(drop=True)
         stats = update_stats(stats)
-        home_stats = extract_stats_components(stats)
-        away_stats = extract_stats_components(stats, away=True)
+        home_stats = extract_stats_components(stats, columns=columns)
+        away_stats = extract_stats_components(stats, away=True,
+                                              columns=columns)
         home_stats, away_stats = drop_stats(home_stats, away_stats)
         stats_dict[team] = home_stats
         stats_dict['%s_away' % team] = away_stats
@@ -239,11 +326,33 @@ def parse_arguments():
     'testing purposes, use the "sample-data" directory. For production '
     'deployments, use "matches" with current data that was pulled.',
     default='matches')
+    parser.add_argument('--compact', help='Optionally keep all features as '
+    'float32 NumPy arrays instead of DataFrames to reduce memory usage.',
+    action='store_true')
+    parser.add_argument('--model', help='Optionally specify a saved model to '
+    'load instead of training a new one. If the file does not exist yet, the '
+    'newly trained model is saved there.', default=None)
+    parser.add_argument('--engine', help='Specify how the forest is evaluated.'
+    ' "flat" walks flattened node arrays for all trees at once, which is '
+    'faster for the many small batches the simulations make.',
+    choices=['sklearn', 'flat'], default='sklearn')
+    parser.add_argument('--surrogate', help='Optionally run the simulations '
+    'on a distilled linear surrogate of the forest, which is much faster for '
+    'bulk sampling. Its fidelity against the forest is printed first.',
+    action='store_true')
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    data_sources.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
 def start_simulations(predictor, conference, num_sims=NUM_SIMS):
-    stats_dict, stdev_dict = create_stats_dictionary(conference)
+    # Only the team stats which the model's features are built from are used.
+    columns = team_stat_columns(predictor.features)
+    stats_dict, stdev_dict = create_stats_dictionary(conference, columns)
     schedule, conference_wins = get_remaining_schedule(conference)
     team_wins, points_dict = predict_all_simulations(predictor, stats_dict,
                                                      stdev_dict, conference,
@@ -252,9 +361,191 @@ def start_simulations(predictor, conference, num_sims=NUM_SIMS):
     return team_wins, points_dict
 
 
+def stats_spread(home_stats, away_stats):
+    # The standard deviation of every stat across a conference's teams, as
+    # create_stats_dictionary finds it.
+    stats = numpy.hstack([home_stats, away_stats]).astype(numpy.float64)
+    return stats.std(axis=0, ddof=1)
+
+
+def share_simulation_data(shared, predictor, conferences):
+    # The projected stats of every team, the spread of each conference's
+    # stats and the flattened forest.
+    store = TeamStatsStore('team-stats', predictor.features)
+    index = share_forest(shared, predictor)
+    shared.write('home_stats', store.home_stats)
+    shared.write('away_stats', store.away_stats)
+    stdev = []
+    for abbreviation, details in sorted(conferences.items()):
+        rows = [store.teams[team] for team in teams_list(details)]
+        stdev.append(stats_spread(store.home_stats[rows],
+                                  store.away_stats[rows]))
+    shared.write('stdev', numpy.array(stdev))
+    index.update({'teams': store.teams,
+                  'home_columns': store.home_columns,
+                  'away_columns': store.away_columns})
+    shared.write_index(index)
+
+
+@contextmanager
+def quiet():
+    # Workers leave printing the results to whoever collects them, instead of
+    # printing the standings of every single simulation.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _attach(directory):
+    global _shared, _model, _team_stats
+    _shared = SharedArrays(directory)
+    _model = SharedModel(_shared)
+    _team_stats = (_shared.read('home_stats'), _shared.read('away_stats'),
+                   _shared.read('stdev'))
+    # Forked workers start from the parent's random state, which would have
+    # every worker draw the same variances.
+    numpy.random.seed()
+    random.seed()
+
+
+def simulate_shared_conference(task):
+    abbreviation, number, details, schedule, conference_wins, num_sims = task
+    home_stats, away_stats, stdev = _team_stats
+    home_columns = _shared.index['home_columns']
+    away_columns = _shared.index['away_columns']
+    rows = [_shared.index['teams'][team] for team in teams_list(details)]
+    stats_matrices = (numpy.array(home_stats[rows]),
+                      numpy.array(away_stats[rows]), home_columns,
+                      away_columns)
+    stdev_dict = dict(zip(home_columns + away_columns, stdev[number]))
+    with quiet():
+        results, points = predict_all_simulations(_model, None, stdev_dict,
+                                                  details, num_sims, schedule,
+                                                  conference_wins,
+                                                  stats_matrices)
+    return abbreviation, results, points
+
+
+def simulate_conferences_shared(predictor, conferences, writer, num_sims,
+                                processes):
+    tasks = []
+    for number, (abbreviation, details) in \
+            enumerate(sorted(conferences.items())):
+        schedule, conference_wins = get_remaining_schedule(details)
+        tasks.append((abbreviation, number, details, schedule,
+                      conference_wins, num_sims))
+    with SharedArrays() as shared:
+        share_simulation_data(shared, predictor, conferences)
+        pool = Pool(processes if processes > 0 else None,
+                    initializer=_attach, initargs=(shared.directory,))
+        try:
+            for abbreviation, results, points in \
+                    pool.imap(simulate_shared_conference, tasks):
+                print_simulation_results(results, num_sims)
+                writer.write_conference(abbreviation,
+                                        conferences[abbreviation]['name'],
+                                        results, points)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def simulate_conferences(predictor, conferences, writer, num_sims=NUM_SIMS,
+                         processes=1):
+    # Every conference is written out as soon as its simulations finish
+    # instead of keeping the results of all of them in memory. With more than
+    # one process, the conferences are simulated in a pool of workers which
+    # share the team stats and the model, so each one only adds its own
+    # simulation buffers. Use -1 for a worker on every core.
+    if processes != 1:
+        simulate_conferences_shared(predictor, conferences, writer, num_sims,
+                                    processes)
+        return
+    for abbreviation, details in sorted(conferences.items()):
+        results, points = start_simulations(predictor, details, num_sims)
+        writer.write_conference(abbreviation, details['name'], results,
+                                points)
+
+
+def simulation_tasks(conferences, num_sims=NUM_SIMS,
+                     sims_per_task=SIMS_PER_TASK, seed=None):
+    # Every conference's simulations are split into ranges, each with its own
+    # seed, so a range gives the same tally wherever and however often it is
+    # run. The tasks carry the schedules, so workers don't need the source.
+    if seed is None:
+        seed = random.getrandbits(32)
+    tasks = []
+    for abbreviation, details in sorted(conferences.items()):
+        schedule, conference_wins = get_remaining_schedule(details)
+        for start in range(0, num_sims, sims_per_task):
+            task_id = '%s:%s' % (abbreviation, start)
+            tasks.append({'id': task_id,
+                          'key': abbreviation,
+                          'conference': details,
+                          'schedule': schedule,
+                          'conference_wins': conference_wins,
+                          'num_sims': min(sims_per_task, num_sims - start),
+                          'seed': zlib.crc32('%s:%s' % (seed, task_id)) &
+                          0xffffffff})
+    return tasks
+
+
+def simulate_task(predictor, task, store):
+    # Returns the place counts and win totals of the task's simulations with
+    # the teams in sorted order. The stats come from a TeamStatsStore which is
+    # loaded once for all of a worker's tasks.
+    conference = task['conference']
+    rows = [store.teams[team] for team in teams_list(conference)]
+    home_stats = store.home_stats[rows]
+    away_stats = store.away_stats[rows]
+    stdev_dict = dict(zip(store.home_columns + store.away_columns,
+                          stats_spread(home_stats, away_stats)))
+    stats_matrices = (home_stats, away_stats, store.home_columns,
+                      store.away_columns)
+    numpy.random.seed(task['seed'])
+    random.seed(task['seed'])
+    with quiet():
+        results, points = predict_all_simulations(predictor, None, stdev_dict,
+                                                  conference,
+                                                  task['num_sims'],
+                                                  task['schedule'],
+                                                  task['conference_wins'],
+                                                  stats_matrices)
+    teams = sorted(results)
+    return {'standings': [results[team]['points'] for team in teams],
+            'points': [points.get(team, 0) for team in teams]}
+
+
+def write_tallies(writer, conferences, tallies, num_sims):
+    for abbreviation, details in sorted(conferences.items()):
+        teams = sorted(details['teams'])
+        standings = tallies[abbreviation].arrays['standings'].tolist()
+        totals = tallies[abbreviation].arrays['points'].tolist()
+        results = {}
+        points = {}
+        for i, team in enumerate(teams):
+            results[team] = {'name': details['teams'][team],
+                             'points': standings[i]}
+            points[team] = totals[i]
+        print_simulation_results(results, num_sims)
+        writer.write_conference(abbreviation, details['name'], results,
+                                points)
+
+
 def main():
     args = parse_arguments()
-    predictor = Predictor(args.dataset)
+    instrumentation.start(args)
+    data_sources.start(args)
+    predictor = Predictor(args.dataset, compact=args.compact,
+                          model_file=args.model, engine=args.engine,
+                          jobs=args.jobs)
+    if args.surrogate:
+        predictor = predictor.surrogate()
+        predictor.fidelity
     start_simulations(predictor, args.conference, int(args.num_sims))
 
 
@@ -0,0 +1,424 @@
+import argparse
+import bracket_builder
+import data_sources
+import hashlib
+import imp
+import instrumentation
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from Queue import Queue
+from common import share_team_stats
+from data_sources import get_source
+from instrumentation import span
+from match_store import TRAINING_DATA_VERSION
+from mongo_store import run_id_for_date, simulation_store
+from monte_carlo_simulation import NUM_SIMS, simulate_conferences
+from predictor import (FOREST_PARAMETERS,
+                       JOBS_VARIABLE,
+                       MODEL_VERSION,
+                       SELECTION_THRESHOLD,
+                       Predictor)
+from save_json import SIMULATION_FILE, SimulationWriter, read_records, save_json
+from simulation_histograms import (HISTOGRAM_FILE,
+                                   HistogramReader,
+                                   HistogramWriter)
+from team_stats import TeamStatsStore
+
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = '.cache/pipeline/state.json'
+MODEL_FILE = 'models/daily.plk'
+BRACKETS_FILE = 'simulations/brackets.json'
+TEAM_STATS_DIRECTORY = 'team-stats'
+WORKERS = 2
+RAN = 'ran'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+def load_script(script):
+    # Scripts such as analyze-games.py can't be imported by name.
+    name = os.path.splitext(script)[0].replace('-', '_')
+    if name not in sys.modules:
+        imp.load_source(name, os.path.join(REPOSITORY, script))
+    return sys.modules[name]
+
+
+def run_script(script, *arguments):
+    # The scraping scripts replace requests.get with a cached version, so
+    # they run in their own process rather than alongside the other stages.
+    subprocess.check_call([sys.executable, os.path.join(REPOSITORY, script)] +
+                          list(arguments))
+
+
+def hash_path(digest, path):
+    if os.path.isdir(path):
+        for directory, directories, filenames in os.walk(path):
+            directories.sort()
+            for filename in sorted(filenames):
+                hash_path(digest, os.path.join(directory, filename))
+        return
+    digest.update(path)
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), ''):
+            digest.update(block)
+
+
+class Stage:
+    def __init__(self, name, run, after=None, files=None, values=None,
+                 outputs=None, uses_model=False, exclusive=None):
+        # files and values return the stage's inputs for a given context:
+        # the paths whose contents it reads and anything else which changes
+        # its result, such as the day's games. A stage without inputs, such
+        # as one pulling new data, always runs.
+        self.name = name
+        self.run = run
+        self.after = after or []
+        self.files = files
+        self.values = values
+        self.outputs = outputs or (lambda context: [])
+        # Stages using the shared model take turns with it, since predicting
+        # changes its state. An exclusive stage, such as one forking worker
+        # processes, runs while no other stage does.
+        self.uses_model = uses_model
+        self.exclusive = exclusive or (lambda context: False)
+
+    def fingerprint(self, context):
+        if not self.files and not self.values:
+            return None
+        digest = hashlib.sha1()
+        for path in sorted(self.files(context) if self.files else []):
+            hash_path(digest, path)
+        if self.values:
+            digest.update(json.dumps(self.values(context), sort_keys=True,
+                                     default=str))
+        return digest.hexdigest()
+
+
+class PipelineState:
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            with open(filename) as state_file:
+                self.fingerprints = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            self.fingerprints = {}
+
+    def unchanged(self, stage, fingerprint):
+        return fingerprint is not None and \
+            self.fingerprints.get(stage) == fingerprint
+
+    def record(self, stage, fingerprint):
+        with self._lock:
+            self.fingerprints[stage] = fingerprint
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            temporary = '%s.tmp' % self.filename
+            with open(temporary, 'w') as state_file:
+                json.dump(self.fingerprints, state_file, indent=2,
+                          sort_keys=True)
+            os.rename(temporary, self.filename)
+
+
+class Context:
+    def __init__(self, args):
+        # Every stage shares a single model. The compact layout serves them
+        # all, and lets the conference simulations take their NumPy path.
+        # Predicting isn't thread-safe, so stages hold model_lock to use it.
+        self.args = args
+        self._predictor = None
+        self._team_stats = None
+        self._lock = threading.Lock()
+        self.model_lock = threading.Lock()
+
+    def predictor(self):
+        with self._lock:
+            if self._predictor is None:
+                self._predictor = Predictor(self.args.dataset, compact=True,
+                                            model_file=self.args.model,
+                                            jobs=self.args.jobs)
+            return self._predictor
+
+    def train(self):
+        with self._lock:
+            if os.path.exists(self.args.model):
+                os.remove(self.args.model)
+            self._predictor = Predictor(self.args.dataset, compact=True,
+                                        model_file=self.args.model,
+                                        jobs=self.args.jobs)
+            self._team_stats = None
+
+    def team_stats(self):
+        # Built for the current model's features, so a new model gets a new
+        # store.
+        predictor = self.predictor()
+        with self._lock:
+            if self._team_stats is None:
+                self._team_stats = TeamStatsStore(TEAM_STATS_DIRECTORY,
+                                                  predictor.features)
+            return self._team_stats
+
+    def simulation_file(self):
+        if self.args.binary:
+            return HISTOGRAM_FILE
+        return SIMULATION_FILE
+
+
+def pull_stats(context):
+    run_script('pull-stats.py')
+
+
+def save_results(context):
+    run_script('save-results.py')
+    run_script('check-predictions.py')
+
+
+def predict_games(context):
+    analyze_games = load_script('analyze-games.py')
+    analyze_games.predict_games(context.predictor(),
+                                context.args.skip_save_to_mongodb)
+
+
+def games_inputs(context):
+    source = get_source()
+    today = source.today()
+    # A run which skipped saving to MongoDB doesn't stand in for one which
+    # saves.
+    return {'date': today.strftime('%Y-%m-%d'),
+            'games': source.boxscores(today),
+            'mongodb': not context.args.skip_save_to_mongodb}
+
+
+def predictions_outputs(context):
+    return [load_script('analyze-games.py').predictions_filename()]
+
+
+def simulate(context):
+    filename = context.simulation_file()
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    if context.args.binary:
+        writer = HistogramWriter(filename, context.args.num_sims)
+    else:
+        writer = SimulationWriter(filename, context.args.num_sims)
+    with writer:
+        simulate_conferences(context.predictor(), get_source().conferences(),
+                             writer, context.args.num_sims,
+                             context.args.processes)
+    if context.args.skip_save_to_mongodb:
+        return
+    if context.args.binary:
+        simulations = HistogramReader(filename).simulations()
+    else:
+        simulations = read_records(filename)
+    simulation_store().save_run(run_id_for_date(), simulations)
+
+
+def simulation_inputs(context):
+    source = get_source()
+    conferences = source.conferences()
+    schedules = dict((team, source.schedule(team))
+                     for details in conferences.values()
+                     for team in details['teams'])
+    return {'num_sims': context.args.num_sims,
+            'binary': context.args.binary,
+            'mongodb': not context.args.skip_save_to_mongodb,
+            'conferences': conferences,
+            'schedules': schedules}
+
+
+def simulate_brackets(context):
+    champions = bracket_builder.simulate_brackets(context.predictor(),
+                                                  context.simulation_file(),
+                                                  context.team_stats())
+    for conference, champion in sorted(champions.items()):
+        print '%s: %s' % (conference, champion)
+    save_json(champions, BRACKETS_FILE)
+
+
+def model_inputs(context):
+    return [context.args.model, TEAM_STATS_DIRECTORY]
+
+
+def daily_stages(args):
+    # pull-stats -> train and results -> predictions and simulations ->
+    # brackets. The results read yesterday's predictions, so today's are
+    # only written once they are done.
+    stages = [
+        Stage('pull-stats', pull_stats),
+        Stage('train', lambda context: context.train(), after=['pull-stats'],
+              files=lambda context: [context.args.dataset],
+              values=lambda context: {'model': MODEL_VERSION,
+                                      'parameters': FOREST_PARAMETERS,
+                                      'threshold': SELECTION_THRESHOLD,
+                                      'training_data': TRAINING_DATA_VERSION},
+              outputs=lambda context: [context.args.model], uses_model=True),
+        Stage('results', save_results, after=['pull-stats']),
+        Stage('predictions', predict_games, after=['train', 'results'],
+              files=model_inputs, values=games_inputs,
+              outputs=predictions_outputs, uses_model=True),
+        Stage('simulations', simulate, after=['train'],
+              files=model_inputs, values=simulation_inputs,
+              outputs=lambda context: [context.simulation_file()],
+              uses_model=True,
+              exclusive=lambda context: context.args.processes != 1),
+        Stage('brackets', simulate_brackets, after=['simulations'],
+              files=lambda context: model_inputs(context) +
+              [context.simulation_file()],
+              outputs=lambda context: [BRACKETS_FILE], uses_model=True)]
+    skipped = []
+    if args.skip_pull:
+        skipped.append('pull-stats')
+    if args.skip_results:
+        skipped.append('results')
+    if args.stages:
+        skipped += [stage.name for stage in stages
+                    if stage.name not in args.stages]
+    return [stage for stage in stages if stage.name not in skipped]
+
+
+def run_stage(stage, context, state, force=False):
+    fingerprint = stage.fingerprint(context)
+    outputs = stage.outputs(context)
+    if not force and state.unchanged(stage.name, fingerprint) and \
+       all(os.path.exists(output) for output in outputs):
+        return SKIPPED
+    with span('pipeline.%s' % stage.name):
+        if stage.uses_model:
+            with context.model_lock:
+                stage.run(context)
+        else:
+            stage.run(context)
+    state.record(stage.name, fingerprint)
+    return RAN
+
+
+def run_pipeline(stages, context, state, workers=WORKERS, force=False):
+    # Stages start as soon as every stage they come after has finished, up
+    # to the given number at a time. Dependencies on stages which aren't
+    # part of this run are treated as done. Exclusive stages wait for the
+    # running ones to finish and then run on their own.
+    names = [stage.name for stage in stages]
+    pending = list(stages)
+    finished = Queue()
+    results = {}
+    running = 0
+
+    def run(stage):
+        start = time.time()
+        try:
+            status = run_stage(stage, context, state, force)
+        except Exception:
+            traceback.print_exc()
+            status = FAILED
+        finished.put((stage.name, status, time.time() - start))
+
+    while pending or running:
+        progress = True
+        while progress:
+            progress = False
+            for stage in list(pending):
+                after = [results.get(name) for name in stage.after
+                         if name in names]
+                if FAILED in after or BLOCKED in after:
+                    pending.remove(stage)
+                    results[stage.name] = BLOCKED
+                    progress = True
+                elif None not in after and running < workers and \
+                        (running == 0 or not stage.exclusive(context)):
+                    pending.remove(stage)
+                    running += 1
+                    progress = True
+                    if stage.exclusive(context):
+                        # Run in this thread so no other thread exists
+                        # while the stage forks its worker processes.
+                        run(stage)
+                        continue
+                    thread = threading.Thread(target=run, args=(stage,))
+                    thread.daemon = True
+                    thread.start()
+        if not running:
+            break
+        name, status, seconds = finished.get()
+        running -= 1
+        results[name] = status
+        print '[pipeline] %s %s in %.1fs' % (name, status, seconds)
+    return results
+
+
+def print_results(stages, results):
+    print '=' * 80
+    for stage in stages:
+        print '%-12s %s' % (stage.name, results.get(stage.name, BLOCKED))
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', help='Specify which dataset to use. For '
+    'testing purposes, use the "sample-data" directory. For production '
+    'deployments, use "matches" with current data that was pulled.',
+    default='matches')
+    parser.add_argument('--model', help='Specify where the shared model is '
+    'saved. Default is %s.' % MODEL_FILE, default=MODEL_FILE)
+    parser.add_argument('--stages', help='Optionally only run the given '
+    'stages, such as "predictions" or "simulations".', nargs='+',
+    default=None)
+    parser.add_argument('--force', help='Run every stage, even those whose '
+    'inputs are unchanged since their last run.', action='store_true')
+    parser.add_argument('--workers', help='Specify how many stages can run '
+    'at the same time. Default is %s.' % WORKERS, type=int, default=WORKERS)
+    parser.add_argument('--num-sims', '-n', help='Specify the number of '
+    'simulations of every conference. Default is %s.' % NUM_SIMS, type=int,
+    default=NUM_SIMS)
+    parser.add_argument('--processes', '-p', help='Optionally simulate the '
+    'conferences in the given number of processes, which share the team stats'
+    ' and the model through memory-mapped files. Use -1 for every core. '
+    'Default is 1.', type=int, default=1)
+    parser.add_argument('--binary', help='Optionally save the place '
+    'histograms to %s instead of %s.' % (HISTOGRAM_FILE, SIMULATION_FILE),
+    action='store_true')
+    parser.add_argument('--skip-pull', help='Optionally skip pulling the '
+    'latest stats and matches.', action='store_true')
+    parser.add_argument('--skip-results', help='Optionally skip saving and '
+    'checking the results of earlier predictions.', action='store_true')
+    parser.add_argument('--skip-save-to-mongodb', help='Optionally skip saving'
+    ' results to a MongoDB database.', action='store_true')
+    parser.add_argument('--state-file', help='Specify where the fingerprints '
+    'of every stage\'s inputs are kept. Default is %s.' % STATE_FILE,
+    default=STATE_FILE)
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    data_sources.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    instrumentation.start(args)
+    data_sources.start(args)
+    share_team_stats()
+    stages = daily_stages(args)
+    results = run_pipeline(stages, Context(args),
+                           PipelineState(args.state_file), args.workers,
+                           args.force)
+    print_results(stages, results)
+    if FAILED in results.values() or BLOCKED in results.values():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
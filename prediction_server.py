@@ -0,0 +1,271 @@
+import argparse
+import instrumentation
+import itertools
+import json
+import os
+import threading
+import time
+import traceback
+import urllib2
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from glob import glob
+from predictor import JOBS_VARIABLE, Predictor
+from team_stats import TeamStatsStore
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8642
+DEFAULT_SERVER = 'http://%s:%s' % (DEFAULT_HOST, DEFAULT_PORT)
+RELOAD_INTERVAL = 60
+
+
+def unknown_team(home, away):
+    return {'home': home, 'away': away, 'error': 'Unknown team'}
+
+
+def all_matchups(team_stats):
+    return list(itertools.permutations(sorted(team_stats.teams), 2))
+
+
+def modified_times(paths):
+    times = []
+    for path in paths:
+        try:
+            times.append((path, os.path.getmtime(path)))
+        except OSError:
+            pass
+    return times
+
+
+class ServedFiles:
+    # The files a resident server loads its model and team stats from. The
+    # daily pipeline pulls new stats and retrains the model in place, so the
+    # server watches them and loads the new versions.
+    def __init__(self, dataset, model_file, team_stats_directory='team-stats',
+                 jobs=None):
+        self.dataset = dataset
+        self.model_file = model_file
+        self.team_stats_directory = team_stats_directory
+        self.jobs = jobs
+
+    def signature(self):
+        model_files = [self.model_file] if self.model_file else []
+        return (modified_times(model_files),
+                modified_times(sorted(glob('%s/*.plk' %
+                                           self.team_stats_directory))))
+
+    def load(self, predictor=None, signature=None):
+        # The model is only loaded again when its file changed. The team
+        # stats always are, since they depend on the model's features.
+        new_signature = self.signature()
+        if predictor is None or new_signature[0] != signature[0]:
+            predictor = Predictor(self.dataset, model_file=self.model_file,
+                                  jobs=self.jobs)
+        team_stats = TeamStatsStore(self.team_stats_directory,
+                                    predictor.features)
+        return predictor, team_stats, new_signature
+
+
+class PredictionService:
+    def __init__(self, predictor, team_stats, files=None, signature=None):
+        # The result of every matchup is kept once computed. All three are
+        # swapped together when a server reloads, so a query always sees a
+        # model with its matching team stats and results.
+        self._state = (predictor, team_stats, {})
+        self._lock = threading.Lock()
+        self._files = files
+        self._signature = signature
+        self._checked = time.time()
+        self._reload_lock = threading.Lock()
+        self._precomputed = False
+
+    @property
+    def team_stats(self):
+        return self._state[1]
+
+    def _predict(self, predictor, team_stats, matchups):
+        match_stats = team_stats.matchup_frame(matchups)
+        match_stats = predictor.simplify(match_stats)
+        points = predictor.predict(match_stats, float)
+        probabilities = predictor.predict_probability(match_stats)
+        results = {}
+        for i, (home, away) in enumerate(matchups):
+            home_points, away_points = points[i]
+            # In the case of a tie, give precedence to the home team.
+            winner = home if home_points >= away_points else away
+            results[(home, away)] = {
+                'home': home,
+                'away': away,
+                'homePoints': round(home_points, 2),
+                'awayPoints': round(away_points, 2),
+                'homeProbability': round(probabilities[i][0], 4),
+                'awayProbability': round(probabilities[i][1], 4),
+                'winner': winner
+            }
+        return results
+
+    def reload(self):
+        # Checks the served files at most every RELOAD_INTERVAL seconds. The
+        # new model is loaded by one query while the others keep being
+        # answered from the current one.
+        if not self._files or time.time() - self._checked < RELOAD_INTERVAL:
+            return
+        if not self._reload_lock.acquire(False):
+            return
+        try:
+            self._checked = time.time()
+            signature = self._files.signature()
+            # A model file which is missing is being retrained.
+            if signature == self._signature or \
+               (self._files.model_file and not signature[0]):
+                return
+            try:
+                predictor, team_stats, signature = self._files.load(
+                    self._state[0], self._signature)
+            except Exception:
+                # Files which are still being written are tried again on
+                # the next check.
+                traceback.print_exc()
+                return
+            results = {}
+            if self._precomputed:
+                results = self._predict(predictor, team_stats,
+                                        all_matchups(team_stats))
+            self._state = (predictor, team_stats, results)
+            self._signature = signature
+            print 'Reloaded the model and team stats'
+        finally:
+            self._reload_lock.release()
+
+    def predict(self, matchups):
+        self.reload()
+        predictor, team_stats, results = self._state
+        # Matchups with a team that has no stats get an error in place of a
+        # prediction instead of failing the rest of the batch.
+        known = [(home, away) for home, away in matchups
+                 if home in team_stats and away in team_stats]
+        if any(matchup not in results for matchup in known):
+            # Score every unseen matchup in a single batch. Cached matchups
+            # are answered without ever waiting on the lock.
+            with self._lock:
+                missing = [matchup for matchup in set(known)
+                           if matchup not in results]
+                if missing:
+                    results.update(self._predict(predictor, team_stats,
+                                                 missing))
+        return [results[matchup] if matchup in results
+                else unknown_team(*matchup) for matchup in matchups]
+
+    def precompute(self):
+        # Reloaded models are precomputed as well.
+        self._precomputed = True
+        self.predict(all_matchups(self.team_stats))
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def _respond(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, matchups, single):
+        results = self.service.predict(matchups)
+        if single:
+            self._respond(404 if 'error' in results[0] else 200, results[0])
+        else:
+            self._respond(200, {'results': results})
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path not in ['/matchup', '/probability']:
+            self._respond(404, {'error': 'Unknown endpoint: %s' % url.path})
+            return
+        try:
+            matchup = (query['home'][0], query['away'][0])
+        except KeyError:
+            self._respond(400, {'error': 'Both home and away are required.'})
+            return
+        self._handle([matchup], True)
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/matchups':
+            self._respond(404, {'error': 'Unknown endpoint: %s' % self.path})
+            return
+        length = int(self.headers.getheader('content-length', 0))
+        try:
+            body = json.loads(self.rfile.read(length))
+            matchups = [(str(game['home']), str(game['away']))
+                        for game in body['matchups']]
+        except (ValueError, KeyError, TypeError):
+            self._respond(400, {'error': 'Expected {"matchups": [{"home": '
+                                         '..., "away": ...}]}'})
+            return
+        self._handle(matchups, False)
+
+    def log_message(self, format, *args):
+        return
+
+
+def request_predictions(matchups, server=DEFAULT_SERVER, timeout=5):
+    body = json.dumps({'matchups': [{'home': home, 'away': away}
+                                    for home, away in matchups]})
+    request = urllib2.Request('%s/matchups' % server, body,
+                              {'Content-Type': 'application/json'})
+    response = urllib2.urlopen(request, timeout=timeout)
+    return json.load(response)['results']
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', help='Specify which dataset to use. For '
+    'testing purposes, use the "sample-data" directory. For production '
+    'deployments, use "matches" with current data that was pulled.',
+    default='matches')
+    parser.add_argument('--model', help='Optionally specify a saved model to '
+    'load instead of training a new one. If the file does not exist yet, the '
+    'newly trained model is saved there. The running server loads it again '
+    'whenever it or the team stats change, such as after the daily pipeline.',
+    default=None)
+    parser.add_argument('--host', help='Specify the address to listen on.',
+    default=DEFAULT_HOST)
+    parser.add_argument('--port', help='Specify the port to listen on.',
+    type=int, default=DEFAULT_PORT)
+    parser.add_argument('--precompute', help='Optionally score every possible '
+    'matchup on startup so no query ever waits on the model.',
+    action='store_true')
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    instrumentation.start(args)
+    files = ServedFiles(args.dataset, args.model, jobs=args.jobs)
+    predictor, team_stats, signature = files.load()
+    PredictionHandler.service = PredictionService(predictor, team_stats,
+                                                  files, signature)
+    if args.precompute:
+        PredictionHandler.service.precompute()
+    server = ThreadedHTTPServer((args.host, args.port), PredictionHandler)
+    print 'Serving predictions on http://%s:%s' % (args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
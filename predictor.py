@@ -1,36 +1,200 @@
+import multiprocessing
+import os
 import pandas as pd
 import numpy as np
-from common import differential_vector, filter_stats
-from glob import glob
-from sklearn import tree
-from sklearn.externals.six import StringIO
-from sklearn.metrics import accuracy_score
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.feature_selection import SelectFromModel
+from forest_inference import FlatForest, NUMPY_MAX_ROWS
+from instrumentation import count, timed
+from match_store import (TRAINING_CACHE_DIRECTORY,
+                         TRAINING_DATA_VERSION,
+                         build_training_data)
+from surrogate import Surrogate
+
+# sklearn is imported by the methods which use it. Loading a saved model only
+# pulls in the classes stored in it, and scripts answer --help without it.
+
+
+MODEL_VERSION = 1
+# The number of cores to train and predict with when none is given. Like
+# sklearn's n_jobs, -1 uses every core.
+JOBS_VARIABLE = 'PREDICTOR_JOBS'
+# Batches smaller than this are always predicted on a single thread since
+# starting the worker threads would cost more than it saves.
+PARALLEL_MIN_ROWS = 5000
+# Incremental updates append this many trees fitted on the most recent games
+# and drop the oldest trees once the forest grows past MAX_TREES.
+UPDATE_TREES = 10
+MAX_TREES = 100
+RECENT_GAMES = 2000
+FOREST_PARAMETERS = {'bootstrap': False,
+                     'min_samples_leaf': 3,
+                     'n_estimators': 50,
+                     'min_samples_split': 10,
+                     'max_features': 'sqrt',
+                     'max_depth': 6}
+# Features whose importance in the initial forest falls below this are
+# dropped before the final forest is fit.
+SELECTION_THRESHOLD = 0.01
+
+
+def default_jobs():
+    return int(os.environ.get(JOBS_VARIABLE, 1))
 
 
 class Predictor:
-    def __init__(self, data_directory='matches'):
+    def __init__(self, data_directory='matches',
+                 cache_directory=TRAINING_CACHE_DIRECTORY, processes=None,
+                 compact=False, model_file=None, engine='sklearn',
+                 jobs=None, data=None, test_games=None, random_state=None,
+                 parameters=None):
+        # In compact mode, features are kept as float32 NumPy arrays with the
+        # column names tracked separately instead of float64 DataFrames.
+        self.compact = compact
+        # The "flat" engine evaluates the forest from flattened node arrays
+        # instead of going through sklearn's per-tree predict.
+        self.engine = engine
+        self.jobs = jobs if jobs is not None else default_jobs()
+        self.random_state = random_state
+        # The forest parameters and selection threshold, such as a winning
+        # configuration from hyperparameter_search.py.
+        self.parameters = dict(FOREST_PARAMETERS,
+                               threshold=SELECTION_THRESHOLD)
+        self.parameters.update(parameters or {})
+        self._flat_model = None
+        self._columns = None
         self._regressor = None
         self._model = None
+        self._fitted = False
+        self._surrogate = None
+        self._model_file = model_file
+        # The games the model has seen and how many incremental updates were
+        # applied since it was last trained from scratch.
+        self._games = set()
+        self.updates = 0
+        # Every game the accuracy is scored on. None of them are ever
+        # trained on, including by later updates.
+        self._test_games = set()
         self._X_train = None
         self._X_test = None
         self._y_train = None
         self._y_test = None
 
-        data = self._read_data(data_directory)
-        self._create_features(data)
+        # A previously saved model is loaded as-is, skipping reading the
+        # match data and training entirely.
+        if model_file and os.path.exists(model_file):
+            self._load(model_file)
+            return
+        # Already processed training data can be passed in directly, along
+        # with the games to hold out instead of a random split.
+        if data is None:
+            data = self._read_data(data_directory, cache_directory, processes)
+        self._games = set(data.index)
+        self._create_features(data, test_games)
         self._create_regressor()
         self._train_model()
+        if model_file:
+            self.save(model_file)
+
+    @property
+    def features(self):
+        return list(self._filtered_features)
+
+    @property
+    def forest(self):
+        if not self._fitted:
+            self._fit_model()
+        return self._model
+
+    @property
+    def test_data(self):
+        if not self._fitted:
+            self._fit_model()
+        return self._X_test
+
+    @property
+    def test_games(self):
+        return sorted(self._test_games)
 
     @property
     def accuracy(self):
-        predicted = self.predict(self._X_test, int)
-        accuracy = round(accuracy_score(self._y_test, predicted) * 100.0, 2)
+        accuracy = self.score()
         print 'Accuracy: %s%%' % accuracy
+        return accuracy
+
+    @property
+    def can_update(self):
+        # Models saved before games and held-out games were tracked can only
+        # be retrained.
+        return bool(self._games) and bool(self._test_games)
+
+    def score(self):
+        from sklearn.metrics import accuracy_score
+        if not self._fitted:
+            self._fit_model()
+        predicted = self.predict(self._X_test, int)
+        # Score the predicted winners since the points are multi-output.
+        actual_winners = self._y_test[:, 0] >= self._y_test[:, 1]
+        predicted_winners = predicted[:, 0] >= predicted[:, 1]
+        return round(accuracy_score(actual_winners, predicted_winners) *
+                     100.0, 2)
+
+    @timed('predictor.update')
+    def update(self, data_directory='matches',
+               cache_directory=TRAINING_CACHE_DIRECTORY, processes=None,
+               trees=UPDATE_TREES, max_trees=MAX_TREES,
+               recent_games=RECENT_GAMES):
+        # Rather than retraining from scratch, warm-start the existing forest
+        # with a few new trees fitted on the most recent games, keeping the
+        # selected features as they are. Returns the number of new games.
+        from sklearn.model_selection import train_test_split
+        if not self._fitted:
+            self._fit_model()
+        data = self._read_data(data_directory, cache_directory, processes)
+        new_games = sorted(set(data.index) - self._games)
+        if not new_games:
+            return 0
+        # Hold out part of the new games so the accuracy keeps tracking
+        # games the model hasn't seen.
+        test_games = []
+        if len(new_games) > 1:
+            new_games, test_games = train_test_split(new_games)
+        self._test_games.update(test_games)
+        held_out = data.index.isin(list(self._test_games))
+        recent = data[~held_out].sort_index().iloc[-recent_games:]
+        X_recent = self._select_features(recent, None)
+        self._model.set_params(warm_start=True, n_jobs=self.jobs,
+                               n_estimators=len(self._model.estimators_) +
+                               trees)
+        self._model.fit(X_recent, recent[['home_points',
+                                          'away_points']].values)
+        self._model.set_params(warm_start=False)
+        if len(self._model.estimators_) > max_trees:
+            self._model.estimators_ = self._model.estimators_[-max_trees:]
+            self._model.set_params(n_estimators=max_trees)
+        if test_games:
+            self._append_test_data(data.loc[test_games])
+        self._games.update(data.index)
+        self.updates += 1
+        self._flat_model = None
+        # The surrogate mimics the previous forest, so it has to be distilled
+        # again from the updated one.
+        self._surrogate = None
+        return len(new_games) + len(test_games)
+
+    def surrogate(self):
+        # The distilled surrogate is trained the first time it is requested
+        # and saved alongside the forest so later runs can load it directly.
+        if self._surrogate is None:
+            if not self._fitted:
+                self._fit_model()
+            self._surrogate = Surrogate(self)
+            self._surrogate.train(self._X_train, self._X_test)
+            if self._model_file:
+                self.save(self._model_file)
+        return self._surrogate
 
     def print_tree(self):
+        from sklearn import tree
+        from sklearn.externals.six import StringIO
         dot_data = StringIO()
         i = 1
         for tree_in_forest in self._model.estimators_:
@@ -43,50 +207,182 @@ class Predictor:
                                             special_characters=True)
             i += 1
 
-    def simplify(self, test_data):
-        test_data = test_data.loc[:, test_data.columns.isin(self._filtered_features)]
-        test_data = test_data.reindex(self._filtered_features, axis=1)
-        self._X_test = self._X_test.reindex(self._filtered_features, axis=1)
-        parameters = {'bootstrap': False,
-                      'min_samples_leaf': 3,
-                      'n_estimators': 50,
-                      'min_samples_split': 10,
-                      'max_features': 'sqrt',
-                      'max_depth': 6}
-        self._model = RandomForestRegressor(**parameters)
-        self._model.fit(self._X_train, self._y_train)
+    @timed('predictor.simplify')
+    def simplify(self, test_data, columns=None):
+        if self.compact:
+            test_data = self._select_features(test_data, columns)
+        else:
+            test_data = test_data.loc[:, test_data.columns.isin(self._filtered_features)]
+            test_data = test_data.reindex(self._filtered_features, axis=1)
+        if not self._fitted:
+            self._fit_model()
         return test_data
 
+    @timed('predictor.predict')
     def predict(self, test_data, output_datatype):
+        count('predicted_rows', len(test_data))
+        jobs = self._jobs_for(len(test_data))
+        if self.engine == 'flat' and (FlatForest.compiled or
+                                      len(test_data) <= NUMPY_MAX_ROWS):
+            threads = jobs if jobs > 0 else multiprocessing.cpu_count()
+            return self._flat_forest().predict(test_data, threads) \
+                .astype(output_datatype)
+        self._model.n_jobs = jobs
         return self._model.predict(test_data).astype(output_datatype)
 
-    def _read_data(self, data_directory):
-        frames = [pd.read_pickle(match) for match in \
-                  glob('%s/*/*' % data_directory)]
-        data = pd.concat(frames)
-        data.drop_duplicates(inplace=True)
-        data = filter_stats(data)
-        data = data.dropna()
-        data['home_free_throw_percentage'].fillna(0, inplace=True)
-        data['away_free_throw_percentage'].fillna(0, inplace=True)
-        data['points_difference'] = data['home_points'] - data['away_points']
-        return differential_vector(data)
-
-    def _create_features(self, data):
-        X = data.drop('away_points', 1)
-        X = X.drop('home_points', 1)
+    def predict_probability(self, test_data):
+        # The share of trees in the forest which pick each team to win, given
+        # as [home, away] for every row.
+        test_data = np.asarray(test_data, dtype=np.float32)
+        if self.engine == 'flat':
+            points = self._flat_forest().predict_trees(test_data)
+            home_wins = (points[:, :, 0] >= points[:, :, 1]).sum(axis=0)
+        else:
+            home_wins = np.zeros(len(test_data))
+            for tree_in_forest in self._model.estimators_:
+                points = tree_in_forest.predict(test_data)
+                home_wins += points[:, 0] >= points[:, 1]
+        home_probability = home_wins / float(len(self._model.estimators_))
+        return np.column_stack([home_probability, 1.0 - home_probability])
+
+    def save(self, model_file):
+        from sklearn.externals import joblib
+        directory = os.path.dirname(model_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        if not self._fitted:
+            self._fit_model()
+        artifact = {'version': MODEL_VERSION,
+                    'training_data_version': TRAINING_DATA_VERSION,
+                    'features': self._filtered_features,
+                    'model': self._model,
+                    'X_test': self._X_test,
+                    'y_test': self._y_test,
+                    'games': sorted(self._games),
+                    'test_games': sorted(self._test_games),
+                    'updates': self.updates,
+                    'parameters': self.parameters}
+        if self._surrogate:
+            artifact['surrogate'] = self._surrogate.state()
+        joblib.dump(artifact, model_file)
+
+    @timed('predictor.load_model')
+    def _load(self, model_file):
+        from sklearn.externals import joblib
+        artifact = joblib.load(model_file)
+        if artifact['version'] != MODEL_VERSION:
+            raise ValueError('%s was saved by an incompatible version of the '
+                             'predictor. Delete it to retrain.' % model_file)
+        # Features computed by a different version of process_matches don't
+        # mean the same thing as the ones the model was trained on.
+        if artifact.get('training_data_version') != TRAINING_DATA_VERSION:
+            raise ValueError('%s was trained on an older version of the '
+                             'training data. Delete it to retrain.' %
+                             model_file)
+        self._filtered_features = artifact['features']
+        self._model = artifact['model']
+        self._X_test = artifact['X_test']
+        self._y_test = artifact['y_test']
+        self._games = set(artifact.get('games', []))
+        self._test_games = set(artifact.get('test_games', []))
+        self.updates = artifact.get('updates', 0)
+        self.parameters.update(artifact.get('parameters', {}))
+        self._flat_model = None
+        self._fitted = True
+        if artifact.get('surrogate'):
+            self._surrogate = Surrogate(self, artifact['surrogate'])
+
+    @timed('predictor.fit')
+    def _fit_model(self):
+        from sklearn.ensemble import RandomForestRegressor
+        if not self.compact:
+            self._X_test = self._X_test.reindex(self._filtered_features,
+                                                axis=1)
+        parameters = dict(self.parameters)
+        parameters.pop('threshold')
+        self._model = RandomForestRegressor(n_jobs=self.jobs,
+                                            random_state=self.random_state,
+                                            **parameters)
+        self._model.fit(self._X_train, self._y_train)
+        self._flat_model = None
+        self._fitted = True
+
+    def _jobs_for(self, rows):
+        if rows < PARALLEL_MIN_ROWS:
+            return 1
+        return self.jobs
+
+    def _append_test_data(self, data):
+        X_test = data.reindex(self._filtered_features, axis=1)
+        if isinstance(self._X_test, np.ndarray):
+            X_test = X_test.values.astype(np.float32)
+            self._X_test = np.vstack([self._X_test, X_test])
+        else:
+            self._X_test = pd.concat([self._X_test, X_test])
+        self._y_test = np.vstack([self._y_test,
+                                  data[['home_points', 'away_points']].values])
+
+    def _flat_forest(self):
+        if self._flat_model is None:
+            self._flat_model = FlatForest(self._model)
+        return self._flat_model
+
+    def _select_features(self, test_data, columns):
+        if columns is None:
+            columns = [str(col) for col in test_data.columns]
+        positions = [columns.index(feature) for feature in
+                     self._filtered_features]
+        if isinstance(test_data, pd.DataFrame):
+            # Only the features have to be numeric, not every column.
+            return test_data.iloc[:, positions].values.astype(np.float32)
+        return np.asarray(test_data, dtype=np.float32)[:, positions]
+
+    @timed('predictor.read_data')
+    def _read_data(self, data_directory, cache_directory, processes):
+        # Only games which haven't been processed on a previous run are read
+        # and transformed. Passing no cache_directory rebuilds from scratch.
+        # Match files are decoded across a pool of processes if requested.
+        # Compact data is read straight into float32, so the match data is
+        # never held at double precision along the way.
+        dtype = np.float32 if self.compact else np.float64
+        return build_training_data(data_directory, cache_directory,
+                                   processes, dtype)
+
+    def _create_features(self, data, test_games=None):
+        from sklearn.model_selection import train_test_split
+        X = data.drop(['away_points', 'home_points'], axis=1)
         y = data[['home_points', 'away_points']].values
-        split_data = train_test_split(X, y)
+        if self.compact:
+            self._columns = [str(col) for col in X.columns]
+            # Converting the frame before taking its values avoids a float64
+            # copy of the mixed float32 and integer ranking columns.
+            X = X.astype(np.float32).values
+        if test_games is None:
+            test_games = train_test_split(data.index,
+                                          random_state=self.random_state)[1]
+        test = np.asarray(data.index.isin(test_games))
+        self._test_games = set(data.index[test])
+        split_data = [X[~test], X[test], y[~test], y[test]]
         self._X_train, self._X_test, self._y_train, self._y_test = split_data
 
+    @timed('predictor.select_features')
     def _create_regressor(self):
-        reg = RandomForestRegressor(n_estimators=50, max_features='sqrt')
+        from sklearn.ensemble import RandomForestRegressor
+        reg = RandomForestRegressor(n_estimators=50, max_features='sqrt',
+                                    n_jobs=self.jobs,
+                                    random_state=self.random_state)
         self._regressor = reg.fit(self._X_train, self._y_train)
 
     def _train_model(self):
+        from sklearn.feature_selection import SelectFromModel
         train = self._X_train
         self._model = SelectFromModel(self._regressor, prefit=True,
-                                      threshold=0.01)
+                                      threshold=self.parameters['threshold'])
         self._X_train = self._model.transform(self._X_train)
-        new_columns = train.columns[self._model.get_support()]
+        support = self._model.get_support()
+        if self.compact:
+            self._X_test = self._X_test[:, support]
+            new_columns = np.array(self._columns)[support]
+        else:
+            new_columns = train.columns[support]
         self._filtered_features = [str(col) for col in new_columns]
@@ -1,6 +1,9 @@
 import argparse
+import instrumentation
+from datetime import datetime
+from manifest import IngestManifest, stats_version
 from os import path, makedirs
-from sportsreference.ncaab.teams import Teams
+from response_cache import CACHE_DIRECTORY, ResponseCache, install_cache
 
 
 def check_dir(directory):
@@ -30,6 +33,23 @@ def arguments():
     parser.add_argument('--skip-pulling-matches', help='Optionally choose to '
                         'skip saving individual match data and instead just '
                         'pull team stats data.', action='store_true')
+    parser.add_argument('--cache-directory', help='Specify the directory to '
+                        'cache downloaded pages in.', default=CACHE_DIRECTORY)
+    parser.add_argument('--offline', help='Optionally only replay pages which '
+                        'were previously saved to the cache without touching '
+                        'the network.', action='store_true')
+    parser.add_argument('--manifest', help='Specify the file which records '
+                        'every game and team stats version that has already '
+                        'been ingested. Defaults to "manifest.json" inside the'
+                        ' match data location.', default=None)
+    parser.add_argument('--incremental', help='Optionally only pull games '
+                        'played since the last recorded run and skip the '
+                        'schedules of teams whose stats have not changed.',
+                        action='store_true')
+    parser.add_argument('--since', help='Optionally only pull games played on'
+                        ' or after the given date, formatted as YYYY-MM-DD. '
+                        'Implies --incremental.', default=None)
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -63,27 +83,68 @@ def add_sos_and_srs(game, teams, team):
     return df
 
 
+def find_since(args, manifest):
+    if args.since:
+        return datetime.strptime(args.since, '%Y-%m-%d')
+    if args.incremental and manifest.last_run:
+        # Games from the day of the last run may have finished after it, so
+        # always start from the beginning of that day.
+        return datetime(manifest.last_run.year, manifest.last_run.month,
+                        manifest.last_run.day)
+    return None
+
+
+def played_before(game, since):
+    if not since:
+        return False
+    try:
+        return game.datetime < since
+    except TypeError:
+        return False
+
+
 def main():
+    # sportsreference is only needed once the stats are actually pulled.
+    from sportsreference.ncaab.teams import Teams
     args = arguments()
+    instrumentation.start(args)
+    install_cache(ResponseCache(args.cache_directory, args.offline))
     check_dir(args.match_data_location)
     check_dir(args.team_stats_location)
+    manifest = IngestManifest(args.manifest or
+                              '%s/manifest.json' % args.match_data_location)
+    since = find_since(args, manifest)
     teams = Teams()
     for team in teams:
         df = team.dataframe
         defensive_rebound_percentage = 100.0 * df['defensive_rebounds'] /\
             (df['defensive_rebounds'] + df['opp_offensive_rebounds'])
         df['defensive_rebound_percentage'] = defensive_rebound_percentage
-        df.to_pickle('%s/%s.plk' % (args.team_stats_location,
-                                    team.abbreviation.lower()))
-        if args.skip_pulling_matches:
+        abbreviation = team.abbreviation.lower()
+        version = stats_version(df)
+        stats_changed = manifest.team_stats_changed(abbreviation, version)
+        if stats_changed:
+            df.to_pickle('%s/%s.plk' % (args.team_stats_location,
+                                        abbreviation))
+            manifest.add_team_stats(abbreviation, version)
+        # A team whose stats haven't moved since the last run hasn't played
+        # a new game either, so its schedule doesn't need to be pulled.
+        if args.skip_pulling_matches or (since and not stats_changed):
+            manifest.save()
             continue
         for game in team.schedule:
+            if not game.boxscore_index or played_before(game, since):
+                continue
             path = '%s/%s/%s.plk' % (args.match_data_location,
-                                     team.abbreviation.lower(),
+                                     abbreviation,
                                      game.boxscore_index)
-            if check_path(path, team.abbreviation.lower(),
-                          args.match_data_location) or \
-               not game.boxscore_index:
+            # Every game appears on both teams' schedules. Only store it the
+            # first time it is seen so each game is saved exactly once.
+            if manifest.has_game(game.boxscore_index):
+                continue
+            if check_path(path, abbreviation, args.match_data_location):
+                manifest.add_game(game.boxscore_index, abbreviation, path,
+                                  game.datetime)
                 continue
             # Occurs when the opponent is Non-DI and the game should be skipped
             # since only DI matchups should be analyzed.
@@ -96,6 +157,10 @@ def main():
                 df.to_pickle(path)
             except AttributeError:
                 continue
+            manifest.add_game(game.boxscore_index, abbreviation, path,
+                              game.datetime)
+        manifest.save()
+    manifest.save(finished=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import re
+import requests
+import time
+from datetime import datetime, timedelta
+
+
+CACHE_DIRECTORY = '.cache/responses'
+# Pages which can still change, such as today's scores or the current season's
+# team stats, are only trusted for a short period of time. Anything describing
+# a day that has already been completed is treated as immutable.
+TODAY_TTL = 15 * 60
+DEFAULT_TTL = 6 * 60 * 60
+IMMUTABLE = None
+INDEX_DATE_REGEX = 'month=(\d+)&day=(\d+)&year=(\d+)'
+BOXSCORE_DATE_REGEX = 'boxscores/(\d{4})-(\d{2})-(\d{2})-'
+
+
+class CachedResponse:
+    def __init__(self, url, status_code, content, encoding=None,
+                 headers=None, reason='OK'):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.headers = headers or {}
+        self.reason = reason
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError('%s %s' % (self.status_code,
+                                                           self.reason))
+
+
+def ttl_for_date(date):
+    # Late games and stat corrections can still land the morning after, so
+    # only pages older than yesterday are considered final.
+    if date.date() < (datetime.now() - timedelta(days=1)).date():
+        return IMMUTABLE
+    return TODAY_TTL
+
+
+def ttl_for_url(url):
+    match = re.search(INDEX_DATE_REGEX, url)
+    if match:
+        month, day, year = [int(value) for value in match.groups()]
+        return ttl_for_date(datetime(year, month, day))
+    match = re.search(BOXSCORE_DATE_REGEX, url)
+    if match:
+        year, month, day = [int(value) for value in match.groups()]
+        return ttl_for_date(datetime(year, month, day))
+    return DEFAULT_TTL
+
+
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIRECTORY, offline=False):
+        self.directory = directory
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return hashlib.sha1(value).hexdigest()
+
+    def _index_path(self, url):
+        digest = self._digest(url)
+        return os.path.join(self.directory, 'index', digest[:2],
+                            '%s.json' % digest)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def _write(self, filename, data, mode='wb'):
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Write to a temporary file first so an interrupted run never leaves a
+        # truncated page behind.
+        temporary = '%s.%s.tmp' % (filename, os.getpid())
+        with open(temporary, mode) as output:
+            output.write(data)
+        os.rename(temporary, filename)
+
+    def _expired(self, entry):
+        if entry['ttl'] is IMMUTABLE:
+            return False
+        return time.time() - entry['fetched'] > entry['ttl']
+
+    def lookup(self, url):
+        try:
+            with open(self._index_path(url)) as index_file:
+                entry = json.load(index_file)
+            with open(self._object_path(entry['digest']), 'rb') as body:
+                content = body.read()
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        # Replaying offline serves whatever was recorded, however old it is.
+        if not self.offline and self._expired(entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedResponse(entry['url'], entry['status_code'], content,
+                              entry['encoding'], entry['headers'])
+
+    def store(self, url, response, ttl=IMMUTABLE):
+        # Never cache failures, otherwise a temporary outage would be replayed
+        # as the permanent state of a historical page.
+        if response is None or response.status_code != 200:
+            return
+        digest = self._digest(response.content)
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            self._write(object_path, response.content)
+        entry = {
+            'url': url,
+            'digest': digest,
+            'status_code': response.status_code,
+            'encoding': response.encoding,
+            'headers': {'content-type': response.headers.get('content-type')},
+            'fetched': time.time(),
+            'ttl': ttl
+        }
+        self._write(self._index_path(url), json.dumps(entry), 'w')
+
+
+def install_cache(cache):
+    # Libraries such as sportsreference issue their own requests.get calls
+    # for every page. Route those through the cache as well so scraping runs
+    # only touch the network for pages which are new or have gone stale.
+    uncached_get = requests.get
+
+    def cached_get(url, params=None, **kwargs):
+        if params:
+            return uncached_get(url, params=params, **kwargs)
+        response = cache.lookup(url)
+        if response:
+            return response
+        if cache.offline:
+            raise requests.exceptions.ConnectionError('%s is not in the '
+                                                      'response cache' % url)
+        response = uncached_get(url, **kwargs)
+        cache.store(url, response, ttl_for_url(url))
+        return response
+
+    requests.get = cached_get
+    return uncached_get
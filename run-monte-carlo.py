@@ -1,37 +1,174 @@
+import argparse
+import data_sources
+import hashlib
+import instrumentation
 import os
+import subprocess
+import sys
+from data_sources import get_source
 from predictor import Predictor
-from pymongo import MongoClient
-from monte_carlo_simulation import start_simulations, NUM_SIMS
-from save_json import Simulation, save_simulation
-from sportsreference.ncaab.conferences import Conferences
+from monte_carlo_simulation import (NUM_SIMS,
+                                    SIMS_PER_TASK,
+                                    simulate_conferences,
+                                    simulate_task,
+                                    simulation_tasks,
+                                    write_tallies)
+from mongo_store import run_id_for_date, simulation_store
+from save_json import SIMULATION_FILE, SimulationWriter, read_records
+from simulation_histograms import (HISTOGRAM_FILE,
+                                   HistogramReader,
+                                   HistogramWriter)
+from team_stats import TeamStatsStore
+from work_queue import DEFAULT_PORT, Coordinator, run_worker, serve
 
 
-def save_to_mongodb(simulation):
-    client = MongoClient()
-    db = client.clarktechsports
-    # Clear all of the existing simulations and add simulation for the current
-    # day
-    db.conference_predictions.update_many({}, {'$set': {'latest': False}})
-    post = simulation['simulation']['conferences']
-    db.conference_predictions.insert_many(post)
+def save_to_mongodb(simulations):
+    # The simulation is saved as the run for the current day, replacing any
+    # earlier run from the same day.
+    simulation_store().save_run(run_id_for_date(), simulations)
+
+
+def model_digest(model_file):
+    # Sent with every task so workers can tell that they loaded the same
+    # model as the coordinator.
+    digest = hashlib.sha1()
+    with open(model_file, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def start_local_worker(args, port):
+    command = [sys.executable, os.path.abspath(__file__), '--worker',
+               'localhost:%s' % port, '--model', args.model]
+    return subprocess.Popen(command)
+
+
+def coordinate(args, writer):
+    # Hands the simulations out to the workers which connect and merges the
+    # tallies they return. Nothing is written until every task is done.
+    conferences = get_source().conferences()
+    tasks = simulation_tasks(conferences, args.num_sims, args.sims_per_task,
+                             args.seed)
+    if args.workers and not os.path.exists(args.model):
+        # Train the model once instead of in every local worker.
+        Predictor(args.dataset, model_file=args.model)
+    if args.model and os.path.exists(args.model):
+        digest = model_digest(args.model)
+        for task in tasks:
+            task['model'] = digest
+    coordinator = Coordinator(tasks)
+    server = serve(coordinator, args.coordinator)
+    print 'Waiting for workers on %s:%s for %s tasks' % (
+        server.server_address + (len(tasks),))
+    workers = [start_local_worker(args, server.server_address[1])
+               for i in range(args.workers)]
+    try:
+        coordinator.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+    write_tallies(writer, conferences, coordinator.tallies, args.num_sims)
+    for worker in workers:
+        worker.wait()
+
+
+def work(args):
+    # Every worker loads the same saved model and reads the team stats on
+    # its own host. Everything else comes with the tasks.
+    digest = model_digest(args.model)
+    predictor = Predictor(model_file=args.model, compact=True, engine='flat')
+    store = TeamStatsStore('team-stats', predictor.features)
+
+    def run_task(task):
+        # Results from a different model would be merged with the others
+        # unnoticed, so the worker stops and its task goes to another one.
+        if task.get('model', digest) != digest:
+            sys.exit('%s is not the model the coordinator uses.' % args.model)
+        return simulate_task(predictor, task, store)
+
+    completed = run_worker(args.worker, run_task)
+    print 'Ran %s tasks' % completed
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--binary', help='Optionally save the place '
+    'histograms to %s instead of %s. It is much smaller at large simulation '
+    'counts and can be converted back with simulation_histograms.py.' %
+    (HISTOGRAM_FILE, SIMULATION_FILE), action='store_true')
+    parser.add_argument('--dataset', help='Specify which dataset to use. For '
+    'testing purposes, use the "sample-data" directory. For production '
+    'deployments, use "matches" with current data that was pulled.',
+    default='matches')
+    parser.add_argument('--model', help='Optionally specify a saved model to '
+    'load instead of training a new one. If the file does not exist yet, the '
+    'newly trained model is saved there. Workers need a copy of the same '
+    'saved model, which is checked against the coordinator\'s.',
+    default=None)
+    parser.add_argument('--num-sims', '-n', help='Specify the number of '
+    'simulations of every conference. Default is %s.' % NUM_SIMS, type=int,
+    default=NUM_SIMS)
+    parser.add_argument('--skip-save-to-mongodb', help='Optionally skip saving'
+    ' results to a MongoDB database.', action='store_true')
+    parser.add_argument('--processes', '-p', help='Optionally simulate the '
+    'conferences in the given number of processes, which share the team stats'
+    ' and the model through memory-mapped files. Use -1 for every core. '
+    'Default is 1.', type=int, default=1)
+    parser.add_argument('--coordinator', help='Optionally hand the '
+    'simulations out to workers connecting to the given HOST[:PORT], such as '
+    '"0.0.0.0:%s", instead of running them here.' % DEFAULT_PORT,
+    default=None)
+    parser.add_argument('--worker', help='Run as a worker for the coordinator '
+    'at the given HOST[:PORT] until it has no simulations left.',
+    default=None)
+    parser.add_argument('--workers', help='Optionally start the given number '
+    'of workers on this host along with the coordinator. Default is 0.',
+    type=int, default=0)
+    parser.add_argument('--sims-per-task', help='Specify how many simulations '
+    'of a conference the coordinator hands out at a time. Default is %s.' %
+    SIMS_PER_TASK, type=int, default=SIMS_PER_TASK)
+    parser.add_argument('--seed', help='Optionally specify the seed of a '
+    'coordinated run, which makes its results reproducible.', type=int,
+    default=None)
+    data_sources.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if (args.worker or args.workers) and not args.model:
+        parser.error('Workers need a saved model given with --model so they '
+                     'all use the same one.')
+    # A worker never trains a model of its own, which could differ from the
+    # coordinator's.
+    if args.worker and not os.path.exists(args.model):
+        parser.error('%s does not exist. Copy the coordinator\'s model to '
+                     'this host first.' % args.model)
+    return args
 
 
 def main():
-    predictor = Predictor()
-    results_dict = {}
-    points_dict = {}
-
-    for abbreviation, details in Conferences().conferences.items():
-        results, points = start_simulations(predictor, details)
-        results_dict[abbreviation] = {'results': results,
-                                      'name': details['name']}
-        points_dict[abbreviation] = {'points': points,
-                                     'name': details['name']}
-    simulation = save_simulation(NUM_SIMS,
-                                 results_dict,
-                                 points_dict,
-                                 'simulations/simulation.json')
-    save_to_mongodb(simulation)
+    args = arguments()
+    instrumentation.start(args)
+    data_sources.start(args)
+    if args.worker:
+        work(args)
+        return
+    if args.binary:
+        writer = HistogramWriter(HISTOGRAM_FILE, args.num_sims)
+    else:
+        writer = SimulationWriter(SIMULATION_FILE, args.num_sims)
+    with writer:
+        if args.coordinator:
+            coordinate(args, writer)
+        else:
+            predictor = Predictor(args.dataset, model_file=args.model)
+            simulate_conferences(predictor, get_source().conferences(),
+                                 writer, args.num_sims, args.processes)
+    if args.skip_save_to_mongodb:
+        return
+    if args.binary:
+        save_to_mongodb(HistogramReader(HISTOGRAM_FILE).simulations())
+    else:
+        save_to_mongodb(read_records(SIMULATION_FILE))
 
 
 if __name__ == "__main__":
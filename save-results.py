@@ -1,10 +1,14 @@
+import argparse
+import instrumentation
 import json
 import re
 import requests
-from bs4 import BeautifulSoup
+from common import make_request
 from constants import YEAR
+from datetime import datetime
 from os import listdir
 from os.path import isfile, join
+from response_cache import CACHE_DIRECTORY, ResponseCache, ttl_for_date
 from save_json import save_json
 
 
@@ -87,11 +91,21 @@ def get_saved_prediction(filename):
         return json.load(prediction)
 
 
-def iterate_files(files):
+def get_date(filename):
+    month, day, year = filename.replace('.json', '').split('-')
+    return datetime(int(year), int(month), int(day))
+
+
+def iterate_files(files, cache):
+    from bs4 import BeautifulSoup
+    session = requests.Session()
     for filename in files:
         url = get_url(filename)
         saved_data = get_saved_prediction(filename)
-        boxscores = requests.get(url)
+        boxscores = make_request(session, url, cache,
+                                 ttl_for_date(get_date(filename)))
+        if not boxscores:
+            continue
         saved_data = parse_boxscore(BeautifulSoup(boxscores.text, 'lxml'),
                                     saved_data)
         save_json(saved_data, 'predictions/%s' % filename)
@@ -101,9 +115,23 @@ def get_files():
     return [f for f in listdir('predictions') if isfile(join('predictions', f))]
 
 
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-directory', help='Specify the directory to '
+                        'cache downloaded pages in.', default=CACHE_DIRECTORY)
+    parser.add_argument('--offline', help='Optionally only replay pages which '
+                        'were previously saved to the cache without touching '
+                        'the network.', action='store_true')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
 def main():
+    args = arguments()
+    instrumentation.start(args)
+    cache = ResponseCache(args.cache_directory, args.offline)
     files = get_files()
-    iterate_files(files)
+    iterate_files(files, cache)
 
 
 if __name__ == "__main__":
@@ -2,56 +2,100 @@ import json
 from mascots import MASCOTS
 
 
-class Simulation:
-    def __init__(self, num_sims, results_dict, points_dict):
-        conferences_list = []
-        for conference, standings in results_dict.items():
-            teams_list = []
-            conf_name = standings['name']
-            for nickname, standings in standings['results'].items():
-                position = standings['points'].index(max(standings['points']))
-                win_prob = float(standings['points'][0]) / float(num_sims)
-                seed_prob = float(standings['points'][position]) / \
-                            float(num_sims)
-                points = points_dict[conference]['points'][nickname]
-                name = standings['name']
-                mascot = MASCOTS[nickname]
-                team_dict = {
-                    "name": name,
-                    "abbreviation": nickname,
-                    "mascot": mascot,
-                    "standings": standings['points'],
-                    "projectedWins": float(points) / float(num_sims),
-                    "seedProbability": seed_prob,
-                    "winProbability": win_prob
-                }
-                teams_list.append(team_dict)
-            conferences_list.append({'teams': teams_list,
-                                     'conferenceAbbreviation': conference,
-                                     'conferenceName': conf_name,
-                                     'latest': True,
-                                     'num_sims': num_sims})
-        self.simulation = {
-            "conferences": conferences_list
+SIMULATION_FILE = 'simulations/simulation.ndjson'
+# The single JSON document layout the website reads.
+DOCUMENT_FILE = 'simulations/simulation.json'
+
+
+def conference_simulation(num_sims, conference, conf_name, results, points):
+    teams_list = []
+    for nickname, standings in results.items():
+        position = standings['points'].index(max(standings['points']))
+        win_prob = float(standings['points'][0]) / float(num_sims)
+        seed_prob = float(standings['points'][position]) / float(num_sims)
+        name = standings['name']
+        mascot = MASCOTS[nickname]
+        team_dict = {
+            "name": name,
+            "abbreviation": nickname,
+            "mascot": mascot,
+            "standings": standings['points'],
+            "projectedWins": float(points[nickname]) / float(num_sims),
+            "seedProbability": seed_prob,
+            "winProbability": win_prob
         }
+        teams_list.append(team_dict)
+    return {'teams': teams_list,
+            'conferenceAbbreviation': conference,
+            'conferenceName': conf_name,
+            'latest': True,
+            'num_sims': num_sims}
 
 
-def save_predictions_json(predictions, output_file):
-    prediction_json = []
-    for prediction in predictions:
-        prediction_json.append(prediction)
-    prediction_json = {"predictions": prediction_json}
-    with open(output_file, 'w') as fp:
-        json.dump(prediction_json, fp)
+class RecordWriter:
+    def __init__(self, output_file, envelope=None):
+        # Every record is written on its own line and flushed right away so
+        # readers can follow the file while it is still being written. With
+        # an envelope, such as "predictions", the finished file is also a
+        # regular JSON document of the form {"predictions": [...]}.
+        self._file = open(output_file, 'w')
+        self._envelope = envelope
+        self.count = 0
+        if envelope:
+            self._file.write('{"%s": [\n' % envelope)
 
+    def __enter__(self):
+        return self
 
-def save_simulation(num_sims, results_dict, points_dict, output_file):
-    simulation = Simulation(num_sims, results_dict, points_dict).__dict__
-    with open(output_file, 'w') as fp:
-        json.dump(simulation, fp)
-    return simulation
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, record):
+        separator = ',' if self._envelope and self.count else ''
+        self._file.write('%s%s\n' % (separator, json.dumps(record)))
+        self._file.flush()
+        self.count += 1
+
+    def close(self):
+        if self._envelope:
+            self._file.write(']}\n')
+        self._file.close()
+
+
+class SimulationWriter(RecordWriter):
+    def __init__(self, output_file, num_sims):
+        RecordWriter.__init__(self, output_file)
+        self.num_sims = num_sims
+
+    def write_conference(self, conference, conf_name, results, points):
+        self.write(conference_simulation(self.num_sims, conference, conf_name,
+                                         results, points))
+
+
+def read_records(filename):
+    # Reads the records written by RecordWriter one line at a time. A last
+    # line without a newline is still being written and is left for later.
+    with open(filename) as record_file:
+        for line in record_file:
+            if not line.endswith('\n'):
+                return
+            line = line.strip().lstrip(',')
+            if not line or line.endswith('[') or line == ']}':
+                continue
+            yield json.loads(line)
+
+
+def save_predictions_json(predictions, output_file):
+    with RecordWriter(output_file, 'predictions') as writer:
+        for prediction in predictions:
+            writer.write(prediction)
 
 
 def save_json(json_data, output_file):
     with open(output_file, 'w') as fp:
         json.dump(json_data, fp)
+
+
+def save_simulation_document(simulations, output_file=DOCUMENT_FILE):
+    save_json({'simulation': {'conferences': list(simulations)}},
+              output_file)
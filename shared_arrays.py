@@ -0,0 +1,92 @@
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+from forest_inference import ARRAYS, FlatForest
+
+
+# Files in a tmpfs live in memory, so mapping them never touches the disk.
+# Without one, the page cache still shares the mapped files between
+# processes.
+SHARED_MEMORY_DIRECTORY = '/dev/shm'
+INDEX_FILE = 'index.json'
+
+
+class SharedArrays:
+    def __init__(self, directory=None):
+        # The parent creates a new directory, writes the arrays into it and
+        # hands its path to the workers, which attach to the same directory.
+        # Every array is memory-mapped read-only, so all processes share a
+        # single copy of its pages instead of unpickling their own.
+        self.owner = directory is None
+        if self.owner:
+            parent = None
+            if os.path.isdir(SHARED_MEMORY_DIRECTORY):
+                parent = SHARED_MEMORY_DIRECTORY
+            directory = tempfile.mkdtemp(prefix='ncaab-', dir=parent)
+            self.index = {}
+        else:
+            with open(os.path.join(directory, INDEX_FILE)) as index_file:
+                self.index = json.load(index_file)
+        self.directory = directory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _filename(self, name):
+        return os.path.join(self.directory, '%s.npy' % name)
+
+    def write(self, name, array):
+        np.save(self._filename(name), np.ascontiguousarray(array))
+
+    def read(self, name):
+        return np.load(self._filename(name), mmap_mode='r')
+
+    def write_index(self, index):
+        # Names such as the teams and columns the arrays are laid out by.
+        self.index = index
+        with open(os.path.join(self.directory, INDEX_FILE), 'w') as \
+                index_file:
+            json.dump(index, index_file)
+
+    def close(self):
+        # Workers which are still attached keep their mappings until they
+        # exit, even once the files are removed.
+        if self.owner and os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+
+def share_forest(shared, predictor):
+    # Saves the predictor's forest as flattened node arrays together with
+    # the features it is evaluated on.
+    for name, array in FlatForest(predictor.forest).arrays().items():
+        shared.write('forest_%s' % name, array)
+    return {'features': predictor.features}
+
+
+class SharedModel:
+    # Stands in for a compact predictor in processes which attached to a
+    # forest saved with share_forest. Nothing is copied out of the shared
+    # arrays except for the rows of every batch.
+    compact = True
+
+    def __init__(self, shared):
+        arrays = dict((name, shared.read('forest_%s' % name)) for name in
+                      ARRAYS + ['depth'])
+        self._forest = FlatForest(arrays=arrays)
+        self._features = shared.index['features']
+
+    @property
+    def features(self):
+        return list(self._features)
+
+    def simplify(self, test_data, columns):
+        positions = [columns.index(feature) for feature in self._features]
+        return np.asarray(test_data, dtype=np.float32)[:, positions]
+
+    def predict(self, test_data, output_datatype):
+        return self._forest.predict(test_data).astype(output_datatype)
@@ -0,0 +1,161 @@
+import argparse
+import json
+import numpy as np
+import os
+import struct
+from save_json import (DOCUMENT_FILE,
+                       SIMULATION_FILE,
+                       RecordWriter,
+                       conference_simulation,
+                       read_records,
+                       save_simulation_document)
+
+
+HISTOGRAM_FILE = 'simulations/simulation.hist'
+MAGIC = 'CTSHIST1'
+COUNT_DTYPE = '<u4'
+FOOTER = struct.Struct('<Q')
+
+
+class HistogramWriter:
+    def __init__(self, output_file, num_sims):
+        # The file starts with MAGIC followed by the place histogram of every
+        # conference as a (teams x places) block of counts. A JSON header with
+        # the team index and the offset of every conference is written at the
+        # end, followed by the header's position, so conferences can be
+        # appended as soon as their simulations finish.
+        self._file = open(output_file, 'wb')
+        self._file.write(MAGIC)
+        self._offset = 0
+        self._header = {'version': 1,
+                        'num_sims': num_sims,
+                        'dtype': COUNT_DTYPE,
+                        'conferences': []}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_conference(self, conference, conf_name, results, points):
+        teams = sorted(results)
+        counts = np.array([results[team]['points'] for team in teams],
+                          dtype=COUNT_DTYPE)
+        self._file.write(counts.tobytes())
+        self._header['conferences'].append({
+            'abbreviation': conference,
+            'name': conf_name,
+            'offset': self._offset,
+            'teams': teams,
+            'names': [results[team]['name'] for team in teams],
+            'points': [points[team] for team in teams]})
+        self._offset += counts.size
+
+    def close(self):
+        position = len(MAGIC) + self._offset * np.dtype(COUNT_DTYPE).itemsize
+        self._file.write(json.dumps(self._header))
+        self._file.write(FOOTER.pack(position))
+        self._file.close()
+
+
+class HistogramReader:
+    def __init__(self, filename):
+        with open(filename, 'rb') as histogram_file:
+            if histogram_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a simulation histogram file' %
+                                 filename)
+            histogram_file.seek(-FOOTER.size, 2)
+            end = histogram_file.tell()
+            position, = FOOTER.unpack(histogram_file.read(FOOTER.size))
+            histogram_file.seek(position)
+            self.header = json.loads(histogram_file.read(end - position))
+        self.num_sims = self.header['num_sims']
+        self.conferences = self.header['conferences']
+        # The counts are memory-mapped, so only the conferences which are
+        # looked at are ever read from disk.
+        num_counts = (position - len(MAGIC)) // \
+            np.dtype(self.header['dtype']).itemsize
+        self._counts = np.memmap(filename, dtype=self.header['dtype'],
+                                 mode='r', offset=len(MAGIC),
+                                 shape=(num_counts,))
+
+    def find(self, conference):
+        for details in self.conferences:
+            if conference in [details['name'], details['abbreviation']]:
+                return details
+        raise ValueError('No simulation found for %s' % conference)
+
+    def histogram(self, details):
+        num_teams = len(details['teams'])
+        start = details['offset']
+        return self._counts[start:start + num_teams * num_teams] \
+            .reshape(num_teams, num_teams)
+
+    def simulation(self, details):
+        # Rebuild the conference in the same schema as the JSON output.
+        histogram = self.histogram(details)
+        results = {}
+        points = {}
+        for i, team in enumerate(details['teams']):
+            results[team] = {'name': details['names'][i],
+                             'points': histogram[i].tolist()}
+            points[team] = details['points'][i]
+        return conference_simulation(self.num_sims, details['abbreviation'],
+                                     details['name'], results, points)
+
+    def simulations(self):
+        for details in self.conferences:
+            yield self.simulation(details)
+
+
+def is_histogram_file(filename):
+    with open(filename, 'rb') as input_file:
+        return input_file.read(len(MAGIC)) == MAGIC
+
+
+def read_simulations(filename):
+    # Either a histogram file or the conferences written one per line.
+    if is_histogram_file(filename):
+        return HistogramReader(filename).simulations()
+    return read_records(filename)
+
+
+def convert(input_file, output_file, document=False):
+    simulations = read_simulations(input_file)
+    if document:
+        # The single JSON document layout of the original simulation.json.
+        save_simulation_document(simulations, output_file)
+        return
+    with RecordWriter(output_file) as writer:
+        for simulation in simulations:
+            writer.write(simulation)
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('histogram', help='Specify the histogram file to '
+    'convert, or a simulation with one conference per line such as %s. '
+    'Default is %s.' % (SIMULATION_FILE, HISTOGRAM_FILE), nargs='?',
+    default=HISTOGRAM_FILE)
+    parser.add_argument('--output', help='Specify where to write the JSON '
+    'simulation. Default is %s, or %s with --document.' % (SIMULATION_FILE,
+    DOCUMENT_FILE), default=None)
+    parser.add_argument('--document', help='Optionally write a single JSON '
+    'document of the form {"simulation": {"conferences": [...]}} instead of '
+    'one conference per line.', action='store_true')
+    args = parser.parse_args()
+    if not args.output:
+        args.output = DOCUMENT_FILE if args.document else SIMULATION_FILE
+    if os.path.abspath(args.output) == os.path.abspath(args.histogram):
+        parser.error('The output would overwrite the file being converted.')
+    return args
+
+
+def main():
+    args = arguments()
+    convert(args.histogram, args.output, args.document)
+
+
+if __name__ == '__main__':
+    main()
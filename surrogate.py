@@ -0,0 +1,69 @@
+import numpy as np
+
+
+RIDGE_ALPHA = 1.0
+
+
+class Surrogate:
+    def __init__(self, predictor, state=None):
+        # The surrogate mimics the forest of the given predictor, so it shares
+        # the predictor's selected features and layout.
+        self._predictor = predictor
+        self.compact = predictor.compact
+        self._model = None
+        self._fidelity = None
+        if state:
+            self._model = state['model']
+            self._fidelity = state['fidelity']
+
+    @property
+    def features(self):
+        return self._predictor.features
+
+    @property
+    def fidelity(self):
+        for name, value in sorted(self._fidelity.items()):
+            print '%s: %s' % (name, value)
+        return self._fidelity
+
+    def state(self):
+        return {'model': self._model, 'fidelity': self._fidelity}
+
+    def simplify(self, test_data, columns=None):
+        return self._predictor.simplify(test_data, columns)
+
+    def predict(self, test_data, output_datatype):
+        test_data = np.asarray(test_data, dtype=np.float32)
+        return self._model.predict(test_data).astype(output_datatype)
+
+    def train(self, X_train, X_test):
+        # The surrogate is fit to the forest's predictions instead of the
+        # actual scores. A loaded model no longer has its training data, so
+        # part of the held-out data is used for distillation instead.
+        from sklearn.linear_model import Ridge
+        from sklearn.model_selection import train_test_split
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+        X_test = np.asarray(X_test, dtype=np.float32)
+        if X_train is None:
+            X_train, X_test = train_test_split(X_test, test_size=0.5)
+        X_train = np.asarray(X_train, dtype=np.float32)
+        forest = self._predictor.forest
+        self._model = make_pipeline(StandardScaler(), Ridge(alpha=RIDGE_ALPHA))
+        self._model.fit(X_train, forest.predict(X_train))
+        self._fidelity = self._measure(forest.predict(X_test),
+                                       self._model.predict(X_test))
+
+    def _measure(self, expected, actual):
+        # Compare the surrogate against the forest on held-out games, both on
+        # the predicted margin and on which team is picked to win.
+        expected_margin = expected[:, 0] - expected[:, 1]
+        actual_margin = actual[:, 0] - actual[:, 1]
+        agreement = np.mean((expected_margin >= 0) == (actual_margin >= 0))
+        error = np.abs(expected_margin - actual_margin)
+        correlation = np.corrcoef(expected_margin, actual_margin)[0, 1]
+        return {'games': len(expected),
+                'winner_agreement': round(agreement * 100.0, 2),
+                'margin_mae': round(error.mean(), 3),
+                'margin_max_error': round(error.max(), 3),
+                'margin_correlation': round(correlation, 4)}
@@ -0,0 +1,63 @@
+import numpy
+import pandas as pd
+from common import (differential_matrix,
+                    extract_stats_components,
+                    read_team_stats_files,
+                    team_stat_columns,
+                    update_stats)
+from glob import glob
+from instrumentation import timed
+from os import path
+
+
+FIELDS_TO_DROP = ['abbreviation', 'conference', 'name']
+
+
+class TeamStatsStore:
+    @timed('team_stats.load')
+    def __init__(self, directory='team-stats', features=None, processes=None):
+        # When the model's features are known, only the team stats they are
+        # derived from are read and transformed.
+        columns = None
+        if features:
+            columns = team_stat_columns(features)
+        filenames = [path.splitext(f)[0] for f in
+                     sorted(glob('%s/*.plk' % directory))]
+        stats = read_team_stats_files(filenames, processes, columns)
+        # Team stats are indexed by the uppercase abbreviation while the files
+        # are saved using the lowercase abbreviation.
+        stats.index = [str(team).lower() for team in stats.index]
+        stats = update_stats(stats)
+        stats = stats.drop([field for field in FIELDS_TO_DROP
+                            if field in stats], axis=1)
+        home_stats = extract_stats_components(stats, columns=columns)
+        away_stats = extract_stats_components(stats, away=True,
+                                              columns=columns)
+        self.teams = dict((team, i) for i, team in enumerate(stats.index))
+        self.home_columns = [str(col) for col in home_stats.columns]
+        self.away_columns = [str(col) for col in away_stats.columns]
+        self.home_stats = home_stats.values.astype(numpy.float32)
+        self.away_stats = away_stats.values.astype(numpy.float32)
+
+    def __contains__(self, team):
+        return team in self.teams
+
+    def matchups(self, matchups):
+        # Build the differential feature rows for every (home, away) pair in
+        # a single vectorized pass.
+        home_rows = [self.teams[home] for home, away in matchups]
+        away_rows = [self.teams[away] for home, away in matchups]
+        match_stats = numpy.hstack([self.away_stats[away_rows],
+                                    self.home_stats[home_rows]])
+        match_vector, columns = differential_matrix(
+            match_stats, self.away_columns + self.home_columns)
+        if 'home_points' not in columns:
+            return match_vector, columns
+        points_difference = match_vector[:, columns.index('home_points')] - \
+            match_vector[:, columns.index('away_points')]
+        match_vector = numpy.column_stack([match_vector, points_difference])
+        return match_vector, columns + ['points_difference']
+
+    def matchup_frame(self, matchups):
+        match_vector, columns = self.matchups(matchups)
+        return pd.DataFrame(match_vector, columns=columns)
@@ -0,0 +1,126 @@
+import argparse
+import instrumentation
+import json
+import os
+import time
+from datetime import datetime
+from match_store import TRAINING_CACHE_DIRECTORY
+from predictor import (JOBS_VARIABLE,
+                       MAX_TREES,
+                       UPDATE_TREES,
+                       Predictor)
+
+
+FULL_RETRAIN_EVERY = 7
+
+
+def drift_log_filename(model_file):
+    return '%s.drift.json' % os.path.splitext(model_file)[0]
+
+
+def log_drift(filename, entry):
+    # One JSON object is appended per run so the history can be followed
+    # over the season.
+    with open(filename, 'a') as drift_log:
+        drift_log.write('%s\n' % json.dumps(entry, sort_keys=True))
+
+
+def retrain(args, parameters=None, test_games=None):
+    # A full retrain keeps the parameters of the model it replaces. Holding
+    # out the same games as that model lets their accuracies be compared.
+    start = time.time()
+    predictor = Predictor(args.dataset, args.cache_directory, jobs=args.jobs,
+                          parameters=parameters, test_games=test_games)
+    accuracy = predictor.score()
+    return predictor, accuracy, time.time() - start
+
+
+def update(args, predictor):
+    start = time.time()
+    games = predictor.update(args.dataset, args.cache_directory,
+                             trees=args.trees, max_trees=args.max_trees)
+    return games, predictor.score(), time.time() - start
+
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='Specify the saved model to update. It '
+    'is trained from scratch if it does not exist yet.')
+    parser.add_argument('--dataset', help='Specify which dataset to use. For '
+    'testing purposes, use the "sample-data" directory. For production '
+    'deployments, use "matches" with current data that was pulled.',
+    default='matches')
+    parser.add_argument('--cache-directory', help='Specify where the '
+    'processed training data is cached. Default is %s.' %
+    TRAINING_CACHE_DIRECTORY, default=TRAINING_CACHE_DIRECTORY)
+    parser.add_argument('--trees', help='Specify how many trees to add for '
+    'the new games. Default is %s.' % UPDATE_TREES, type=int,
+    default=UPDATE_TREES)
+    parser.add_argument('--max-trees', help='Specify how many trees the forest'
+    ' may grow to before the oldest are dropped. Default is %s.' % MAX_TREES,
+    type=int, default=MAX_TREES)
+    parser.add_argument('--full-retrain-every', help='Specify after how many '
+    'incremental updates the model is retrained from scratch instead. Default'
+    ' is %s.' % FULL_RETRAIN_EVERY, type=int, default=FULL_RETRAIN_EVERY)
+    parser.add_argument('--full', help='Optionally retrain the model from '
+    'scratch regardless of the schedule.', action='store_true')
+    parser.add_argument('--compare', help='Optionally also train a model from '
+    'scratch after an incremental update to measure the accuracy drift. The '
+    'saved model is not replaced by it.', action='store_true')
+    parser.add_argument('--jobs', '-j', help='Optionally specify the number '
+    'of cores to train and predict with. Use -1 for every core. Defaults to '
+    'the %s environment variable, or 1 if it is not set.' % JOBS_VARIABLE,
+    type=int, default=None)
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = arguments()
+    instrumentation.start(args)
+    entry = {'date': datetime.now().isoformat()}
+    predictor = None
+    if os.path.exists(args.model):
+        predictor = Predictor(model_file=args.model, jobs=args.jobs)
+    if predictor and predictor.can_update and not args.full and \
+       predictor.updates < args.full_retrain_every:
+        games, accuracy, elapsed = update(args, predictor)
+        if games:
+            print 'Added %s trees for %s new games in %.1fs' % (args.trees,
+                                                               games, elapsed)
+        else:
+            print 'No new games since the last update'
+        entry.update({'mode': 'update', 'games': games,
+                      'updates': predictor.updates,
+                      'trees': len(predictor.forest.estimators_),
+                      'accuracy': accuracy, 'seconds': round(elapsed, 2)})
+        if args.compare:
+            full, full_accuracy, full_elapsed = retrain(
+                args, predictor.parameters, predictor.test_games)
+            entry.update({'full_accuracy': full_accuracy,
+                          'drift': round(accuracy - full_accuracy, 2)})
+    else:
+        previous, parameters, test_games = None, None, None
+        if predictor and predictor.can_update:
+            previous, parameters = predictor.score(), predictor.parameters
+            test_games = predictor.test_games
+        elif predictor:
+            parameters = predictor.parameters
+        predictor, accuracy, elapsed = retrain(args, parameters, test_games)
+        print 'Retrained from scratch in %.1fs' % elapsed
+        entry.update({'mode': 'full', 'accuracy': accuracy,
+                      'seconds': round(elapsed, 2)})
+        if previous is not None:
+            # The model being replaced is the incrementally updated one, so
+            # this is how far it drifted from a full retrain.
+            entry.update({'incremental_accuracy': previous,
+                          'drift': round(previous - accuracy, 2)})
+    predictor.save(args.model)
+    print 'Accuracy: %s%%' % entry['accuracy']
+    if 'drift' in entry:
+        print 'Drift against a full retrain: %s points' % entry['drift']
+    log_drift(drift_log_filename(args.model), entry)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import json
+import numpy as np
+import socket
+import SocketServer
+import threading
+import time
+from collections import deque
+
+
+DEFAULT_PORT = 5557
+# A task whose worker neither returns it nor disconnects within this long is
+# handed out again, such as when the worker's host stops responding.
+LEASE_SECONDS = 600
+# How long a worker waits before asking again while every remaining task is
+# being run by another worker.
+WAIT_SECONDS = 1.0
+# How long workers keep trying to reach a coordinator which isn't up yet or
+# went away.
+CONNECT_TIMEOUT = 60
+# How long a finished coordinator keeps telling connected workers that there
+# is nothing left to do.
+LINGER_SECONDS = 5
+
+
+def parse_address(address):
+    if ':' not in address:
+        return address, DEFAULT_PORT
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+class Tally:
+    def __init__(self):
+        # Arrays of counts or totals which are summed element by element, so
+        # partial tallies can be merged in any order and grouping.
+        self.arrays = {}
+
+    def add(self, arrays):
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if name in self.arrays:
+                self.arrays[name] = self.arrays[name] + array
+            else:
+                self.arrays[name] = array.copy()
+
+
+class Coordinator:
+    def __init__(self, tasks, lease_seconds=LEASE_SECONDS):
+        # Every task is a dictionary with a unique "id" and a "key". The arrays
+        # returned for all tasks with the same key are merged into one Tally.
+        self.tasks = dict((task['id'], task) for task in tasks)
+        self.tallies = {}
+        self._pending = deque(task['id'] for task in tasks)
+        self._leases = {}
+        self._completed = set()
+        self._connections = 0
+        self._lease_seconds = lease_seconds
+        self._condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return len(self._completed) == len(self.tasks)
+
+    def connect(self):
+        with self._condition:
+            self._connections += 1
+
+    def disconnect(self, worker):
+        # Whatever a worker was running when it went away, such as when it
+        # was restarted, goes back to the front of the queue.
+        with self._condition:
+            self._connections -= 1
+            for task_id, (owner, deadline) in self._leases.items():
+                if owner == worker:
+                    del self._leases[task_id]
+                    self._pending.appendleft(task_id)
+            self._condition.notify_all()
+
+    def lease(self, worker):
+        with self._condition:
+            now = time.time()
+            for task_id, (owner, deadline) in self._leases.items():
+                if deadline < now:
+                    del self._leases[task_id]
+                    self._pending.append(task_id)
+            if not self._pending:
+                return None
+            task_id = self._pending.popleft()
+            self._leases[task_id] = (worker, now + self._lease_seconds)
+            return self.tasks[task_id]
+
+    def complete(self, task_id, arrays):
+        with self._condition:
+            # A task which was handed out again can be returned twice. Tasks
+            # give the same result wherever they run, so the first is kept.
+            if task_id not in self.tasks or task_id in self._completed:
+                return
+            self._leases.pop(task_id, None)
+            if task_id in self._pending:
+                self._pending.remove(task_id)
+            self._completed.add(task_id)
+            key = self.tasks[task_id]['key']
+            self.tallies.setdefault(key, Tally()).add(arrays)
+            print '[coordinator] %s/%s tasks done' % (len(self._completed),
+                                                      len(self.tasks))
+            self._condition.notify_all()
+
+    def wait(self, linger=LINGER_SECONDS):
+        with self._condition:
+            while not self.finished:
+                self._condition.wait(WAIT_SECONDS)
+            deadline = time.time() + linger
+            while self._connections and time.time() < deadline:
+                self._condition.wait(WAIT_SECONDS)
+
+
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+    # Workers send one JSON message per line and get one line back. They ask
+    # for a task with {"type": "task"} and return it with {"type": "result",
+    # "id": ..., "arrays": {...}}.
+    def handle(self):
+        coordinator = self.server.coordinator
+        worker = '%s:%s' % self.client_address
+        coordinator.connect()
+        try:
+            for line in iter(self.rfile.readline, ''):
+                message = json.loads(line)
+                if message['type'] == 'result':
+                    coordinator.complete(message['id'], message['arrays'])
+                    reply = {'ok': True}
+                elif coordinator.finished:
+                    reply = {'done': True}
+                else:
+                    task = coordinator.lease(worker)
+                    if task:
+                        reply = {'task': task}
+                    else:
+                        reply = {'wait': WAIT_SECONDS}
+                self.wfile.write('%s\n' % json.dumps(reply))
+        except (socket.error, ValueError):
+            pass
+        finally:
+            coordinator.disconnect(worker)
+
+
+class CoordinatorServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, coordinator):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 CoordinatorHandler)
+        self.coordinator = coordinator
+
+
+def serve(coordinator, address):
+    # Starts answering workers in the background. Port 0 picks a free port,
+    # which is in the returned server's server_address.
+    server = CoordinatorServer(parse_address(address), coordinator)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _connect(address, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except socket.error:
+            if time.time() > deadline:
+                return None
+            time.sleep(WAIT_SECONDS)
+
+
+def _request(connection, reader, message):
+    connection.sendall('%s\n' % json.dumps(message))
+    line = reader.readline()
+    if not line:
+        raise socket.error('The coordinator closed the connection')
+    return json.loads(line)
+
+
+def run_worker(address, run_task, connect_timeout=CONNECT_TIMEOUT):
+    # Runs tasks from the coordinator until it has none left and returns how
+    # many were run. Lost connections are retried, so workers can be started
+    # before the coordinator and keep going if it is restarted.
+    address = parse_address(address)
+    completed = 0
+    while True:
+        connection = _connect(address, connect_timeout)
+        if connection is None:
+            print 'Could not reach the coordinator at %s:%s' % address
+            return completed
+        reader = connection.makefile('r')
+        try:
+            while True:
+                reply = _request(connection, reader, {'type': 'task'})
+                if reply.get('done'):
+                    return completed
+                if 'wait' in reply:
+                    time.sleep(reply['wait'])
+                    continue
+                task = reply['task']
+                arrays = run_task(task)
+                _request(connection, reader, {'type': 'result',
+                                              'id': task['id'],
+                                              'arrays': arrays})
+                completed += 1
+        except (socket.error, ValueError) as error:
+            print 'Lost the connection to the coordinator: %s' % error
+        finally:
+            reader.close()
+            connection.close()